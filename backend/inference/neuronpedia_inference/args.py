@@ -2,9 +2,7 @@ import argparse
 import json
 import os
 
-import torch
-
-from neuronpedia_inference.config import get_saelens_neuronpedia_directory_df
+from neuronpedia_inference.config import SaeLensDirectory
 
 
 def parse_env_and_args():
@@ -19,14 +17,9 @@ def parse_env_and_args():
     args.model_dtype = os.getenv("MODEL_DTYPE", "float32")
     args.sae_dtype = os.getenv("SAE_DTYPE", "float32")
     args.token_limit = int(os.getenv("TOKEN_LIMIT", "200"))
+    # resolved with get_available_device when the server initializes, so that parsing
+    # the args doesn't import torch
     args.device = os.getenv("DEVICE")
-    # set device to mps or cuda if available, otherwise cpu
-    if torch.backends.mps.is_available():
-        args.device = "mps"
-    elif torch.cuda.is_available():
-        args.device = "cuda"
-    else:
-        args.device = "cpu"
     args.include_sae = json.loads(os.getenv("INCLUDE_SAE", "[]"))
     args.exclude_sae = json.loads(os.getenv("EXCLUDE_SAE", "[]"))
     args.model_from_pretrained_kwargs = os.getenv("MODEL_FROM_PRETRAINED_KWARGS", "{}")
@@ -34,25 +27,42 @@ def parse_env_and_args():
     args.max_loaded_saes = int(os.getenv("MAX_LOADED_SAES", "300"))
     args.sentry_dsn = os.getenv("SENTRY_DSN")
     args.nnsight = os.getenv("NNSIGHT", "").lower() == "true"
-    args.optimize_memory = os.getenv("OPTIMIZE_MEMORY", "").lower() == "true"
     args.auto_clear_cache = os.getenv("AUTO_CLEAR_CACHE", "").lower() == "true"
+    args.batch_window_ms = float(os.getenv("BATCH_WINDOW_MS", "0"))
+    args.max_batch_size = int(os.getenv("MAX_BATCH_SIZE", "8"))
+    args.activation_cache_bytes = int(os.getenv("ACTIVATION_CACHE_BYTES", "0"))
+    args.sae_memory_budget_bytes = int(os.getenv("SAE_MEMORY_BUDGET_BYTES", "0"))
+    args.sae_host_memory_budget_bytes = int(os.getenv("SAE_HOST_MEMORY_BUDGET_BYTES", "0"))
+    args.sae_disk_cache_dir = os.getenv("SAE_DISK_CACHE_DIR")
+    args.sae_load_workers = int(os.getenv("SAE_LOAD_WORKERS", "4"))
+    args.sae_prefetch_count = int(os.getenv("SAE_PREFETCH_COUNT", "0"))
+    args.sae_compiled_dir = os.getenv("SAE_COMPILED_DIR")
+    args.n_devices = int(os.getenv("N_DEVICES", "1"))
+    args.n_replicas = int(os.getenv("N_REPLICAS", "1"))
+    args.prompt_kv_cache_bytes = int(os.getenv("PROMPT_KV_CACHE_BYTES", "0"))
 
     return args
 
 
+def get_available_device() -> str:
+    import torch
+
+    # set device to mps or cuda if available, otherwise cpu
+    if torch.backends.mps.is_available():
+        return "mps"
+    if torch.cuda.is_available():
+        return "cuda"
+    return "cpu"
+
+
 def list_available_options():
-    df = get_saelens_neuronpedia_directory_df()
-    df = df[df["neuronpedia_id"].notna()]  # Remove rows with None neuronpedia_id
-    models = df["model"].unique()  # type: ignore
-    df = df.sort_values(by=["model", "neuronpedia_set"])  # type: ignore
+    directory = SaeLensDirectory.get_instance()
 
     print("Available models and SAE sets:")
-    for model in models:
+    for model in directory.get_models():
         print(f"  {model}:")
-        model_df = df[df["model"] == model]
-        sae_sets = model_df["neuronpedia_set"].unique()  # type: ignore
-        for sae_set in sae_sets:
-            set_size = len(model_df[model_df["neuronpedia_set"] == sae_set])
+        for sae_set in sorted(directory.get_sets(model)):
+            set_size = len(directory.get_saes(model, sae_set))
             print(f"    - {sae_set} ({set_size} SAEs)")
 
         print("-" * 80)
@@ -0,0 +1,63 @@
+import logging
+import time
+
+from neuronpedia_inference.args import parse_env_and_args
+from neuronpedia_inference.config import Config, SaeLensDirectory
+from neuronpedia_inference.saes.saelens import SaeLensSAE, get_compiled_sae_path
+
+logger = logging.getLogger(__name__)
+
+
+def compile_saes() -> None:
+    """Compile the SAEs selected by the env (SAE_SETS, INCLUDE_SAE, ...) into SAE_COMPILED_DIR.
+
+    Each SAE is loaded from SAELens once, folded and converted to SAE_DTYPE, and saved
+    with its metadata, so that the server can load it without SAELens or its directory.
+    SAEs that have already been compiled are skipped.
+    """
+    logging.basicConfig(level=logging.INFO)
+    args = parse_env_and_args()
+    if args.sae_compiled_dir is None:
+        raise ValueError("Set --sae_compiled_dir to compile SAEs")
+
+    args_sae_sets = []
+    for sae_set in args.sae_sets:
+        args_sae_sets.extend(sae_set.split())
+    config = Config(
+        model_id=args.model_id,
+        custom_hf_model_id=args.custom_hf_model_id,
+        sae_sets=args_sae_sets,
+        sae_dtype=args.sae_dtype,
+        include_sae=args.include_sae,
+        exclude_sae=args.exclude_sae,
+        sae_compiled_dir=args.sae_compiled_dir,
+    )
+    model_id = (
+        config.custom_hf_model_id if config.custom_hf_model_id else config.model_id
+    )
+
+    directory = SaeLensDirectory.get_instance()
+    start_time = time.time()
+    n_compiled = 0
+    for sae_set in config.sae_config:
+        for sae_id in sae_set["saes"]:
+            path = get_compiled_sae_path(args.sae_compiled_dir, model_id, sae_id)
+            if SaeLensSAE.is_compiled(path):
+                logger.info(f"Already compiled SAE: {sae_id}")
+                continue
+
+            sae_start_time = time.time()
+            sae_lens_release, sae_lens_id = directory.get_sae_lens_ids(
+                model_id=model_id, neuronpedia_id=sae_id
+            )
+            SaeLensSAE.compile(sae_lens_release, sae_lens_id, path, config.sae_dtype)
+            n_compiled += 1
+            logger.info(
+                f"Compiled SAE: {sae_id} to {path} in {time.time() - sae_start_time:.2f} seconds"
+            )
+
+    logger.info(f"Compiled {n_compiled} SAEs in {time.time() - start_time:.2f} seconds")
+
+
+if __name__ == "__main__":
+    compile_saes()
@@ -1,10 +1,12 @@
 import json
 import logging
 import re
-from typing import Any
+import time
+from types import MappingProxyType
+from typing import Any, NamedTuple
 
-import pandas as pd
-from sae_lens.loading.pretrained_saes_directory import get_pretrained_saes_directory
+# sae_lens is imported where it's used, so that importing the config (e.g. by the
+# server, before it can answer health checks) stays fast
 
 logger = logging.getLogger(__name__)
 
@@ -39,8 +41,19 @@ class Config:
         max_loaded_saes: int = 100,
         steer_special_token_ids: list[int] | None = None,
         nnsight: bool = False,
-        optimize_memory: bool = False,
         auto_clear_cache: bool = False,
+        batch_window_ms: float = 0,
+        max_batch_size: int = 8,
+        activation_cache_bytes: int = 0,
+        sae_memory_budget_bytes: int = 0,
+        sae_host_memory_budget_bytes: int = 0,
+        sae_disk_cache_dir: str | None = None,
+        sae_load_workers: int = 4,
+        sae_prefetch_count: int = 0,
+        sae_compiled_dir: str | None = None,
+        n_devices: int = 1,
+        n_replicas: int = 1,
+        prompt_kv_cache_bytes: int = 0,
     ):
         self.model_id = model_id
         self.custom_hf_model_id = custom_hf_model_id
@@ -61,8 +74,19 @@ class Config:
         self.max_loaded_saes = max_loaded_saes
         self.steer_special_token_ids = steer_special_token_ids
         self.nnsight = nnsight
-        self.optimize_memory = optimize_memory
         self.auto_clear_cache = auto_clear_cache
+        self.batch_window_ms = batch_window_ms
+        self.max_batch_size = max_batch_size
+        self.activation_cache_bytes = activation_cache_bytes
+        self.sae_memory_budget_bytes = sae_memory_budget_bytes
+        self.sae_host_memory_budget_bytes = sae_host_memory_budget_bytes
+        self.sae_disk_cache_dir = sae_disk_cache_dir
+        self.sae_load_workers = sae_load_workers
+        self.sae_prefetch_count = sae_prefetch_count
+        self.sae_compiled_dir = sae_compiled_dir
+        self.n_devices = n_devices
+        self.n_replicas = n_replicas
+        self.prompt_kv_cache_bytes = prompt_kv_cache_bytes
 
         # Log configuration details after initialization
         logger.info(
@@ -80,8 +104,19 @@ class Config:
             f"  include_sae_patterns: {self.include_sae_patterns}\n"
             f"  exclude_sae_patterns: {self.exclude_sae_patterns}\n"
             f"  nnsight: {self.nnsight}\n"
-            f"  optimize_memory: {self.optimize_memory}\n"
             f"  auto_clear_cache: {self.auto_clear_cache}\n"
+            f"  batch_window_ms: {self.batch_window_ms}\n"
+            f"  max_batch_size: {self.max_batch_size}\n"
+            f"  activation_cache_bytes: {self.activation_cache_bytes}\n"
+            f"  sae_memory_budget_bytes: {self.sae_memory_budget_bytes}\n"
+            f"  sae_host_memory_budget_bytes: {self.sae_host_memory_budget_bytes}\n"
+            f"  sae_disk_cache_dir: {self.sae_disk_cache_dir}\n"
+            f"  sae_load_workers: {self.sae_load_workers}\n"
+            f"  sae_prefetch_count: {self.sae_prefetch_count}\n"
+            f"  sae_compiled_dir: {self.sae_compiled_dir}\n"
+            f"  n_devices: {self.n_devices}\n"
+            f"  n_replicas: {self.n_replicas}\n"
+            f"  prompt_kv_cache_bytes: {self.prompt_kv_cache_bytes}\n"
         )
 
     def set_num_layers(self, num_layers: int) -> None:
@@ -96,15 +131,12 @@ class Config:
         return set([sae_set["model"] for sae_set in self.sae_config])
 
     def _generate_sae_config(self):
-        directory_df = get_saelens_neuronpedia_directory_df()
-        config_json = config_to_json(
-            directory_df,
-            selected_sets_neuronpedia=self.sae_sets,
-            selected_model=(
+        return SaeLensDirectory.get_instance().get_sae_config(
+            model_id=(
                 self.custom_hf_model_id if self.custom_hf_model_id else self.model_id
             ),
+            sae_sets=self.sae_sets,
         )
-        return config_json  # noqa: RET504
 
     def _filter_sae_config(
         self, sae_config: list[dict[str, str | list[str]]]
@@ -145,87 +177,123 @@ class Config:
         return True
 
 
-# this is an example of a Claude refactor gone wrong. way too confusing.
-def get_saelens_neuronpedia_directory_df():
-    df = pd.DataFrame.from_records(
-        {k: v.__dict__ for k, v in get_pretrained_saes_directory().items()}
-    ).T
-    df.drop(
-        columns=[
-            "repo_id",
-            "saes_map",
-            "expected_var_explained",
-            "expected_l0",
-            "config_overrides",
-            "conversion_func",
-        ],
-        inplace=True,
-    )
-    df["neuronpedia_id_list"] = df["neuronpedia_id"].apply(lambda x: list(x.items()))
-    df_exploded = df.explode("neuronpedia_id_list")
-    df_exploded[["sae_lens_id", "neuronpedia_id"]] = pd.DataFrame(
-        df_exploded["neuronpedia_id_list"].tolist(), index=df_exploded.index
-    )
-    df_exploded = df_exploded.drop(columns=["neuronpedia_id_list"])
-    df_exploded = df_exploded.reset_index(drop=True)
-    df_exploded["neuronpedia_set"] = df_exploded["neuronpedia_id"].apply(
-        lambda x: ("-".join(x.split("/")[-1].split("-")[1:]) if x is not None else None)
-    )
-    return df_exploded
-
-
-def config_to_json(
-    directory_df: pd.DataFrame,
-    selected_sets_sae_lens: list[str] | None = None,
-    selected_sets_neuronpedia: list[str] | None = None,
-    selected_model: str | None = None,
-) -> list[dict[str, Any]]:
-    if selected_model:
-        directory_df = directory_df.loc[directory_df["model"] == selected_model]
-    if selected_sets_neuronpedia and selected_sets_sae_lens:
-        directory_df = directory_df.loc[
-            (directory_df["neuronpedia_set"].isin(selected_sets_neuronpedia))
-            | (directory_df["release"].isin(selected_sets_sae_lens))
-        ]
-    elif selected_sets_sae_lens:
-        directory_df = directory_df.loc[
-            directory_df["release"].isin(selected_sets_sae_lens)
-        ]
-    elif selected_sets_neuronpedia:
-        directory_df = directory_df.loc[
-            directory_df["neuronpedia_set"].isin(selected_sets_neuronpedia)
+def get_neuronpedia_set(neuronpedia_id: str) -> str:
+    # e.g. gpt2-small/5-res-jb -> res-jb
+    return "-".join(neuronpedia_id.split("/")[-1].split("-")[1:])
+
+
+class SaeDirectoryEntry(NamedTuple):
+    model: str
+    release: str
+    sae_lens_id: str
+    neuronpedia_id: str
+    neuronpedia_set: str
+
+    @property
+    def source(self) -> str:
+        """The neuronpedia source ID, e.g. 5-res-jb. This is what we call the SAE's ID."""
+        return self.neuronpedia_id.split("/")[-1]
+
+
+class SaeLensDirectory:
+    """The SAELens pretrained SAEs that are on neuronpedia, indexed by model and source.
+
+    It's built once, and never changes afterwards, so every lookup is a dict access
+    instead of a scan over the whole directory.
+    """
+
+    _instance = None  # Class variable to store the singleton instance
+
+    @classmethod
+    def get_instance(cls):
+        """Get the global SaeLensDirectory instance, creating it if it doesn't exist"""
+        if cls._instance is None:
+            cls._instance = SaeLensDirectory.from_pretrained_saes_directory()
+        return cls._instance
+
+    @classmethod
+    def from_pretrained_saes_directory(cls) -> "SaeLensDirectory":
+        from sae_lens.loading.pretrained_saes_directory import (
+            get_pretrained_saes_directory,
+        )
+
+        start_time = time.time()
+        entries = [
+            SaeDirectoryEntry(
+                model=lookup.model,
+                release=release,
+                sae_lens_id=sae_lens_id,
+                neuronpedia_id=neuronpedia_id,
+                neuronpedia_set=get_neuronpedia_set(neuronpedia_id),
+            )
+            for release, lookup in get_pretrained_saes_directory().items()
+            for sae_lens_id, neuronpedia_id in lookup.neuronpedia_id.items()
+            if neuronpedia_id is not None
         ]
-    grouped = directory_df.groupby("model")
-    config_json = []
-    for model, group in grouped:
-        # Get unique sets within the group (you can also use directory_df if that's intended)
-        sets_to_include = group["neuronpedia_set"].unique()
-        for set_name in sets_to_include:
-            set_data = group.loc[group["neuronpedia_set"] == set_name]
-            set_entry = {
-                "model": model,
-                "set": set_name,
+        directory = cls(entries)
+        logger.info(
+            f"Indexed {len(entries)} SAEs from the SAELens directory in "
+            f"{time.time() - start_time:.2f} seconds"
+        )
+        return directory
+
+    def __init__(self, entries: list[SaeDirectoryEntry]):
+        by_source: dict[tuple[str, str], list[SaeDirectoryEntry]] = {}
+        by_set: dict[tuple[str, str], list[SaeDirectoryEntry]] = {}
+        sets_by_model: dict[str, dict[str, None]] = {}
+        for entry in entries:
+            by_source.setdefault((entry.model, entry.source), []).append(entry)
+            by_set.setdefault((entry.model, entry.neuronpedia_set), []).append(entry)
+            # dicts as ordered sets, to keep the order of the directory
+            sets_by_model.setdefault(entry.model, {})[entry.neuronpedia_set] = None
+
+        self._by_source = MappingProxyType(
+            {key: tuple(value) for key, value in by_source.items()}
+        )
+        self._by_set = MappingProxyType(
+            {key: tuple(value) for key, value in by_set.items()}
+        )
+        self._sets_by_model = MappingProxyType(
+            {model: tuple(sets) for model, sets in sets_by_model.items()}
+        )
+
+    def get_models(self) -> tuple[str, ...]:
+        return tuple(self._sets_by_model)
+
+    def get_sets(self, model_id: str | None = None) -> tuple[str, ...]:
+        """Get the SAE sets of a model, or of every model if it's None."""
+        if model_id is not None:
+            return self._sets_by_model.get(model_id, ())
+        return tuple(
+            dict.fromkeys(
+                sae_set for sets in self._sets_by_model.values() for sae_set in sets
+            )
+        )
+
+    def get_saes(self, model_id: str, sae_set: str) -> tuple[SaeDirectoryEntry, ...]:
+        return self._by_set.get((model_id, sae_set), ())
+
+    def get_sae_lens_ids(self, model_id: str, neuronpedia_id: str) -> tuple[str, str]:
+        """Get the SAELens (release, sae_id) of a neuronpedia source ID, e.g. 5-res-jb."""
+        entries = self._by_source.get((model_id, neuronpedia_id), ())
+        if len(entries) != 1:
+            raise ValueError(
+                f"Found {len(entries)} entries when searching for {model_id}/{neuronpedia_id}"
+            )
+        return entries[0].release, entries[0].sae_lens_id
+
+    def get_sae_config(
+        self, model_id: str, sae_sets: list[str] | None = None
+    ) -> list[dict[str, Any]]:
+        """Get the sae_config of a model's SAE sets, for Config.sae_config."""
+        return [
+            {
+                "model": model_id,
+                "set": sae_set,
                 "type": "saelens-1",
                 "local": False,
-                "saes": [
-                    sae.split("/")[-1] for sae in set_data["neuronpedia_id"].tolist()
-                ],
+                "saes": [entry.source for entry in self.get_saes(model_id, sae_set)],
             }
-            config_json.append(set_entry)
-    return config_json
-
-
-def get_sae_lens_ids_from_neuronpedia_id(
-    model_id: str, neuronpedia_id: str, df_exploded: pd.DataFrame
-):
-    # find where neuronpedia_id ends in /neuronpedia_id and df_exploded["model"] = model_id
-    tmp_df = df_exploded[
-        (df_exploded["model"] == model_id)
-        & (df_exploded["neuronpedia_id"].str.endswith(f"/{neuronpedia_id}"))
-    ]
-    assert (
-        tmp_df.shape[0] == 1
-    ), f"Found {tmp_df.shape[0]} entries when searching for {model_id}/{neuronpedia_id}"
-    sae_lens_release = tmp_df.release.values[0]
-    sae_lens_id = tmp_df.sae_lens_id.values[0]
-    return sae_lens_release, sae_lens_id
+            for sae_set in self.get_sets(model_id)
+            if not sae_sets or sae_set in sae_sets
+        ]
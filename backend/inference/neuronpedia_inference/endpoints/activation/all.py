@@ -2,7 +2,6 @@ import logging
 import re
 from typing import Any
 
-import einops
 import torch
 from fastapi import APIRouter
 from fastapi.responses import JSONResponse
@@ -18,16 +17,24 @@ from neuronpedia_inference_client.models.activation_all_post_request import (
 from transformer_lens import ActivationCache
 
 from neuronpedia_inference.config import Config
+from neuronpedia_inference.inference_utils.dfa import calculate_batched_dfa_values
+from neuronpedia_inference.inference_utils.forward_batcher import ForwardBatcher
+from neuronpedia_inference.inference_utils.forward_plan import (
+    ForwardPlan,
+    get_forward_plan,
+)
 from neuronpedia_inference.sae_manager import SAEManager
-from neuronpedia_inference.shared import Model, with_request_lock
+from neuronpedia_inference.saes.saelens import SaeLensSAE
+from neuronpedia_inference.shared import Model
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
 
+# no request lock here - the forward pass takes the lock in the ForwardBatcher, so that
+# concurrent requests can be batched together
 @router.post("/activation/all")
-@with_request_lock()
 async def activation_all(
     request: ActivationAllPostRequest,
 ):
@@ -78,7 +85,7 @@ async def activation_all(
     try:
         logger.info("Processing activations")
         processor = ActivationProcessor()
-        result = processor.process_activations(request)
+        result = await processor.process_activations(request)
         logger.info("Activations result processed successfully")
 
         return result
@@ -93,42 +100,30 @@ async def activation_all(
         )
 
 
-def _get_safe_dtype(dtype: torch.dtype) -> torch.dtype:
-    """
-    Convert float16 to float32, leave other dtypes unchanged.
-    """
-    return torch.float32 if dtype == torch.float16 else dtype
-
-
-def _safe_cast(tensor: torch.Tensor, target_dtype: torch.dtype) -> torch.Tensor:
-    """
-    Safely cast a tensor to the target dtype, creating a copy if needed.
-    Convert float16 to float32, leave other dtypes unchanged.
-    """
-    safe_dtype = _get_safe_dtype(tensor.dtype)
-    if safe_dtype != tensor.dtype or safe_dtype != target_dtype:
-        return tensor.to(target_dtype)
-    return tensor
-
-
 class ActivationProcessor:
-    @torch.no_grad()
-    def process_activations(
+    async def process_activations(
         self, request: ActivationAllPostRequest
     ) -> ActivationAllPost200Response:
-        model = Model.get_instance()
         sae_manager = SAEManager.get_instance()
-        max_layer = max(self._get_layer_num(s) for s in request.selected_sources) + 1
-        if max_layer >= model.cfg.n_layers:
-            max_layer = None
 
         # Get the first sae and check if prepend bos is true, then pass to token getter
         first_layer = request.selected_sources[0]
         prepend_bos = sae_manager.get_sae(first_layer).cfg.metadata.prepend_bos
+        # start loading the next SAEs while the forward pass runs
+        sae_manager.prefetch_saes(request.selected_sources[1:])
 
-        _, str_tokens, cache = self._tokenize_and_get_cache(
-            request.prompt, prepend_bos, max_layer
+        _, str_tokens, cache = await self._tokenize_and_get_cache(
+            request.prompt, prepend_bos, get_forward_plan(request.selected_sources)
         )
+        return self._process_cache(request, str_tokens, cache)
+
+    @torch.no_grad()
+    def _process_cache(
+        self,
+        request: ActivationAllPostRequest,
+        str_tokens: list[str],
+        cache: ActivationCache,
+    ) -> ActivationAllPost200Response:
         # ensure sort_by_token_indexes doesn't have any out of range indexes
         # TODO: return a better error for this (currently returns a 500 error)
         for token_index in request.sort_by_token_indexes:
@@ -153,8 +148,8 @@ class ActivationProcessor:
             counts=table_counts.tolist(),
         )
 
-    def _tokenize_and_get_cache(
-        self, text: str, prepend_bos: bool, max_layer: int | None = None
+    async def _tokenize_and_get_cache(
+        self, text: str, prepend_bos: bool, forward_plan: ForwardPlan
     ) -> tuple[torch.Tensor, list[str], ActivationCache]:
         """Process input text and return tokens, string tokens, and cache."""
         model = Model.get_instance()
@@ -167,11 +162,11 @@ class ActivationProcessor:
 
         str_tokens = model.to_str_tokens(text, prepend_bos=prepend_bos)
 
-        with torch.no_grad():
-            if max_layer:
-                _, cache = model.run_with_cache(tokens, stop_at_layer=max_layer)
-            else:
-                _, cache = model.run_with_cache(tokens)
+        cache = await ForwardBatcher.get_instance().run_with_cache(
+            tokens,
+            stop_at_layer=forward_plan.stop_at_layer,
+            names_filter=forward_plan.hook_names,
+        )
         return tokens, str_tokens, cache  # type: ignore
 
     def _process_sources(
@@ -182,11 +177,29 @@ class ActivationProcessor:
         """Process activations for each selected layer."""
         sae_manager = SAEManager.get_instance()
         source_activations = []
-        for selected_source in request.selected_sources:
+        for i, selected_source in enumerate(request.selected_sources):
+            # keep loading the SAEs after this one while it's being encoded. This one
+            # is included, so that its prefetch (if it's still running) isn't dropped.
+            sae_manager.prefetch_saes(request.selected_sources[i:])
             layer_num = self._get_layer_num(selected_source)
             hook_name = sae_manager.get_sae_hook(selected_source)
             sae_type = sae_manager.get_sae_type(selected_source)
 
+            # stream the SAE's activations instead of encoding to a dense [d_sae, T]
+            # matrix. The feature filter still zeroes out a dense matrix.
+            if sae_type != "neurons" and not request.feature_filter:
+                # the SAE is on its layer's device, where its activations already are
+                sae_device = sae_manager.get_sae_device(selected_source)
+                source_activations.append(
+                    self._stream_source_activations(
+                        selected_source,
+                        cache[hook_name].to(sae_device),
+                        layer_num,
+                        request.sort_by_token_indexes,
+                    )
+                )
+                continue
+
             activations_by_index = self._get_activations_by_index(
                 sae_type, selected_source, cache, hook_name
             )
@@ -221,9 +234,12 @@ class ActivationProcessor:
             mlp_activation_data = cache[hook_name].to(Config.get_instance().device)
             return torch.transpose(mlp_activation_data[0], 0, 1)
 
-        activation_data = cache[hook_name].to(Config.get_instance().device)
-        feature_activation_data = (
-            SAEManager.get_instance().get_sae(selected_source).encode(activation_data)
+        sae_manager = SAEManager.get_instance()
+        activation_data = cache[hook_name].to(
+            sae_manager.get_sae_device(selected_source)
+        )
+        feature_activation_data = sae_manager.get_sae(selected_source).encode(
+            activation_data
         )
         return torch.transpose(feature_activation_data.squeeze(0), 0, 1)
 
@@ -255,45 +271,114 @@ class ActivationProcessor:
             "max_values": max_values,
             "max_indices": max_indices,
             "sum_values": sum_values,
-            "activations": activations_by_index,
+            "nonzero_counts": (activations_by_index > 0).sum(dim=0),
+            "get_activations": lambda rows: activations_by_index[rows],
         }
 
-    def _sort_and_filter_results(
+    def _stream_source_activations(
         self,
-        source_activations: list[dict[str, Any]],
-        request: ActivationAllPostRequest,
-    ) -> list[list[float]]:
-        """Sort and filter activations based on request parameters."""
+        source: str,
+        activation_data: torch.Tensor,
+        layer_num: int,
+        sort_by_token_indexes: list[int],
+    ) -> dict[str, Any]:
+        """Process activations for a single layer, without the dense activations.
+
+        The statistics are accumulated over chunks of the SAE's features, and the full
+        activations are only re-encoded for the features that make it into the results.
+        The SAE is looked up again for that, since loading the later sources may have
+        moved it off its device (or evicted it) in the meantime.
+        """
         device = Config.get_instance().device
-        all_activations = torch.cat(
-            [
-                torch.cat(
-                    (
-                        source["layer_num"].unsqueeze(1).to(device),
-                        source["indices"].unsqueeze(1).to(device),
-                        source["max_values"].unsqueeze(1).to(torch.float32).to(device),
-                        source["max_indices"].unsqueeze(1).to(device),
-                        source["sum_values"].unsqueeze(1).to(torch.float32).to(device),
-                        source["activations"].to(torch.float32).to(device),
-                    ),
-                    dim=1,
-                )
-                for source in source_activations
-            ],
-            dim=0,
+        sae_manager = SAEManager.get_instance()
+        stats = SaeLensSAE.encode_stats(
+            sae_manager.get_sae(source), activation_data, sort_by_token_indexes
         )
+        max_values = stats["max_values"].squeeze(0)
 
-        if request.sort_by_token_indexes:
-            _, sorted_indices = torch.sort(all_activations[:, 4], descending=True)
-        else:
-            _, sorted_indices = torch.sort(all_activations[:, 2], descending=True)
-
-        sorted_activations = all_activations[sorted_indices]
+        return {
+            "layer_num": torch.full(max_values.shape, layer_num).to(device),
+            "indices": torch.arange(0, max_values.size(0)).to(device),
+            "max_values": max_values,
+            "max_indices": stats["max_indices"].squeeze(0),
+            "sum_values": stats["sum_values"].squeeze(0),
+            "nonzero_counts": stats["nonzero_counts"].squeeze(0),
+            "get_activations": lambda rows: SaeLensSAE.encode_features(
+                sae_manager.get_sae(source), activation_data, rows
+            )
+            .squeeze(0)
+            .T,
+        }
 
-        if request.ignore_bos and Model.get_instance().cfg.default_prepend_bos:
-            sorted_activations = sorted_activations[sorted_activations[:, 3] != 0]
+    def _sort_and_filter_results(
+        self,
+        source_activations: list[dict[str, Any]],
+        request: ActivationAllPostRequest,
+    ) -> list[list[float]]:
+        """Sort and filter activations based on request parameters.
 
-        return sorted_activations[: request.num_results].tolist()
+        Only the top `num_results` features of each source can make it into the results,
+        so we select those per source with topk, merge them, and only gather the full
+        activation rows of the winners instead of concatenating and sorting every row.
+        """
+        device = Config.get_instance().device
+        score_key = "sum_values" if request.sort_by_token_indexes else "max_values"
+        ignore_bos = request.ignore_bos and Model.get_instance().cfg.default_prepend_bos
+
+        candidate_scores: list[torch.Tensor] = []
+        candidate_sources: list[torch.Tensor] = []
+        candidate_rows: list[torch.Tensor] = []
+        for source_num, source in enumerate(source_activations):
+            scores = source[score_key].to(torch.float32).to(device)
+            rows = torch.arange(scores.shape[0], device=device)
+            if ignore_bos:
+                not_bos = source["max_indices"].to(device) != 0
+                scores, rows = scores[not_bos], rows[not_bos]
+
+            k = scores.shape[0]
+            if request.num_results is not None:
+                k = min(request.num_results, k)
+            top_scores, top_positions = torch.topk(scores, k)
+            candidate_scores.append(top_scores)
+            candidate_sources.append(torch.full_like(top_positions, source_num))
+            candidate_rows.append(rows[top_positions])
+
+        all_scores = torch.cat(candidate_scores)
+        k = all_scores.shape[0]
+        if request.num_results is not None:
+            k = min(request.num_results, k)
+        _, winners = torch.topk(all_scores, k)
+        winner_sources = torch.cat(candidate_sources)[winners].tolist()
+        winner_rows = torch.cat(candidate_rows)[winners].tolist()
+
+        # gather the full activations of each source's winners at once
+        winner_activations: dict[tuple[int, int], list[float]] = {}
+        for source_num in set(winner_sources):
+            rows = [
+                row
+                for winner_source, row in zip(winner_sources, winner_rows)
+                if winner_source == source_num
+            ]
+            activations = source_activations[source_num]["get_activations"](rows)
+            for row, row_activations in zip(
+                rows, activations.to(torch.float32).tolist()
+            ):
+                winner_activations[(source_num, row)] = row_activations
+
+        sorted_activations: list[list[float]] = []
+        for source_num, row in zip(winner_sources, winner_rows):
+            source = source_activations[source_num]
+            sorted_activations.append(
+                [
+                    float(source["layer_num"][row]),
+                    float(source["indices"][row]),
+                    float(source["max_values"][row]),
+                    float(source["max_indices"][row]),
+                    float(source["sum_values"][row]),
+                    *winner_activations[(source_num, row)],
+                ]
+            )
+        return sorted_activations
 
     def _format_result_and_calculate_dfa(
         self,
@@ -304,6 +389,10 @@ class ActivationProcessor:
         """Format results and if needed, calculate DFA values for sorted activations."""
 
         feature_activations: list[ActivationAllPost200ResponseActivationsInner] = []
+        # results that need DFA, grouped by layer so that each layer is computed once
+        dfa_results_by_layer: dict[
+            int, list[ActivationAllPost200ResponseActivationsInner]
+        ] = {}
         for result in sorted_activations:
             source = (
                 f"{int(result[0])}-{request.source_set}"
@@ -324,90 +413,46 @@ class ActivationProcessor:
                 max_value_index=max_value_index,
             )
             if SAEManager.get_instance().is_dfa_enabled(source):
-                dfa_values = self._calculate_dfa_values(
-                    cache,
-                    int(result[0]),
-                    feature_index,
-                    max_value_index,
-                    request.source_set,
+                dfa_results_by_layer.setdefault(int(result[0]), []).append(
+                    feature_activation
                 )
-                feature_activation.dfa_values = dfa_values[0].tolist()
-                feature_activation.dfa_target_index = max_value_index
-                feature_activation.dfa_max_value = max(dfa_values[0].tolist())
 
             feature_activations.append(feature_activation)
 
+        for layer_num, dfa_results in dfa_results_by_layer.items():
+            dfa_values = self._calculate_dfa_values(
+                cache,
+                layer_num,
+                [result.index for result in dfa_results],
+                [result.max_value_index for result in dfa_results],
+                request.source_set,
+            ).tolist()
+            for feature_activation, feature_dfa_values in zip(dfa_results, dfa_values):
+                feature_activation.dfa_values = feature_dfa_values
+                feature_activation.dfa_target_index = feature_activation.max_value_index
+                feature_activation.dfa_max_value = max(feature_dfa_values)
+
         return feature_activations
 
     def _calculate_dfa_values(
         self,
         cache: ActivationCache,
         layer_num: int,
-        idx: int,
-        max_value_index: int,
+        indices: list[int],
+        max_value_indices: list[int],
         source_set: str,
     ) -> torch.Tensor:
-        """Calculate DFA values for a specific feature, supporting both standard and GQA models."""
-        model = Model.get_instance()
-        encoder = SAEManager.get_instance().get_sae(f"{layer_num}-{source_set}")
-        v = cache["v", layer_num]
-        attn_weights = cache["pattern", layer_num]
-
-        # Determine the safe dtype for operations
-        v_dtype = _get_safe_dtype(v.dtype)
-        attn_weights_dtype = _get_safe_dtype(attn_weights.dtype)
-        encoder_dtype = _get_safe_dtype(encoder.W_enc.dtype)
-
-        # Use the highest precision dtype
-        op_dtype = max(
-            v_dtype,
-            attn_weights_dtype,
-            encoder_dtype,
-            key=lambda x: x.itemsize,
-        )
-
-        # Check if the model uses GQA
-        use_gqa = (
-            hasattr(model.cfg, "n_key_value_heads")
-            and model.cfg.n_key_value_heads is not None
-            and model.cfg.n_key_value_heads < model.cfg.n_heads
-        )
-
-        if use_gqa:
-            n_query_heads = attn_weights.shape[1]
-            n_kv_heads = v.shape[2]
-            expansion_factor = n_query_heads // n_kv_heads
-            v = v.repeat_interleave(expansion_factor, dim=2)
+        """Calculate DFA values for several features of the same layer in one batch.
 
-        # Cast tensors to operation dtype
-        v = _safe_cast(v, op_dtype)
-        attn_weights = _safe_cast(attn_weights, op_dtype)
-
-        v_cat = einops.rearrange(
-            v, "batch src_pos n_heads d_head -> batch src_pos (n_heads d_head)"
-        )
-
-        attn_weights_bcast = einops.repeat(
-            attn_weights,
-            "batch n_heads dest_pos src_pos -> batch dest_pos src_pos (n_heads d_head)",
-            d_head=model.cfg.d_head,
-        )
-
-        decomposed_z_cat = attn_weights_bcast * v_cat.unsqueeze(1)
-
-        # Cast encoder weights to operation dtype
-        W_enc = _safe_cast(encoder.W_enc[:, idx], op_dtype)
-
-        per_src_pos_dfa = einops.einsum(
-            decomposed_z_cat,
-            W_enc,
-            "batch dest_pos src_pos d_model, d_model -> batch dest_pos src_pos",
-        )
-
-        result = per_src_pos_dfa[torch.arange(1), torch.tensor([max_value_index]), :]
-
-        # Cast the result back to the original dtype of v
-        return _safe_cast(result, v.dtype)
+        Returns [n_features, src_pos]. Supports both standard and GQA models.
+        """
+        encoder = SAEManager.get_instance().get_sae(f"{layer_num}-{source_set}")
+        return calculate_batched_dfa_values(
+            cache["v", layer_num],
+            cache["pattern", layer_num],
+            encoder.W_enc[:, indices],
+            torch.tensor(max_value_indices),
+        )[0]
 
     def _calculate_table_counts(
         self,
@@ -424,8 +469,7 @@ class ActivationProcessor:
 
         for source_activation in source_activations:
             layer_num = int(source_activation["layer_num"][0])
-            activating_features = (source_activation["activations"] > 0).sum(dim=0)
-            table_counts[layer_num, :] = activating_features
+            table_counts[layer_num, :] = source_activation["nonzero_counts"]
 
         return table_counts
 
@@ -1,7 +1,6 @@
 import logging
 from typing import Any
 
-import einops
 import torch
 from fastapi import APIRouter, Body
 from fastapi.responses import JSONResponse
@@ -17,16 +16,23 @@ from neuronpedia_inference_client.models.activation_single_post_request import (
 from transformer_lens import ActivationCache, HookedTransformer
 
 from neuronpedia_inference.config import Config
+from neuronpedia_inference.inference_utils.dfa import calculate_dfa_values
+from neuronpedia_inference.inference_utils.forward_batcher import ForwardBatcher
+from neuronpedia_inference.inference_utils.forward_plan import (
+    ForwardPlan,
+    get_forward_plan,
+)
 from neuronpedia_inference.sae_manager import SAEManager
-from neuronpedia_inference.shared import Model, with_request_lock
+from neuronpedia_inference.shared import Model
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
 
+# no request lock here - the forward pass takes the lock in the ForwardBatcher, so that
+# concurrent requests can be batched together
 @router.post("/activation/single")
-@with_request_lock()
 async def activation_single(
     request: ActivationSinglePostRequest = Body(
         ...,
@@ -88,17 +94,26 @@ async def activation_single(
             )
 
         str_tokens: list[str] = model.to_str_tokens(prompt, prepend_bos=prepend_bos)  # type: ignore
-        result = process_activations(model, source, index, tokens)
+
+        # a single forward pass caches both the SAE's hook and, for DFA-enabled
+        # sources, the attention values and pattern that DFA needs
+        forward_plan = get_forward_plan([source])
+        cache = await ForwardBatcher.get_instance().run_with_cache(
+            tokens,
+            stop_at_layer=forward_plan.stop_at_layer,
+            names_filter=forward_plan.hook_names,
+        )
+        result = process_activations(model, source, index, cache)
 
         # Calculate DFA if enabled
         if sae_manager.is_dfa_enabled(source):
             dfa_result = calculate_dfa(
                 model,
-                sae,
+                sae_manager.get_sae(source),
                 layer_num,
                 index,
                 result.max_value_index,
-                tokens,
+                cache,
             )
             result.dfa_values = dfa_result["dfa_values"]  # type: ignore
             result.dfa_target_index = dfa_result["dfa_target_index"]  # type: ignore
@@ -127,7 +142,12 @@ async def activation_single(
             )
 
         str_tokens: list[str] = model.to_str_tokens(prompt, prepend_bos=prepend_bos)  # type: ignore
-        _, cache = model.run_with_cache(tokens)
+        forward_plan = ForwardPlan.for_hooks({hook})  # type: ignore
+        cache = await ForwardBatcher.get_instance().run_with_cache(
+            tokens,
+            stop_at_layer=forward_plan.stop_at_layer,
+            names_filter=forward_plan.hook_names,
+        )
         result = process_vector_activations(vector, cache, hook, sae_manager.device)  # type: ignore
 
     logger.info("Returning result: %s", result)
@@ -135,33 +155,18 @@ async def activation_single(
     return ActivationSinglePost200Response(activation=result, tokens=str_tokens)
 
 
-def _get_safe_dtype(dtype: torch.dtype) -> torch.dtype:
-    """
-    Convert float16 to float32, leave other dtypes unchanged.
-    """
-    return torch.float32 if dtype == torch.float16 else dtype
-
-
-def _safe_cast(tensor: torch.Tensor, target_dtype: torch.dtype) -> torch.Tensor:
-    """
-    Safely cast a tensor to the target dtype, creating a copy if needed.
-    Convert float16 to float32, leave other dtypes unchanged.
-    """
-    safe_dtype = _get_safe_dtype(tensor.dtype)
-    if safe_dtype != tensor.dtype or safe_dtype != target_dtype:
-        return tensor.to(target_dtype)
-    return tensor
-
-
 def get_layer_num_from_sae_id(sae_id: str) -> int:
     return int(sae_id.split("-")[0]) if not sae_id.isdigit() else int(sae_id)
 
 
+@torch.no_grad()
 def process_activations(
-    model: HookedTransformer, layer: str, index: int, tokens: torch.Tensor
+    model: HookedTransformer,  # noqa: ARG001
+    layer: str,
+    index: int,
+    cache: ActivationCache,
 ) -> ActivationSinglePost200ResponseActivation:
     sae_manager = SAEManager.get_instance()
-    _, cache = model.run_with_cache(tokens)
     hook_name = sae_manager.get_sae_hook(layer)
     sae_type = sae_manager.get_sae_type(layer)
 
@@ -246,63 +251,21 @@ def process_vector_activations(
     )
 
 
+@torch.no_grad()
 def calculate_dfa(
-    model: HookedTransformer,
+    model: HookedTransformer,  # noqa: ARG001
     sae: Any,
     layer_num: int,
     index: int,
     max_value_index: int,
-    tokens: torch.Tensor,
+    cache: ActivationCache,
 ) -> dict[str, list[float] | int | float]:
-    _, cache = model.run_with_cache(tokens)
-    v = cache["v", layer_num]  # [batch, src_pos, n_heads, d_head]
-    attn_weights = cache["pattern", layer_num]  # [batch, n_heads, dest_pos, src_pos]
-
-    # Determine the safe dtype for operations
-    v_dtype = _get_safe_dtype(v.dtype)
-    attn_weights_dtype = _get_safe_dtype(attn_weights.dtype)
-    sae_dtype = _get_safe_dtype(sae.W_enc.dtype)
-
-    # Use the highest precision dtype
-    op_dtype = max(v_dtype, attn_weights_dtype, sae_dtype, key=lambda x: x.itemsize)
-
-    # Check if the model uses GQA
-    use_gqa = (
-        hasattr(model.cfg, "n_key_value_heads")
-        and model.cfg.n_key_value_heads is not None
-        and model.cfg.n_key_value_heads < model.cfg.n_heads
-    )
-
-    if use_gqa:
-        n_query_heads = attn_weights.shape[1]
-        n_kv_heads = v.shape[2]
-        expansion_factor = n_query_heads // n_kv_heads
-        v = v.repeat_interleave(expansion_factor, dim=2)
-
-    # Cast tensors to operation dtype
-    v = _safe_cast(v, op_dtype)
-    attn_weights = _safe_cast(attn_weights, op_dtype)
-
-    v_cat = einops.rearrange(
-        v, "batch src_pos n_heads d_head -> batch src_pos (n_heads d_head)"
-    )
-    attn_weights_bcast = einops.repeat(
-        attn_weights,
-        "batch n_heads dest_pos src_pos -> batch dest_pos src_pos (n_heads d_head)",
-        d_head=model.cfg.d_head,
-    )
-    decomposed_z_cat = attn_weights_bcast * v_cat.unsqueeze(1)
-
-    # Cast SAE weights to operation dtype
-    W_enc = _safe_cast(sae.W_enc[:, index], op_dtype)
-
-    per_src_pos_dfa = einops.einsum(
-        decomposed_z_cat,
-        W_enc,
-        "batch dest_pos src_pos d_model, d_model -> batch dest_pos src_pos",
-    )
-    per_src_dfa = per_src_pos_dfa[torch.arange(1), torch.tensor([max_value_index]), :]
-    dfa_values = per_src_dfa[0].tolist()
+    dfa_values = calculate_dfa_values(
+        cache["v", layer_num],  # [batch, src_pos, n_heads, d_head]
+        cache["pattern", layer_num],  # [batch, n_heads, dest_pos, src_pos]
+        sae.W_enc[:, index],
+        max_value_index,
+    )[0].tolist()
     return {
         "dfa_values": dfa_values,
         "dfa_target_index": max_value_index,
@@ -18,8 +18,11 @@ from neuronpedia_inference_client.models.activation_topk_by_token_post_request i
 from transformer_lens import ActivationCache
 
 from neuronpedia_inference.config import Config
+from neuronpedia_inference.inference_utils.forward_batcher import ForwardBatcher
+from neuronpedia_inference.inference_utils.forward_plan import get_forward_plan
 from neuronpedia_inference.sae_manager import SAEManager
-from neuronpedia_inference.shared import Model, with_request_lock
+from neuronpedia_inference.saes.saelens import SaeLensSAE
+from neuronpedia_inference.shared import Model, request_lock
 
 logger = logging.getLogger(__name__)
 
@@ -28,8 +31,9 @@ DEFAULT_TOP_K = 5
 router = APIRouter()
 
 
+# no request lock here - the forward pass takes the lock in the ForwardBatcher, so that
+# concurrent requests can be batched together
 @router.post("/activation/topk-by-token")
-@with_request_lock()
 async def activation_topk_by_token(
     request: ActivationTopkByTokenPostRequest,
 ):
@@ -68,34 +72,26 @@ async def activation_topk_by_token(
 
     str_tokens = model.to_str_tokens(prompt, prepend_bos=prepend_bos)
 
-    # Extract layer number from source (e.g., "20-gemmascope-res-131k" -> 20)
-    layer_num = None
-    if config.optimize_memory:
-        try:
-            layer_num = int(source.split('-')[0])
-        except (ValueError, IndexError):
-            layer_num = None
-
-    # Run with optimizations if enabled
-    if config.optimize_memory and layer_num is not None:
-        with torch.no_grad():
-            _, cache = model.run_with_cache(tokens, stop_at_layer=layer_num + 1)
-    else:
-        _, cache = model.run_with_cache(tokens)
+    # Only cache the SAE's hook, and stop after the block it's in
+    forward_plan = get_forward_plan([source], include_dfa=False)
+    cache = await ForwardBatcher.get_instance().run_with_cache(
+        tokens,
+        stop_at_layer=forward_plan.stop_at_layer,
+        names_filter=forward_plan.hook_names,
+    )
 
     hook_name = sae_manager.get_sae_hook(source)
     sae_type = sae_manager.get_sae_type(source)
 
-    activations_by_index = get_activations_by_index(
+    # Get top k activations for each token
+    top_k_values, top_k_indices = get_top_k_by_token(
         sae_type,
         source,
         cache,
         hook_name,
+        top_k,
     )
 
-    # Get top k activations for each token
-    top_k_values, top_k_indices = torch.topk(activations_by_index.T, k=top_k)
-
     # if we are ignoring BOS and the model prepends BOS, we shift everything over by one
     if ignore_bos and prepend_bos:
         str_tokens = str_tokens[1:]
@@ -152,35 +148,39 @@ async def activation_topk_by_token(
     if should_clear:
         # Clear all tensor references
         del cache
-        del activations_by_index
         del top_k_values
         del top_k_indices
 
         # Clear model's internal hooks and contexts
-        model.reset_hooks(clear_contexts=True, including_permanent=False)
-        model.clear_contexts()
-
-        # Force GPU memory cleanup
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
+        # (under the request lock, so we don't pull hooks out from under a running generation)
+        async with request_lock:
+            model.reset_hooks(clear_contexts=True, including_permanent=False)
+            model.clear_contexts()
+
+            # Force GPU memory cleanup
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
         logger.info("Cleared GPU cache and model hooks after processing request")
 
     return response
 
 
-# Keep the get_activations_by_index function from the original code
-def get_activations_by_index(
+def get_top_k_by_token(
     sae_type: str,
     selected_layer: str,
     cache: ActivationCache | dict[str, torch.Tensor],
     hook_name: str,
-) -> torch.Tensor:
+    top_k: int,
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """Get the top k (values, indices) of every token, both [T, top_k]."""
     if sae_type == "neurons":
         mlp_activation_data = cache[hook_name].to(Config.get_instance().device)
-        return torch.transpose(mlp_activation_data[0], 0, 1)
+        return torch.topk(mlp_activation_data[0], k=top_k)
 
-    activation_data = cache[hook_name].to(Config.get_instance().device)
-    feature_activation_data = (
-        SAEManager.get_instance().get_sae(selected_layer).encode(activation_data)
+    # encode sparsely, so that we never hold the dense [T, d_sae] activations
+    sae_manager = SAEManager.get_instance()
+    activation_data = cache[hook_name].to(sae_manager.get_sae_device(selected_layer))
+    top_k_values, top_k_indices = SaeLensSAE.encode_topk(
+        sae_manager.get_sae(selected_layer), activation_data, top_k
     )
-    return torch.transpose(feature_activation_data.squeeze(0), 0, 1)
+    return top_k_values.squeeze(0), top_k_indices.squeeze(0)
@@ -1,7 +1,6 @@
 import logging
 from typing import Any
 
-import torch
 from fastapi import APIRouter
 from fastapi.responses import JSONResponse, StreamingResponse
 from neuronpedia_inference_client.models.np_logprob import NPLogprob
@@ -20,14 +19,16 @@ from neuronpedia_inference_client.models.steer_completion_request import (
 )
 
 from neuronpedia_inference.config import Config
+from neuronpedia_inference.inference_utils.generation import BatchedGeneration
+from neuronpedia_inference.inference_utils.prompt_kv_cache import PromptKVCache
 from neuronpedia_inference.inference_utils.steering import (
-    OrthogonalProjector,
+    SteeringPlan,
     format_sse_message,
+    get_row,
     process_features_vectorized,
     remove_sse_formatting,
     stream_lock,
 )
-from neuronpedia_inference.sae_manager import SAEManager
 from neuronpedia_inference.shared import Model, with_request_lock
 from neuronpedia_inference.utils import make_logprob_from_logits
 
@@ -35,8 +36,6 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
-TOKENS_PER_YIELD = 1
-
 
 @router.post("/steer/completion")
 @with_request_lock()
@@ -150,189 +149,73 @@ async def run_batched_generate(
 ):
     async with await stream_lock(use_stream_lock):
         model = Model.get_instance()
-        sae_manager = SAEManager.get_instance()
 
         # Add device logging
         logger.info(f"Model device: {model.cfg.device}")
 
-        if seed is not None:
-            torch.manual_seed(seed)
-
-        def steering_hook(activations: torch.Tensor, hook: Any) -> torch.Tensor:  # noqa: ARG001
-            # Log activation device
-            logger.info(f"Activations device: {activations.device}")
-
-            for i, flag in enumerate(steer_types):
-                if flag == NPSteerType.STEERED:
-                    for feature in features:
-                        steering_vector = torch.tensor(feature.steering_vector).to(
-                            activations.device
-                        )
-                        logger.info(f"Steering vector device: {steering_vector.device}")
-
-                        if not torch.isfinite(steering_vector).all():
-                            raise ValueError(
-                                "Steering vector contains inf or nan values"
-                            )
-
-                        if normalize_steering:
-                            norm = torch.norm(steering_vector)
-                            if norm == 0:
-                                raise ValueError("Zero norm steering vector")
-                            steering_vector = steering_vector / norm
-
-                        # If it's attention hook, reshape it to (n_heads, head_dim)
-                        # get n_heads from the transformerlens model
-                        if isinstance(
-                            feature, NPSteerFeature
-                        ) and "attn.hook_z" in sae_manager.get_sae_hook(feature.source):
-                            n_heads = model.cfg.n_heads
-                            d_head = model.cfg.d_head
-                            steering_vector = steering_vector.view(n_heads, d_head)
-
-                        coeff = strength_multiplier * feature.strength
-
-                        if steer_method == NPSteerMethod.SIMPLE_ADDITIVE:
-                            activations[i] += coeff * steering_vector
-
-                        elif steer_method == NPSteerMethod.ORTHOGONAL_DECOMP:
-                            projector = OrthogonalProjector(steering_vector)
-                            activations[i] = projector.project(activations[i], coeff)
-            return activations
-
-        # Check if we need to generate both STEERED and DEFAULT
-        generate_both = (
-            NPSteerType.STEERED in steer_types and NPSteerType.DEFAULT in steer_types
+        steering_plan = SteeringPlan.compile(
+            features,
+            steer_types,
+            strength_multiplier,
+            steer_method,
+            normalize_steering,
+            model.cfg,
         )
 
         tokenized = model.to_tokens(prompt)[0]
-        logger.info(f"Tokenized input device: {tokenized.device}")
-
-        if generate_both:
-            steered_partial_result = ""
-            default_partial_result = ""
-            steered_logprobs = None
-            default_logprobs = None
-
-            # Generate STEERED and DEFAULT separately
-            for flag in [NPSteerType.STEERED, NPSteerType.DEFAULT]:
-                if seed is not None:
-                    torch.manual_seed(seed)  # Reset seed for each generation
-
-                model.reset_hooks()
-                if flag == NPSteerType.STEERED:
-                    editing_hooks = [
-                        (
-                            (
-                                sae_manager.get_sae_hook(feature.source)
-                                if isinstance(feature, NPSteerFeature)
-                                else feature.hook
-                            ),
-                            steering_hook,
-                        )
-                        for feature in features
-                    ]
-                else:
-                    editing_hooks = []
 
-                logprobs = []
-
-                with model.hooks(fwd_hooks=editing_hooks):  # type: ignore
-                    for i, (result, logits) in enumerate(
-                        model.generate_stream(
-                            stop_at_eos=(model.cfg.device != "mps"),
-                            input=tokenized.unsqueeze(0),
-                            do_sample=True,
-                            max_tokens_per_yield=TOKENS_PER_YIELD,
-                            return_logits=True,
-                            **kwargs,
-                        )
-                    ):
-                        to_append = ""
-                        if i == 0:
-                            to_append = model.to_string(result[0][1:])  # type: ignore
-                        else:
-                            to_append = model.to_string(result[0])  # type: ignore
+        # one batch row per requested type, so STEERED and DEFAULT generate together
+        generation = BatchedGeneration(
+            model,
+            tokenized,
+            n_rows=len(steer_types),
+            seed=seed,
+            stop_at_eos=(model.cfg.device != "mps"),
+            # the prompt only goes through the unsteered layers once
+            shared_layers=steering_plan.get_first_layer(),
+            # the prompt's keys and values can only be reused with the same steering
+            prompt_cache=PromptKVCache.get_instance(),
+            prompt_cache_key=f"completion {steering_plan.get_key()} {model.cfg.device}",
+            **kwargs,
+        )
 
-                        if n_logprobs > 0:
-                            current_logprobs = make_logprob_from_logits(
-                                result,  # type: ignore
-                                logits,  # type: ignore
+        model.reset_hooks()
+        editing_hooks = []
+        if NPSteerType.STEERED in steer_types:
+            editing_hooks = steering_plan.get_fwd_hooks()
+
+        # each output starts with the prompt, without its BOS
+        prompt_string = model.to_string(tokenized[1:])
+        results = [prompt_string for _ in steer_types]
+        logprobs: list[list[NPLogprob]] = [[] for _ in steer_types]
+
+        with model.hooks(fwd_hooks=editing_hooks):  # type: ignore
+            for new_tokens, logits, active in generation.stream():
+                for row in range(len(steer_types)):
+                    if not active[row]:
+                        continue
+                    token = new_tokens[row : row + 1]
+                    results[row] += model.to_string(token)  # type: ignore
+                    if n_logprobs > 0:
+                        logprobs[row].append(
+                            make_logprob_from_logits(
+                                new_tokens[row].view(1, 1),
+                                logits[row].view(1, 1, -1),
                                 model,
                                 n_logprobs,
                             )
-                            logprobs.append(current_logprobs)
-
-                        if flag == NPSteerType.STEERED:
-                            steered_partial_result += to_append  # type: ignore
-                            steered_logprobs = logprobs.copy() or None
-                        else:
-                            default_partial_result += to_append  # type: ignore
-                            default_logprobs = logprobs.copy() or None
-
-                        to_return = make_steer_completion_response(
-                            steer_types,
-                            steered_partial_result,
-                            default_partial_result,
-                            steered_logprobs,
-                            default_logprobs,
-                        )  # type: ignore
-                        yield format_sse_message(to_return.to_json())
-
-        else:
-            steer_type = steer_types[0]
-            if seed is not None:
-                torch.manual_seed(seed)
-
-            model.reset_hooks()
-            editing_hooks = [
-                (
-                    (
-                        sae_manager.get_sae_hook(feature.source)
-                        if isinstance(feature, NPSteerFeature)
-                        else feature.hook
-                    ),
-                    steering_hook,
-                )
-                for feature in features
-            ]
-
-            with model.hooks(fwd_hooks=editing_hooks):  # type: ignore
-                partial_result = ""
-                logprobs = []
-
-                for i, (result, logits) in enumerate(
-                    model.generate_stream(
-                        stop_at_eos=(model.cfg.device != "mps"),
-                        input=tokenized.unsqueeze(0),
-                        do_sample=True,
-                        max_tokens_per_yield=TOKENS_PER_YIELD,
-                        return_logits=True,
-                        **kwargs,
-                    )
-                ):
-                    if i == 0:
-                        partial_result = model.to_string(result[0][1:])  # type: ignore
-                    else:
-                        partial_result += model.to_string(result[0])  # type: ignore
-
-                    if n_logprobs > 0:
-                        current_logprobs = make_logprob_from_logits(
-                            result,  # type: ignore
-                            logits,  # type: ignore
-                            model,
-                            n_logprobs,
                         )
-                        logprobs.append(current_logprobs)
 
-                    to_return = make_steer_completion_response(
-                        [steer_type],
-                        partial_result,  # type: ignore
-                        partial_result,  # type: ignore
-                        logprobs or None,
-                        logprobs or None,
-                    )
-                    yield format_sse_message(to_return.to_json())
+                steered_row = get_row(steer_types, NPSteerType.STEERED)
+                default_row = get_row(steer_types, NPSteerType.DEFAULT)
+                to_return = make_steer_completion_response(
+                    steer_types,
+                    results[steered_row],
+                    results[default_row],
+                    logprobs[steered_row] or None,
+                    logprobs[default_row] or None,
+                )
+                yield format_sse_message(to_return.to_json())
 
 
 def make_steer_completion_response(
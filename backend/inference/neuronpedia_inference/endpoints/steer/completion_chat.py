@@ -20,16 +20,18 @@ from neuronpedia_inference_client.models.steer_completion_chat_post_request impo
 from transformer_lens import HookedTransformer
 
 from neuronpedia_inference.config import Config
+from neuronpedia_inference.inference_utils.generation import BatchedGeneration
+from neuronpedia_inference.inference_utils.prompt_kv_cache import PromptKVCache
 from neuronpedia_inference.inference_utils.steering import (
-    OrthogonalProjector,
+    SteeringPlan,
     apply_generic_chat_template,
     convert_to_chat_array,
     format_sse_message,
+    get_row,
     process_features_vectorized,
     remove_sse_formatting,
     stream_lock,
 )
-from neuronpedia_inference.sae_manager import SAEManager
 from neuronpedia_inference.shared import Model, with_request_lock
 from neuronpedia_inference.utils import make_logprob_from_logits
 
@@ -38,8 +40,6 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
-TOKENS_PER_YIELD = 1
-
 
 @router.post("/steer/completion-chat")
 @with_request_lock()
@@ -180,244 +180,137 @@ async def run_batched_generate(
 ):
     async with await stream_lock(use_stream_lock):
         model = Model.get_instance()
-        sae_manager = SAEManager.get_instance()
 
         # Add device logging
         # logger.info(f"Model device: {model.cfg.device}")
         # logger.info(f"Input tensor device: {promptTokenized.device}")
 
-        if seed is not None:
-            torch.manual_seed(seed)
-
-        def steering_hook(activations: torch.Tensor, hook: Any) -> torch.Tensor:  # noqa: ARG001
-            # log activation device
-            # logger.info(f"Activations device: {activations.device}")
-
-            for i, flag in enumerate(steer_types):
-                if flag == NPSteerType.STEERED:
-                    if model.tokenizer is None:
-                        raise ValueError("Tokenizer is not initialized")
-
-                    # If we want to steer special tokens, then just pass it through without masking
-                    if steer_special_tokens:
-                        mask = torch.ones(
-                            activations.shape[1], device=activations.device
-                        )
-                    else:
-                        # TODO: Need to generalize beyond the gemma tokenizer
-
-                        # Get the current tokens for this batch
-                        current_tokens = promptTokenized.to(activations.device)
-
-                        mask = torch.ones(
-                            activations.shape[1], device=activations.device
-                        )
-
-                        # Find indices of special tokens
-
-                        bos_indices = (
-                            current_tokens == model.tokenizer.bos_token_id
-                        ).nonzero(as_tuple=True)[0]  # type: ignore
-                        start_of_turn_indices = (
-                            current_tokens
-                            == model.tokenizer.encode("<start_of_turn>")[0]
-                        ).nonzero(as_tuple=True)[0]
-                        end_of_turn_indices = (
-                            current_tokens == model.tokenizer.encode("<end_of_turn>")[0]
-                        ).nonzero(as_tuple=True)[0]
-
-                        # Apply masking rules
-                        # 1. Don't steer <bos>
-                        mask[bos_indices] = 0
-
-                        # 2. Don't steer <start_of_turn> and the next two tokens
-                        for idx in start_of_turn_indices:
-                            mask[idx : idx + 3] = 0
-
-                        # 3. Don't steer <end_of_turn> and the next token
-                        for idx in end_of_turn_indices:
-                            mask[idx : idx + 2] = 0
-                    # Apply steering with the mask
-                    for feature in features:
-                        steering_vector = torch.tensor(feature.steering_vector).to(
-                            activations.device
-                        )
-
-                        if not torch.isfinite(steering_vector).all():
-                            raise ValueError(
-                                "Steering vector contains inf or nan values"
-                            )
-
-                        if normalize_steering:
-                            norm = torch.norm(steering_vector)
-                            if norm == 0:
-                                raise ValueError("Zero norm steering vector")
-                            steering_vector = steering_vector / norm
-
-                        # If it's attention hook, reshape it to (n_heads, head_dim)
-                        if isinstance(
-                            feature, NPSteerFeature
-                        ) and "attn.hook_z" in sae_manager.get_sae_hook(feature.source):
-                            n_heads = model.cfg.n_heads
-                            d_head = model.cfg.d_head
-                            steering_vector = steering_vector.view(n_heads, d_head)
-
-                        coeff = strength_multiplier * feature.strength
-
-                        if steer_method == NPSteerMethod.SIMPLE_ADDITIVE:
-                            activations[i] += (
-                                coeff * steering_vector * mask.unsqueeze(-1)
-                            )
-
-                        elif steer_method == NPSteerMethod.ORTHOGONAL_DECOMP:
-                            projector = OrthogonalProjector(steering_vector)
-                            projected = projector.project(activations[i], coeff)
-                            activations[i] = activations[i] * (
-                                1 - mask.unsqueeze(-1)
-                            ) + projected * mask.unsqueeze(-1)
-
-            return activations
+        prompt_mask = get_prompt_mask(promptTokenized, model, steer_special_tokens)
+
+        steering_plan = SteeringPlan.compile(
+            features,
+            steer_types,
+            strength_multiplier,
+            steer_method,
+            normalize_steering,
+            model.cfg,
+            position_mask=lambda n_positions: get_position_mask(
+                prompt_mask, generation.position, n_positions
+            ),
+        )
 
-        # Check if we need to generate both STEERED and DEFAULT
-        generate_both = (
-            NPSteerType.STEERED in steer_types and NPSteerType.DEFAULT in steer_types
+        # one batch row per requested type, so STEERED and DEFAULT generate together
+        generation = BatchedGeneration(
+            model,
+            promptTokenized,
+            n_rows=len(steer_types),
+            seed=seed,
+            stop_at_eos=(model.cfg.device != "mps"),
+            # the prompt only goes through the unsteered layers once
+            shared_layers=steering_plan.get_first_layer(),
+            # the prompt's keys and values can only be reused with the same steering
+            prompt_cache=PromptKVCache.get_instance(),
+            prompt_cache_key=(
+                f"completion-chat {steer_special_tokens} "
+                f"{steering_plan.get_key()} {model.cfg.device}"
+            ),
+            **kwargs,
         )
 
-        if generate_both:
-            steered_partial_result = ""
-            default_partial_result = ""
-            steered_logprobs = None
-            default_logprobs = None
-
-            # Generate STEERED and DEFAULT separately
-            for flag in [NPSteerType.STEERED, NPSteerType.DEFAULT]:
-                if seed is not None:
-                    torch.manual_seed(seed)  # Reset seed for each generation
-
-                model.reset_hooks()
-                if flag == NPSteerType.STEERED:
-                    logger.info("Running Steered")
-                    editing_hooks = [
-                        (
-                            (
-                                sae_manager.get_sae_hook(feature.source)
-                                if isinstance(feature, NPSteerFeature)
-                                else feature.hook
-                            ),
-                            steering_hook,
-                        )
-                        for feature in features
-                    ]
-                else:
-                    logger.info("Running Default")
-                    editing_hooks = []
-
-                logprobs = []
-
-                with model.hooks(fwd_hooks=editing_hooks):  # type: ignore
-                    for i, (result, logits) in enumerate(
-                        model.generate_stream(
-                            max_tokens_per_yield=TOKENS_PER_YIELD,
-                            stop_at_eos=(model.cfg.device != "mps"),
-                            input=promptTokenized.unsqueeze(0),
-                            do_sample=True,
-                            return_logits=True,
-                            **kwargs,
-                        )
-                    ):
-                        to_append = ""
-                        if i == 0:
-                            to_append = model.to_string(result[0][1:])  # type: ignore
-                        else:
-                            to_append = model.to_string(result[0])  # type: ignore
-
-                        if n_logprobs > 0:
-                            current_logprobs = make_logprob_from_logits(
-                                result,  # type: ignore
-                                logits,  # type: ignore
+        model.reset_hooks()
+        editing_hooks = []
+        if NPSteerType.STEERED in steer_types:
+            editing_hooks = steering_plan.get_fwd_hooks()
+        logger.info("steer_types: %s", steer_types)
+
+        # each output starts with the prompt, without its BOS
+        prompt_string = model.to_string(promptTokenized[1:])
+        results = [prompt_string for _ in steer_types]
+        logprobs: list[list[NPLogprob]] = [[] for _ in steer_types]
+
+        with model.hooks(fwd_hooks=editing_hooks):  # type: ignore
+            for new_tokens, logits, active in generation.stream():
+                for row in range(len(steer_types)):
+                    if not active[row]:
+                        continue
+                    token = new_tokens[row : row + 1]
+                    results[row] += model.to_string(token)  # type: ignore
+                    if n_logprobs > 0:
+                        logprobs[row].append(
+                            make_logprob_from_logits(
+                                new_tokens[row].view(1, 1),
+                                logits[row].view(1, 1, -1),
                                 model,
                                 n_logprobs,
                             )
-                            logprobs.append(current_logprobs)
-
-                        if flag == NPSteerType.STEERED:
-                            steered_partial_result += to_append  # type: ignore
-                            steered_logprobs = logprobs.copy() or None
-                        else:
-                            default_partial_result += to_append  # type: ignore
-                            default_logprobs = logprobs.copy() or None
-
-                        to_return = make_steer_completion_chat_response(
-                            steer_types,
-                            steered_partial_result,
-                            default_partial_result,
-                            model,
-                            promptTokenized,
-                            inputPrompt,
-                            custom_hf_model_id,
-                            steered_logprobs,
-                            default_logprobs,
-                        )  # type: ignore
-                        yield format_sse_message(to_return.to_json())
-        else:
-            steer_type = steer_types[0]
-            if seed is not None:
-                torch.manual_seed(seed)
-
-            model.reset_hooks()
-            editing_hooks = [
-                (
-                    (
-                        sae_manager.get_sae_hook(feature.source)
-                        if isinstance(feature, NPSteerFeature)
-                        else feature.hook
-                    ),
-                    steering_hook,
+                        )
+
+                steered_row = get_row(steer_types, NPSteerType.STEERED)
+                default_row = get_row(steer_types, NPSteerType.DEFAULT)
+                to_return = make_steer_completion_chat_response(
+                    steer_types,
+                    results[steered_row],
+                    results[default_row],
+                    model,
+                    promptTokenized,
+                    inputPrompt,
+                    custom_hf_model_id,
+                    logprobs[steered_row] or None,
+                    logprobs[default_row] or None,
                 )
-                for feature in features
-            ]
-            logger.info("steer_type: %s", steer_type)
-
-            with model.hooks(fwd_hooks=editing_hooks):  # type: ignore
-                partial_result = ""
-                logprobs = []
-
-                for i, (result, logits) in enumerate(
-                    model.generate_stream(
-                        max_tokens_per_yield=TOKENS_PER_YIELD,
-                        stop_at_eos=(model.cfg.device != "mps"),
-                        input=promptTokenized.unsqueeze(0),
-                        do_sample=True,
-                        return_logits=True,
-                        **kwargs,
-                    )
-                ):
-                    if i == 0:
-                        partial_result = model.to_string(result[0][1:])  # type: ignore
-                    else:
-                        partial_result += model.to_string(result[0])  # type: ignore
+                yield format_sse_message(to_return.to_json())
 
-                    if n_logprobs > 0:
-                        current_logprobs = make_logprob_from_logits(
-                            result,  # type: ignore
-                            logits,  # type: ignore
-                            model,
-                            n_logprobs,
-                        )
-                        logprobs.append(current_logprobs)
-
-                    to_return = make_steer_completion_chat_response(
-                        [steer_type],
-                        partial_result,  # type: ignore
-                        partial_result,  # type: ignore
-                        model,
-                        promptTokenized,
-                        inputPrompt,
-                        custom_hf_model_id,
-                        logprobs or None,
-                        logprobs or None,
-                    )
-                    yield format_sse_message(to_return.to_json())
+
+def get_prompt_mask(
+    prompt_tokens: torch.Tensor, model: HookedTransformer, steer_special_tokens: bool
+) -> torch.Tensor:
+    """Get which of the prompt's positions to steer (1) and not to steer (0)."""
+    prompt_mask = torch.ones(len(prompt_tokens))
+    if steer_special_tokens:
+        return prompt_mask
+    if model.tokenizer is None:
+        raise ValueError("Tokenizer is not initialized")
+    # TODO: Need to generalize beyond the gemma tokenizer
+
+    # Find indices of special tokens
+    bos_indices = (prompt_tokens == model.tokenizer.bos_token_id).nonzero(
+        as_tuple=True
+    )[0]  # type: ignore
+    start_of_turn_indices = (
+        prompt_tokens == model.tokenizer.encode("<start_of_turn>")[0]
+    ).nonzero(as_tuple=True)[0]
+    end_of_turn_indices = (
+        prompt_tokens == model.tokenizer.encode("<end_of_turn>")[0]
+    ).nonzero(as_tuple=True)[0]
+
+    # Apply masking rules
+    # 1. Don't steer <bos>
+    prompt_mask[bos_indices] = 0
+
+    # 2. Don't steer <start_of_turn> and the next two tokens
+    for idx in start_of_turn_indices:
+        prompt_mask[idx : idx + 3] = 0
+
+    # 3. Don't steer <end_of_turn> and the next token
+    for idx in end_of_turn_indices:
+        prompt_mask[idx : idx + 2] = 0
+    return prompt_mask
+
+
+def get_position_mask(
+    prompt_mask: torch.Tensor, position: int, n_positions: int
+) -> torch.Tensor | None:
+    """Get the mask of the `n_positions` tokens of a forward pass from `position` on.
+
+    Generated tokens are always steered, so this is None (steer everything) once the
+    forward pass is past the prompt.
+    """
+    if position >= len(prompt_mask):
+        return None
+    mask = torch.ones(n_positions)
+    prompt_positions = prompt_mask[position : position + n_positions]
+    mask[: len(prompt_positions)] = prompt_positions
+    return mask
 
 
 def make_steer_completion_chat_response(
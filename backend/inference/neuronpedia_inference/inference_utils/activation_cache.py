@@ -0,0 +1,111 @@
+import logging
+from collections import OrderedDict
+
+import torch
+
+from neuronpedia_inference.config import Config
+from neuronpedia_inference.replicas import get_current_replica
+
+logger = logging.getLogger(__name__)
+
+
+class PromptActivationCache:
+    """A byte-budgeted LRU cache of hook activations, keyed by (model, tokens, hook).
+
+    The same prompts get sent to the activation endpoints over and over, so we keep the
+    activations of the hooks they asked for and skip the forward pass when every hook a
+    request needs is already cached. With a budget of 0 (the default), nothing is cached.
+    """
+
+    _instance = None  # Class variable to store the singleton instance
+
+    @classmethod
+    def get_instance(cls):
+        """Get the global PromptActivationCache instance, creating it if it doesn't exist"""
+        replica = get_current_replica()
+        if replica is not None:
+            return replica.activation_cache
+        if cls._instance is None:
+            config = Config.get_instance()
+            cls._instance = PromptActivationCache(
+                model_id=config.override_model_id,
+                max_bytes=config.activation_cache_bytes,
+            )
+        return cls._instance
+
+    def __init__(self, model_id: str, max_bytes: int = 0):
+        self.model_id = model_id
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[tuple[str, tuple[int, ...], str], torch.Tensor] = (
+            OrderedDict()
+        )
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _key(
+        self, tokens: tuple[int, ...], hook_name: str
+    ) -> tuple[str, tuple[int, ...], str]:
+        return (self.model_id, tokens, hook_name)
+
+    def get(
+        self, tokens: torch.Tensor, hook_names: set[str] | None
+    ) -> dict[str, torch.Tensor] | None:
+        """Get the cached activations of these hooks, or None unless all of them are cached.
+
+        Requests without a hook filter need every hook, so they are never served from here.
+        """
+        if not self.enabled or hook_names is None:
+            return None
+
+        token_ids = tuple(tokens.tolist())
+        keys = [self._key(token_ids, hook_name) for hook_name in hook_names]
+        if not all(key in self.entries for key in keys):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        for key in keys:
+            self.entries.move_to_end(key)
+        return {key[2]: self.entries[key] for key in keys}
+
+    def put(self, tokens: torch.Tensor, activations: dict[str, torch.Tensor]) -> None:
+        """Cache the activations of a prompt, evicting the least recently used ones."""
+        if not self.enabled:
+            return
+
+        token_ids = tuple(tokens.tolist())
+        for hook_name, activation in activations.items():
+            n_bytes = activation.numel() * activation.element_size()
+            if n_bytes > self.max_bytes:
+                continue
+            key = self._key(token_ids, hook_name)
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                continue
+            # copy, so that we don't keep a whole batched activation alive through a view
+            self.entries[key] = activation.detach().clone()
+            self.bytes += n_bytes
+
+        while self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= evicted.numel() * evicted.element_size()
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.bytes = 0
+
+    def get_stats(self) -> dict[str, int | float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+        }
@@ -0,0 +1,45 @@
+import logging
+
+from transformer_lens import HookedTransformer
+
+from neuronpedia_inference.inference_utils.forward_plan import get_hook_layer
+
+logger = logging.getLogger(__name__)
+
+
+class DevicePlacement:
+    """Which device each layer of the model lives on, when it's split across devices.
+
+    TransformerLens decides where each block goes when the model is loaded with
+    n_devices > 1, so we read it back from the model instead of recomputing it. Each SAE
+    is then put on the device of its hook's layer, next to the activations it encodes.
+    """
+
+    def __init__(self, layer_devices: list[str], device: str):
+        self.layer_devices = layer_devices
+        # where everything that isn't in a block (e.g. hook_embed) is assumed to be
+        self.device = device
+
+    @classmethod
+    def from_model(cls, model: HookedTransformer) -> "DevicePlacement":
+        layer_devices = [str(next(block.parameters()).device) for block in model.blocks]
+        device = layer_devices[0] if layer_devices else str(model.cfg.device)
+        placement = cls(layer_devices, device)
+        logger.info(f"Model layers are on devices: {placement.get_layer_ranges()}")
+        return placement
+
+    def get_device_for_layer(self, layer: int | None) -> str:
+        if layer is None or not 0 <= layer < len(self.layer_devices):
+            return self.device
+        return self.layer_devices[layer]
+
+    def get_device_for_hook(self, hook_name: str) -> str:
+        return self.get_device_for_layer(get_hook_layer(hook_name))
+
+    def get_layer_ranges(self) -> dict[str, tuple[int, int]]:
+        """Get the first and last layer on each device, e.g. {"cuda:1": (12, 23)}."""
+        ranges: dict[str, tuple[int, int]] = {}
+        for layer, device in enumerate(self.layer_devices):
+            first_layer = ranges.get(device, (layer, layer))[0]
+            ranges[device] = (first_layer, layer)
+        return ranges
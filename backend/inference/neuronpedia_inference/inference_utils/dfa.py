@@ -0,0 +1,97 @@
+import einops
+import torch
+
+
+def _get_safe_dtype(dtype: torch.dtype) -> torch.dtype:
+    """
+    Convert float16 to float32, leave other dtypes unchanged.
+    """
+    return torch.float32 if dtype == torch.float16 else dtype
+
+
+def _safe_cast(tensor: torch.Tensor, target_dtype: torch.dtype) -> torch.Tensor:
+    """
+    Safely cast a tensor to the target dtype, creating a copy if needed.
+    Convert float16 to float32, leave other dtypes unchanged.
+    """
+    safe_dtype = _get_safe_dtype(tensor.dtype)
+    if safe_dtype != tensor.dtype or safe_dtype != target_dtype:
+        return tensor.to(target_dtype)
+    return tensor
+
+
+@torch.no_grad()
+def calculate_dfa_values(
+    v: torch.Tensor,
+    attn_weights: torch.Tensor,
+    W_enc: torch.Tensor,
+    dest_index: int,
+) -> torch.Tensor:
+    """Direct feature attribution of one feature, for a single destination position.
+
+    `v` is [batch, src_pos, n_kv_heads, d_head], `attn_weights` is the attention pattern
+    [batch, n_heads, dest_pos, src_pos] and `W_enc` is the feature's encoder column
+    [n_heads * d_head]. Returns [batch, src_pos].
+    """
+    dest_indices = torch.tensor([dest_index], device=attn_weights.device)
+    return calculate_batched_dfa_values(
+        v, attn_weights, W_enc.unsqueeze(-1), dest_indices
+    )[:, 0]
+
+
+@torch.no_grad()
+def calculate_batched_dfa_values(
+    v: torch.Tensor,
+    attn_weights: torch.Tensor,
+    W_enc: torch.Tensor,
+    dest_indices: torch.Tensor,
+) -> torch.Tensor:
+    """Direct feature attribution of several features of the same layer at once.
+
+    `W_enc` holds the features' stacked encoder columns [n_heads * d_head, n_features],
+    and `dest_indices` [n_features] the destination position to attribute for each of
+    them. Returns [batch, n_features, src_pos].
+
+    The values are projected onto the encoder columns per head first, and only the
+    destination rows of the pattern are used, so memory is linear in the sequence length
+    instead of materializing [batch, dest_pos, src_pos, n_heads * d_head].
+    """
+    input_dtype = v.dtype
+    # Use the highest precision dtype
+    op_dtype = max(
+        _get_safe_dtype(v.dtype),
+        _get_safe_dtype(attn_weights.dtype),
+        _get_safe_dtype(W_enc.dtype),
+        key=lambda x: x.itemsize,
+    )
+
+    # with GQA, each key/value head is shared by a group of query heads
+    n_heads = attn_weights.shape[1]
+    n_kv_heads = v.shape[2]
+    if n_kv_heads < n_heads:
+        v = v.repeat_interleave(n_heads // n_kv_heads, dim=2)
+
+    v = _safe_cast(v, op_dtype)
+    attn_weights_rows = _safe_cast(
+        attn_weights[:, :, dest_indices.to(attn_weights.device), :], op_dtype
+    )
+    W_enc_heads = einops.rearrange(
+        _safe_cast(W_enc.to(v.device), op_dtype),
+        "(n_heads d_head) n_features -> n_heads d_head n_features",
+        n_heads=n_heads,
+    )
+
+    v_proj = einops.einsum(
+        v,
+        W_enc_heads,
+        "batch src_pos n_heads d_head, n_heads d_head n_features "
+        "-> batch n_features src_pos n_heads",
+    )
+    dfa_values = einops.einsum(
+        attn_weights_rows,
+        v_proj,
+        "batch n_heads n_features src_pos, batch n_features src_pos n_heads "
+        "-> batch n_features src_pos",
+    )
+    # Cast the result back to the original dtype of v
+    return _safe_cast(dfa_values, input_dtype)
@@ -0,0 +1,250 @@
+import asyncio
+import logging
+from typing import Any
+
+import torch
+from transformer_lens import ActivationCache
+
+from neuronpedia_inference.config import Config
+from neuronpedia_inference.inference_utils.activation_cache import (
+    PromptActivationCache,
+)
+from neuronpedia_inference.inference_utils.forward_plan import RESID_PRE_HOOK_SUFFIX
+from neuronpedia_inference.replicas import get_current_replica
+from neuronpedia_inference.shared import Model, request_lock
+
+logger = logging.getLogger(__name__)
+
+# hooks whose activations have two position dimensions (dest_pos, src_pos)
+TWO_POSITION_HOOK_SUFFIXES = ("hook_pattern", "hook_attn_scores")
+
+
+class PendingForward:
+    def __init__(
+        self,
+        tokens: torch.Tensor,
+        stop_at_layer: int | None,
+        names_filter: set[str] | None,
+        future: "asyncio.Future[ActivationCache]",
+    ):
+        self.tokens = tokens
+        self.stop_at_layer = stop_at_layer
+        self.names_filter = names_filter
+        self.future = future
+
+
+class ForwardBatcher:
+    """Micro-batches concurrent activation forward passes.
+
+    Requests that arrive within `window_ms` of each other are right-padded to the same
+    length and run through a single `model.run_with_cache` call. The batched cache is then
+    split back into one cache per request. Right padding doesn't change the activations of
+    the real tokens, since with causal attention they never attend to the padding after them.
+
+    With a window of 0 (the default), each request runs its own forward pass.
+
+    If an activation cache is given, requests whose hooks are all cached for their tokens
+    skip the forward pass entirely.
+    """
+
+    _instance = None  # Class variable to store the singleton instance
+
+    @classmethod
+    def get_instance(cls):
+        """Get the global ForwardBatcher instance, creating it if it doesn't exist"""
+        replica = get_current_replica()
+        if replica is not None:
+            return replica.forward_batcher
+        if cls._instance is None:
+            config = Config.get_instance()
+            cls._instance = ForwardBatcher(
+                window_ms=config.batch_window_ms,
+                max_batch_size=config.max_batch_size,
+                activation_cache=PromptActivationCache.get_instance(),
+            )
+        return cls._instance
+
+    def __init__(
+        self,
+        window_ms: float = 0,
+        max_batch_size: int = 8,
+        activation_cache: PromptActivationCache | None = None,
+    ):
+        self.window_ms = window_ms
+        self.max_batch_size = max_batch_size
+        self.activation_cache = activation_cache
+        self._pending: list[PendingForward] = []
+        self._batch_full: asyncio.Event | None = None
+        self._flush_task: asyncio.Task[None] | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.window_ms > 0 and self.max_batch_size > 1
+
+    async def run_with_cache(
+        self,
+        tokens: torch.Tensor,
+        stop_at_layer: int | None = None,
+        names_filter: set[str] | None = None,
+    ) -> ActivationCache:
+        """Run the model on a single prompt's tokens and return its activation cache.
+
+        Only the hooks in `names_filter` are cached. None caches every hook.
+        """
+        if self.activation_cache is not None:
+            cached = self.activation_cache.get(tokens, names_filter)
+            if cached is not None:
+                return ActivationCache(cached, Model.get_instance())
+
+        cache = await self._run_with_cache(tokens, stop_at_layer, names_filter)
+
+        # requests without a filter cache every hook, which is too much to keep around
+        if self.activation_cache is not None and names_filter is not None:
+            self.activation_cache.put(
+                tokens, {name: cache[name] for name in names_filter}
+            )
+        return cache
+
+    async def _run_with_cache(
+        self,
+        tokens: torch.Tensor,
+        stop_at_layer: int | None,
+        names_filter: set[str] | None,
+    ) -> ActivationCache:
+        if not self.enabled:
+            async with request_lock:
+                return self._run_batch([tokens], stop_at_layer, names_filter)[0]
+
+        future: asyncio.Future[ActivationCache] = (
+            asyncio.get_running_loop().create_future()
+        )
+        self._pending.append(
+            PendingForward(tokens, stop_at_layer, names_filter, future)
+        )
+        if self._flush_task is None:
+            self._start_flush()
+        elif len(self._pending) >= self.max_batch_size:
+            self._batch_full.set()  # type: ignore
+        return await future
+
+    def _start_flush(self) -> None:
+        # the event is created per flush so that it's bound to the running event loop
+        self._batch_full = asyncio.Event()
+        if len(self._pending) >= self.max_batch_size:
+            self._batch_full.set()
+        self._flush_task = asyncio.create_task(self._flush(self._batch_full))
+
+    async def _flush(self, batch_full: asyncio.Event) -> None:
+        try:
+            await asyncio.wait_for(batch_full.wait(), timeout=self.window_ms / 1000)
+        except asyncio.TimeoutError:
+            pass
+
+        batch = self._pending[: self.max_batch_size]
+        self._pending = self._pending[self.max_batch_size :]
+        # anything left over starts collecting the next batch right away
+        self._flush_task = None
+        if self._pending:
+            self._start_flush()
+
+        batch = [pending for pending in batch if not pending.future.done()]
+        if not batch:
+            return
+
+        async with request_lock:
+            try:
+                caches = self._run_batch(
+                    [pending.tokens for pending in batch],
+                    self._merge_stop_at_layer(batch),
+                    self._merge_names_filter(batch),
+                )
+            except Exception as e:
+                for pending in batch:
+                    if not pending.future.done():
+                        pending.future.set_exception(e)
+                return
+
+        for pending, cache in zip(batch, caches):
+            if not pending.future.done():
+                pending.future.set_result(cache)
+
+    @staticmethod
+    def _merge_stop_at_layer(batch: list[PendingForward]) -> int | None:
+        # the batch has to run deep enough for its deepest request
+        if any(pending.stop_at_layer is None for pending in batch):
+            return None
+        return max(pending.stop_at_layer for pending in batch)  # type: ignore
+
+    @staticmethod
+    def _merge_names_filter(batch: list[PendingForward]) -> set[str] | None:
+        # the batch has to cache every hook that one of its requests needs
+        names_filter: set[str] = set()
+        for pending in batch:
+            if pending.names_filter is None:
+                return None
+            names_filter |= pending.names_filter
+        return names_filter
+
+    @torch.no_grad()
+    def _run_batch(
+        self,
+        tokens_list: list[torch.Tensor],
+        stop_at_layer: int | None,
+        names_filter: set[str] | None = None,
+    ) -> list[ActivationCache]:
+        model = Model.get_instance()
+        run_kwargs: dict[str, Any] = {"stop_at_layer": stop_at_layer}
+        if names_filter is not None:
+            run_kwargs["names_filter"] = sorted(names_filter)
+
+        if len(tokens_list) == 1:
+            residual, cache = model.run_with_cache(tokens_list[0], **run_kwargs)
+            self._add_stop_resid_pre(cache, residual, stop_at_layer, names_filter)
+            return [cache]  # type: ignore
+
+        lengths = [len(tokens) for tokens in tokens_list]
+        max_length = max(lengths)
+        batch_tokens = tokens_list[0].new_zeros((len(tokens_list), max_length))
+        attention_mask = torch.zeros_like(batch_tokens)
+        for row, tokens in enumerate(tokens_list):
+            batch_tokens[row, : len(tokens)] = tokens
+            attention_mask[row, : len(tokens)] = 1
+
+        logger.info("Running batched forward pass for %s prompts", len(tokens_list))
+        if min(lengths) < max_length:
+            run_kwargs["attention_mask"] = attention_mask
+        residual, batch_cache = model.run_with_cache(batch_tokens, **run_kwargs)
+        self._add_stop_resid_pre(batch_cache, residual, stop_at_layer, names_filter)
+
+        return [
+            self._slice_cache(batch_cache, model, row, length)  # type: ignore
+            for row, length in enumerate(lengths)
+        ]
+
+    @staticmethod
+    def _add_stop_resid_pre(
+        cache: ActivationCache,
+        residual: torch.Tensor,
+        stop_at_layer: int | None,
+        names_filter: set[str] | None,
+    ) -> None:
+        """The block we stop at doesn't run, so its hook_resid_pre isn't cached, but its
+        value is the residual that the forward pass returns."""
+        if stop_at_layer is None:
+            return
+        hook_name = f"blocks.{stop_at_layer}.{RESID_PRE_HOOK_SUFFIX}"
+        if names_filter is None or hook_name in names_filter:
+            cache.cache_dict[hook_name] = residual
+
+    @staticmethod
+    def _slice_cache(
+        batch_cache: ActivationCache, model: object, row: int, length: int
+    ) -> ActivationCache:
+        """Take one request's row out of a batched cache, dropping its padding."""
+        cache_dict: dict[str, torch.Tensor] = {}
+        for name, activation in batch_cache.items():
+            if name.endswith(TWO_POSITION_HOOK_SUFFIXES):
+                cache_dict[name] = activation[row : row + 1, :, :length, :length]
+            else:
+                cache_dict[name] = activation[row : row + 1, :length]
+        return ActivationCache(cache_dict, model)  # type: ignore
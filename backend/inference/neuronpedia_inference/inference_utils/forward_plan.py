@@ -0,0 +1,91 @@
+import re
+
+from transformer_lens.utils import get_act_name
+
+from neuronpedia_inference.sae_manager import SAEManager
+from neuronpedia_inference.shared import Model
+
+HOOK_LAYER_PATTERN = re.compile(r"blocks\.(\d+)\.")
+# the input of a block is the output of the blocks below it, so it's the residual that
+# the forward pass returns when it stops at that block
+RESID_PRE_HOOK_SUFFIX = "hook_resid_pre"
+
+
+class ForwardPlan:
+    """What a forward pass has to produce for a request.
+
+    `hook_names` are the hooks to cache (None caches every hook), and `stop_at_layer` is
+    how many blocks have to run to reach the deepest of them (None runs the whole model).
+    """
+
+    def __init__(self, hook_names: set[str] | None, stop_at_layer: int | None):
+        self.hook_names = hook_names
+        self.stop_at_layer = stop_at_layer
+
+    @classmethod
+    def for_hooks(cls, hook_names: set[str] | None) -> "ForwardPlan":
+        return cls(hook_names, get_stop_at_layer(hook_names))
+
+
+def get_hook_layer(hook_name: str) -> int | None:
+    """Get the block index of a hook, e.g. blocks.7.attn.hook_z -> 7"""
+    match = HOOK_LAYER_PATTERN.match(hook_name)
+    return int(match.group(1)) if match else None
+
+
+def get_dfa_hook_names(layer_num: int) -> set[str]:
+    """DFA reads the attention values and pattern of the SAE's layer."""
+    return {get_act_name("v", layer_num), get_act_name("pattern", layer_num)}
+
+
+def get_cache_hook_names(
+    sources: list[str], include_dfa: bool = True
+) -> set[str] | None:
+    """Get the exact set of hooks a forward pass has to cache for these sources.
+
+    The attention values and pattern are only included for DFA-enabled sources, and only
+    if `include_dfa` is set. Returns None (cache every hook) if we don't know the hook of
+    one of the sources, so that the endpoint fails the same way it would without a filter.
+    """
+    sae_manager = SAEManager.get_instance()
+    hook_names: set[str] = set()
+    for source in sources:
+        hook_name = sae_manager.get_sae_hook(source)
+        if hook_name is None:
+            return None
+        hook_names.add(hook_name)
+
+        if include_dfa and sae_manager.is_dfa_enabled(source):
+            layer_num = get_hook_layer(hook_name)
+            if layer_num is None:
+                return None
+            hook_names |= get_dfa_hook_names(layer_num)
+    return hook_names
+
+
+def get_stop_at_layer(hook_names: set[str] | None) -> int | None:
+    """Get the stop_at_layer that runs just far enough to reach every hook.
+
+    A hook_resid_pre of block L only needs the L blocks below it (the forward pass
+    returns its value), any other hook of block L needs block L to run. Returns None
+    (run the whole model) if there is no filter, if a hook isn't inside a block (e.g.
+    ln_final), or if the deepest hook is in the last block anyway.
+    """
+    if not hook_names:
+        return None
+    stop_at_layer = 0
+    for hook_name in hook_names:
+        layer_num = get_hook_layer(hook_name)
+        if layer_num is None:
+            return None
+        if not hook_name.endswith(RESID_PRE_HOOK_SUFFIX):
+            layer_num += 1
+        stop_at_layer = max(stop_at_layer, layer_num)
+    if stop_at_layer >= Model.get_instance().cfg.n_layers:
+        return None
+    return stop_at_layer
+
+
+def get_forward_plan(sources: list[str], include_dfa: bool = True) -> ForwardPlan:
+    """Plan the forward pass for these sources: their hooks, and how deep to run."""
+    return ForwardPlan.for_hooks(get_cache_hook_names(sources, include_dfa))
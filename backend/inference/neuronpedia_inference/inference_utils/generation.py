@@ -0,0 +1,198 @@
+import logging
+from collections.abc import Iterator
+
+import torch
+from transformer_lens import HookedTransformer
+from transformer_lens.past_key_value_caching import HookedTransformerKeyValueCache
+
+from neuronpedia_inference.inference_utils.prompt_kv_cache import PromptKVCache
+
+logger = logging.getLogger(__name__)
+
+
+class BatchedGeneration:
+    """Samples several completions of the same prompt together, one token per step.
+
+    Each row of the batch is one completion (e.g. STEERED and DEFAULT), so a single
+    forward pass per token serves all of them. Hooks added around the generation (e.g.
+    steering) can tell the rows apart by their batch index.
+
+    Every row samples with its own generator, seeded with the same seed, so each row
+    draws the same random numbers as it would if it were generated on its own.
+
+    The rows only differ from the first hooked layer on, so the prompt is run through
+    the layers below it (`shared_layers`) once, and their keys and values are shared by
+    all the rows. Only the layers above are prefilled for every row.
+
+    With a prompt cache, the prefill resumes from the longest prefix of the prompt
+    cached with the same `prompt_cache_key`, and the prompt's keys and values are
+    cached for the next requests.
+    """
+
+    def __init__(
+        self,
+        model: HookedTransformer,
+        tokens: torch.Tensor,
+        n_rows: int,
+        max_new_tokens: int,
+        temperature: float = 1.0,
+        freq_penalty: float = 0.0,
+        seed: int | None = None,
+        stop_at_eos: bool = True,
+        shared_layers: int = 0,
+        prompt_cache: PromptKVCache | None = None,
+        prompt_cache_key: str = "",
+    ):
+        self.model = model
+        # [n_rows, pos], the prompt followed by the tokens generated so far
+        self.tokens = tokens.to(model.cfg.device).unsqueeze(0).expand(n_rows, -1)
+        self.prompt_length = tokens.shape[0]
+        self.n_rows = n_rows
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.freq_penalty = freq_penalty
+        self.seed = seed
+        self.stop_at_eos = stop_at_eos and model.tokenizer is not None
+        # shortformer models add the positional embedding in every layer, which
+        # starting at a layer doesn't support
+        if model.cfg.positional_embedding_type == "shortformer":
+            shared_layers = 0
+        self.shared_layers = min(shared_layers, model.cfg.n_layers)
+        self.prompt_cache = prompt_cache
+        self.prompt_cache_key = prompt_cache_key
+        # index of the first token of the forward pass that is running
+        self.position = 0
+        self.generators: list[torch.Generator] | None = None
+
+    def _make_generators(self, device: torch.device) -> list[torch.Generator]:
+        generators = []
+        for _ in range(self.n_rows):
+            generator = torch.Generator(device=device)
+            if self.seed is not None:
+                generator.manual_seed(self.seed)
+            else:
+                generator.seed()
+            generators.append(generator)
+        return generators
+
+    def sample(self, logits: torch.Tensor) -> torch.Tensor:
+        """Sample the next token of each row from its logits, [n_rows, d_vocab]."""
+        if self.temperature == 0.0:
+            return logits.argmax(dim=-1)
+
+        logits = logits / self.temperature
+        if self.freq_penalty > 0:
+            for row in range(self.n_rows):
+                logits[row] = logits[row] - self.freq_penalty * torch.bincount(
+                    self.tokens[row], minlength=logits.shape[-1]
+                )
+        probs = torch.softmax(logits.to(torch.float32), dim=-1)
+
+        if self.generators is None:
+            self.generators = self._make_generators(probs.device)
+        # sampled the way torch.distributions.Categorical does, so that a row draws the
+        # same tokens as a batch of one after torch.manual_seed(seed)
+        return torch.cat(
+            [
+                torch.multinomial(probs[row : row + 1], 1, True, generator=generator)
+                for row, generator in enumerate(self.generators)
+            ]
+        ).squeeze(1)
+
+    def forward(self, tokens: torch.Tensor, cache: HookedTransformerKeyValueCache):
+        """Run the next tokens [n_rows, pos] of every row, returning the last logits."""
+        logits = self.model(tokens, past_kv_cache=cache)
+        self.position += tokens.shape[1]
+        return logits[:, -1, :]
+
+    def init_cache(self, n_rows: int | None = None) -> HookedTransformerKeyValueCache:
+        return HookedTransformerKeyValueCache.init_cache(
+            self.model.cfg, self.model.cfg.device, n_rows or self.n_rows
+        )
+
+    def prefill(self, cache: HookedTransformerKeyValueCache) -> torch.Tensor:
+        """Run the prompt, returning the logits of its last token for every row."""
+        if self.prompt_cache is None:
+            return self.prefill_prompt(cache)
+
+        prompt = self.tokens[0]
+        cached = self.prompt_cache.get_longest_prefix(self.prompt_cache_key, prompt)
+        if cached is None:
+            logits = self.prefill_prompt(cache)
+        else:
+            length, entry = cached
+            entry.restore(cache)
+            self.position = length
+            if length == self.prompt_length:
+                return entry.logits
+            logger.info(f"Resuming the prompt from {length} cached tokens")
+            logits = self.forward(self.tokens[:, length:], cache)
+        self.prompt_cache.put(self.prompt_cache_key, prompt, cache, logits)
+        return logits
+
+    def prefill_prompt(self, cache: HookedTransformerKeyValueCache) -> torch.Tensor:
+        if self.shared_layers == 0 or self.n_rows == 1:
+            return self.forward(self.tokens, cache)
+
+        # the layers below the first hooked one are the same for every row
+        shared_cache = self.init_cache(n_rows=1)
+        residual = self.model(
+            self.tokens[:1],
+            past_kv_cache=shared_cache,
+            stop_at_layer=self.shared_layers,
+        )
+        for layer in range(self.shared_layers):
+            shared_entry = shared_cache.entries[layer]
+            cache.entries[layer].past_keys = shared_entry.past_keys.expand(
+                self.n_rows, -1, -1, -1
+            )
+            cache.entries[layer].past_values = shared_entry.past_values.expand(
+                self.n_rows, -1, -1, -1
+            )
+        cache.previous_attention_mask = shared_cache.previous_attention_mask.expand(
+            self.n_rows, -1
+        )
+
+        # hooks may change the residual in place, so every row needs its own copy
+        logits = self.model(
+            residual.repeat(self.n_rows, 1, 1),
+            start_at_layer=self.shared_layers,
+            past_kv_cache=cache,
+            attention_mask=cache.previous_attention_mask,
+        )
+        self.position += self.tokens.shape[1]
+        return logits[:, -1, :]
+
+    @torch.no_grad()
+    def stream(self) -> Iterator[tuple[torch.Tensor, torch.Tensor, list[bool]]]:
+        """Generate one token per row per step.
+
+        Yields the new tokens [n_rows], their logits [n_rows, d_vocab], and which rows
+        are still generating. A row stops after it samples the EOS token; it keeps
+        getting EOS (which should be ignored) until every row has stopped.
+        """
+        self.position = 0
+        cache = self.init_cache()
+        logits = self.prefill(cache)
+
+        eos_token_id = (
+            self.model.tokenizer.eos_token_id  # type: ignore
+            if self.stop_at_eos
+            else None
+        )
+        finished = torch.zeros(self.n_rows, dtype=torch.bool, device=logits.device)
+        for _ in range(self.max_new_tokens):
+            new_tokens = self.sample(logits).to(logits.device)
+            active = [not done for done in finished.tolist()]
+            if eos_token_id is not None:
+                new_tokens[finished] = eos_token_id
+                finished |= new_tokens == eos_token_id
+
+            self.tokens = torch.cat(
+                [self.tokens, new_tokens.unsqueeze(1).to(self.tokens.device)], dim=1
+            )
+            yield new_tokens, logits, active
+
+            if finished.all():
+                break
+            logits = self.forward(new_tokens.unsqueeze(1), cache)
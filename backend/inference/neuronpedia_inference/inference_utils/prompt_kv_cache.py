@@ -0,0 +1,174 @@
+import logging
+from collections import Counter, OrderedDict
+
+import torch
+from transformer_lens.past_key_value_caching import HookedTransformerKeyValueCache
+
+from neuronpedia_inference.config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class PromptKVCacheEntry:
+    """The keys and values of every layer for a prompt, and its last token's logits."""
+
+    def __init__(
+        self,
+        keys: list[torch.Tensor],
+        values: list[torch.Tensor],
+        attention_mask: torch.Tensor,
+        logits: torch.Tensor,
+    ):
+        self.keys = keys
+        self.values = values
+        self.attention_mask = attention_mask
+        self.logits = logits
+        # the layers shared by every row are expanded views of one row, so each
+        # storage is only counted once, and in full
+        storages = {
+            tensor.untyped_storage().data_ptr(): tensor.untyped_storage().nbytes()
+            for tensor in [*keys, *values, attention_mask, logits]
+        }
+        self.n_bytes = sum(storages.values())
+
+    @classmethod
+    def from_cache(
+        cls, cache: HookedTransformerKeyValueCache, logits: torch.Tensor
+    ) -> "PromptKVCacheEntry":
+        # the cache's tensors are replaced (not changed) when tokens are appended, so
+        # they can be kept as they are. The logits are copied so that we don't keep the
+        # logits of the whole prompt alive through a view.
+        return cls(
+            keys=[entry.past_keys for entry in cache.entries],
+            values=[entry.past_values for entry in cache.entries],
+            attention_mask=cache.previous_attention_mask,
+            logits=logits.detach().clone(),
+        )
+
+    def restore(self, cache: HookedTransformerKeyValueCache) -> None:
+        """Put the prompt's keys and values into an empty cache."""
+        for entry, keys, values in zip(cache.entries, self.keys, self.values):
+            entry.past_keys = keys
+            entry.past_values = values
+        cache.previous_attention_mask = self.attention_mask
+
+
+class PromptKVCache:
+    """A byte-budgeted LRU cache of the keys and values of steering prompts.
+
+    Multi-turn chats send the previous prompt plus a new turn, so we keep the keys and
+    values of every layer after each prompt, and a prompt that starts with a cached one
+    only runs its new tokens (or no tokens, if it's the same prompt).
+
+    The keys and values of the steered rows depend on the steering, so entries are
+    keyed by a steering key as well as the tokens, and only reused by requests with the
+    same steering key (the same steering, types and devices). With a budget of 0 (the
+    default), nothing is cached.
+    """
+
+    _instance = None  # Class variable to store the singleton instance
+
+    @classmethod
+    def get_instance(cls):
+        """Get the global PromptKVCache instance, creating it if it doesn't exist"""
+        if cls._instance is None:
+            config = Config.get_instance()
+            cls._instance = PromptKVCache(
+                model_id=config.override_model_id,
+                max_bytes=config.prompt_kv_cache_bytes,
+            )
+        return cls._instance
+
+    def __init__(self, model_id: str, max_bytes: int = 0):
+        self.model_id = model_id
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[
+            tuple[str, str, tuple[int, ...]], PromptKVCacheEntry
+        ] = OrderedDict()
+        # how many entries of each prompt length there are for each steering key, so
+        # that we only look up the prefixes that could be cached
+        self.lengths: dict[str, Counter[int]] = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _key(
+        self, steering_key: str, tokens: tuple[int, ...]
+    ) -> tuple[str, str, tuple[int, ...]]:
+        return (self.model_id, steering_key, tokens)
+
+    def get_longest_prefix(
+        self, steering_key: str, tokens: torch.Tensor
+    ) -> tuple[int, PromptKVCacheEntry] | None:
+        """Get the longest cached prefix of these tokens (which may be all of them), and
+        its length, or None if no prefix is cached for this steering key."""
+        if not self.enabled:
+            return None
+
+        token_ids = tuple(tokens.tolist())
+        lengths = self.lengths.get(steering_key, Counter())
+        for length in sorted(lengths, reverse=True):
+            if length > len(token_ids):
+                continue
+            key = self._key(steering_key, token_ids[:length])
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return length, self.entries[key]
+
+        self.misses += 1
+        return None
+
+    def put(
+        self,
+        steering_key: str,
+        tokens: torch.Tensor,
+        cache: HookedTransformerKeyValueCache,
+        logits: torch.Tensor,
+    ) -> None:
+        """Cache the keys and values of a prompt, evicting the least recently used."""
+        if not self.enabled:
+            return
+
+        key = self._key(steering_key, tuple(tokens.tolist()))
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        entry = PromptKVCacheEntry.from_cache(cache, logits)
+        if entry.n_bytes > self.max_bytes:
+            return
+        self.entries[key] = entry
+        self.lengths.setdefault(steering_key, Counter())[len(tokens)] += 1
+        self.bytes += entry.n_bytes
+
+        while self.bytes > self.max_bytes:
+            (_, evicted_steering_key, evicted_tokens), evicted = self.entries.popitem(
+                last=False
+            )
+            self.bytes -= evicted.n_bytes
+            lengths = self.lengths[evicted_steering_key]
+            lengths[len(evicted_tokens)] -= 1
+            if lengths[len(evicted_tokens)] == 0:
+                del lengths[len(evicted_tokens)]
+            if not lengths:
+                del self.lengths[evicted_steering_key]
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.lengths.clear()
+        self.bytes = 0
+
+    def get_stats(self) -> dict[str, int | float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+        }
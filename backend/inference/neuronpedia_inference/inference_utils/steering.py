@@ -1,16 +1,26 @@
+import hashlib
+import logging
 from collections import defaultdict
+from collections.abc import Callable
+from typing import Any
 
 import torch
 from neuronpedia_inference_client.models.np_steer_chat_message import (
     NPSteerChatMessage,
 )
 from neuronpedia_inference_client.models.np_steer_feature import NPSteerFeature
+from neuronpedia_inference_client.models.np_steer_method import NPSteerMethod
+from neuronpedia_inference_client.models.np_steer_type import NPSteerType
+from neuronpedia_inference_client.models.np_steer_vector import NPSteerVector
 from transformers import PreTrainedTokenizerBase
 
 from neuronpedia_inference.config import Config
+from neuronpedia_inference.inference_utils.forward_plan import get_hook_layer
 from neuronpedia_inference.sae_manager import SAEManager
 from neuronpedia_inference.shared import request_lock
 
+logger = logging.getLogger(__name__)
+
 
 async def stream_lock(is_stream: bool):
     if is_stream:
@@ -36,6 +46,11 @@ def remove_sse_formatting(data: str) -> str:
     return data.rstrip("\n\n")
 
 
+def get_row(steer_types: list[NPSteerType], steer_type: NPSteerType) -> int:
+    """Get the batch row that generates a type (the first row if there's none)."""
+    return steer_types.index(steer_type) if steer_type in steer_types else 0
+
+
 def process_features_vectorized(features: list[NPSteerFeature]):
     # Group features by source
     source_groups: defaultdict[str, list[tuple[int, int]]] = defaultdict(list)
@@ -218,91 +233,186 @@ def apply_generic_chat_template(
     return formatted_text
 
 
-class OrthogonalProjector:
-    """Performs orthogonal projection steering for language model activations.
+def get_tensor_bytes(tensor: torch.Tensor) -> bytes:
+    # as bytes, since numpy doesn't support every dtype (e.g. bfloat16)
+    return tensor.detach().cpu().contiguous().view(torch.uint8).numpy().tobytes()
+
 
-    This class implements low-rank orthogonal projection-based steering by projecting
-    activations onto and orthogonal to a steering direction.
+class RankOneProjector:
+    """Orthogonal projection steering without building the d x d projection matrix.
 
-    Attributes:
-        steering_vector: The direction to project onto/orthogonal to
-        _P: Cached projection matrix
-        _orthogonal_complement: Cached orthogonal complement matrix
+    Computes the orthogonal projection (I - P)h + strength * Ph with P = vv^T as
+    h + (strength - 1)(h . v)v. That is two O(d) operations per activation instead of
+    two O(d^2) matmuls, and no d x d matrix to allocate. v is used as given (it isn't
+    normalized here), so it's the unit direction when the steering is normalized.
+
+    For multi-dimensional steering vectors (e.g. (n_heads, d_head) for attn.hook_z),
+    the dot product is over all of the vector's dimensions.
     """
 
     def __init__(self, steering_vector: torch.Tensor):
-        """Initializes projector with a steering vector.
-
-        Args:
-            steering_vector: Vector defining steering direction, shape (d,)
-                           where d is activation dimension
-
-        Raises:
-            ValueError: If steering vector contains inf/nan values
-        """
-        self._P = None
-        self._orthogonal_complement = None
-        self.steering_vector = steering_vector.unsqueeze(1)
-
-    def get_P(self) -> torch.Tensor:
-        """Computes or returns cached projection matrix.
-
-        Returns:
-            Projection matrix P = vv^T/||v||^2, shape (d,d)
-
-        Raises:
-            ValueError: If projection computation fails or results in inf/nan
-        """
-        if self._P is None:
-            self.steering_vector = torch.matmul(
-                self.steering_vector, self.steering_vector.T
-            )
-            self._P = self.steering_vector
+        if not torch.isfinite(steering_vector).all():
+            raise ValueError("Steering vector contains inf or nan values")
+        self.steering_vector = steering_vector
 
-            if not torch.isfinite(self._P).all():
-                raise ValueError("Projection matrix contains inf or nan values")
+    def project(
+        self, activations: torch.Tensor, strength_multiplier: float = 1.0
+    ) -> torch.Tensor:
+        """Projects activations, shape (..., *steering_vector.shape)."""
+        steering_vector = self.steering_vector.to(activations.device)
+        vector_dims = tuple(range(-steering_vector.dim(), 0))
+        # in the steering vector's dtype, so that the dot product over d is accurate
+        dot = (activations.to(steering_vector.dtype) * steering_vector).sum(
+            dim=vector_dims, keepdim=True
+        )
+        update = (strength_multiplier - 1) * dot * steering_vector
+        return activations + update.to(activations.dtype)
 
-        return self._P
 
-    def get_orthogonal_complement(self) -> torch.Tensor:
-        """Computes or returns cached orthogonal complement matrix.
+class SteeringPlan:
+    """The steering of a request, compiled once before generating.
 
-        Returns:
-            Matrix I-P where P is projection matrix, shape (d,d)
+    The features are grouped by the hook they steer. For SIMPLE_ADDITIVE, all the
+    features of a hook are summed into one delta, already scaled, normalized and on the
+    hook's device, so the hook is a single add per forward pass. For ORTHOGONAL_DECOMP,
+    each hook keeps its rank-1 projectors, applied in the order of the features.
 
-        Raises:
-            ValueError: If computation fails
-        """
-        if self._orthogonal_complement is None:
-            P = self.get_P()  # This may raise ValueError
-            I = torch.eye(P.shape[0], dtype=P.dtype, device=P.device)  # noqa
-            self._orthogonal_complement = I - P
-            if not torch.isfinite(self._orthogonal_complement).all():
-                raise ValueError(
-                    "Orthogonal complement matrix contains inf or nan values"
+    Only the steered rows of the batch are changed. An optional position mask, given
+    the number of positions in the forward pass, can also leave some positions
+    unsteered (or return None to steer them all).
+    """
+
+    def __init__(
+        self,
+        steer_method: NPSteerMethod,
+        steered_rows: list[bool],
+        deltas: dict[str, torch.Tensor],
+        projectors: dict[str, list[tuple[RankOneProjector, float]]],
+        position_mask: Callable[[int], torch.Tensor | None] | None = None,
+    ):
+        self.steer_method = steer_method
+        self.steered_rows = steered_rows
+        self.deltas = deltas
+        self.projectors = projectors
+        self.position_mask = position_mask
+        # [batch, 1] of 1 for steered rows and 0 for the others, per device and dtype
+        self._row_scales: dict[tuple[torch.device, torch.dtype], torch.Tensor] = {}
+
+    @classmethod
+    def compile(
+        cls,
+        features: list[NPSteerFeature] | list[NPSteerVector],
+        steer_types: list[NPSteerType],
+        strength_multiplier: float,
+        steer_method: NPSteerMethod,
+        normalize_steering: bool,
+        model_cfg: Any,
+        position_mask: Callable[[int], torch.Tensor | None] | None = None,
+    ) -> "SteeringPlan":
+        sae_manager = SAEManager.get_instance()
+        vectors_by_hook: defaultdict[str, list[tuple[torch.Tensor, float]]] = (
+            defaultdict(list)
+        )
+        for feature in features:
+            hook_name = (
+                sae_manager.get_sae_hook(feature.source)
+                if isinstance(feature, NPSteerFeature)
+                else feature.hook
+            )
+            steering_vector = torch.as_tensor(feature.steering_vector).to(
+                sae_manager.get_device_for_hook(hook_name)
+            )
+
+            if not torch.isfinite(steering_vector).all():
+                raise ValueError("Steering vector contains inf or nan values")
+
+            if normalize_steering:
+                norm = torch.norm(steering_vector)
+                if norm == 0:
+                    raise ValueError("Zero norm steering vector")
+                steering_vector = steering_vector / norm
+
+            # If it's attention hook, reshape it to (n_heads, head_dim)
+            if "attn.hook_z" in hook_name:
+                steering_vector = steering_vector.view(
+                    model_cfg.n_heads, model_cfg.d_head
                 )
-        return self._orthogonal_complement
 
-    def project(
-        self, activations: torch.Tensor, strength_multiplier: float = 1.0
-    ) -> torch.Tensor:
-        """Projects activations using orthogonal decomposition.
-
-        Decomposes activations into components parallel and orthogonal to steering direction,
-        then recombines with optional scaling of parallel component.
-
-        Args:
-            activations: Input activations to project, shape (d,)
-            strength_multiplier: Scaling factor for parallel component
-
-        Returns:
-            Projected activations = (I-P)h + strength*Ph, shape (d,)
-        """
-        P = self.get_P()
-        orthogonal_complement = self.get_orthogonal_complement()
-        # use same dtype as activations
-        orthogonal_complement = orthogonal_complement.to(activations.dtype)
-        P = P.to(activations.dtype)
-        return torch.matmul(
-            activations, orthogonal_complement.T
-        ) + strength_multiplier * torch.matmul(activations, P.T)
+            coeff = strength_multiplier * feature.strength
+            vectors_by_hook[hook_name].append((steering_vector, coeff))
+
+        deltas: dict[str, torch.Tensor] = {}
+        projectors: dict[str, list[tuple[RankOneProjector, float]]] = {}
+        for hook_name, vectors in vectors_by_hook.items():
+            if steer_method == NPSteerMethod.SIMPLE_ADDITIVE:
+                delta = sum(
+                    coeff * steering_vector for steering_vector, coeff in vectors
+                )
+                deltas[hook_name] = delta.to(model_cfg.dtype)  # type: ignore
+            elif steer_method == NPSteerMethod.ORTHOGONAL_DECOMP:
+                projectors[hook_name] = [
+                    (RankOneProjector(steering_vector), coeff)
+                    for steering_vector, coeff in vectors
+                ]
+
+        logger.info(
+            f"Compiled the steering of {len(features)} features "
+            f"into {len(vectors_by_hook)} hooks"
+        )
+        steered_rows = [steer_type == NPSteerType.STEERED for steer_type in steer_types]
+        return cls(steer_method, steered_rows, deltas, projectors, position_mask)
+
+    def get_hook_names(self) -> list[str]:
+        return list(self.deltas) + list(self.projectors)
+
+    def get_key(self) -> str:
+        """A hash of the steering, e.g. to only reuse state computed with the same one."""
+        key = hashlib.sha256(f"{self.steer_method} {self.steered_rows}".encode())
+        if not any(self.steered_rows):
+            # nothing is steered, so the features don't matter
+            return key.hexdigest()
+        for hook_name in sorted(self.deltas):
+            key.update(hook_name.encode())
+            key.update(get_tensor_bytes(self.deltas[hook_name]))
+        for hook_name in sorted(self.projectors):
+            for projector, coeff in self.projectors[hook_name]:
+                key.update(f"{hook_name} {coeff}".encode())
+                key.update(get_tensor_bytes(projector.steering_vector))
+        return key.hexdigest()
+
+    def get_first_layer(self) -> int:
+        """The first layer that is steered. Nothing below it differs between rows."""
+        layers = [get_hook_layer(hook_name) for hook_name in self.get_hook_names()]
+        if not layers or any(layer is None for layer in layers):
+            return 0
+        return min(layers)  # type: ignore
+
+    def get_scale(self, activations: torch.Tensor) -> torch.Tensor:
+        """How much to steer each row (and position), [batch, pos or 1, 1, ...]."""
+        key = (activations.device, activations.dtype)
+        if key not in self._row_scales:
+            self._row_scales[key] = torch.tensor(
+                self.steered_rows, dtype=activations.dtype, device=activations.device
+            ).unsqueeze(1)
+        scale = self._row_scales[key]
+        position_mask = (
+            self.position_mask(activations.shape[1])
+            if self.position_mask is not None
+            else None
+        )
+        if position_mask is not None:
+            scale = scale * position_mask.to(activations.device, activations.dtype)
+        return scale.view(*scale.shape, *([1] * (activations.dim() - 2)))
+
+    def steer(self, activations: torch.Tensor, hook: Any) -> torch.Tensor:
+        scale = self.get_scale(activations)
+        if hook.name in self.deltas:
+            activations += scale * self.deltas[hook.name]
+        for projector, coeff in self.projectors.get(hook.name, []):
+            projected = projector.project(activations, coeff)
+            activations = torch.where(scale > 0, projected, activations)
+        return activations
+
+    def get_fwd_hooks(self) -> list[tuple[str, Callable]]:
+        """One hook per steered hook point, e.g. for model.hooks(fwd_hooks=...)."""
+        return [(hook_name, self.steer) for hook_name in self.get_hook_names()]
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+
+class Replica:
+    """A copy of the model on one device, with its own SAEs, batcher and request lock."""
+
+    def __init__(
+        self,
+        index: int,
+        device: str,
+        model: Any,
+        sae_manager: Any,
+        activation_cache: Any,
+        forward_batcher: Any,
+    ):
+        self.index = index
+        self.device = device
+        self.model = model
+        self.sae_manager = sae_manager
+        self.activation_cache = activation_cache
+        self.forward_batcher = forward_batcher
+        self.lock = asyncio.Lock()
+        self.in_flight = 0
+        self.requests = 0
+
+    def get_status(self) -> dict[str, Any]:
+        return {
+            "index": self.index,
+            "device": self.device,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "loaded_saes": len(self.sae_manager.loaded_saes),
+        }
+
+
+# the replica serving the current request. The singletons' get_instance() return that
+# replica's model, SAEManager, etc. instead of the global ones while it's set.
+current_replica: ContextVar[Replica | None] = ContextVar("current_replica", default=None)
+
+
+def get_current_replica() -> Replica | None:
+    return current_replica.get()
+
+
+class ReplicaPool:
+    """Routes each request to the least busy of several model replicas.
+
+    Each replica serializes its own requests, so N replicas on N devices serve up to N
+    requests at once. Only created when the server runs more than one replica.
+    """
+
+    _instance = None  # Class variable to store the singleton instance
+
+    def __init__(self, replicas: list[Replica]):
+        self.replicas = replicas
+
+    def acquire(self) -> Replica:
+        """Take a replica for a request, until it's released."""
+        # an idle replica if there is one, spreading the requests between them
+        replica = min(
+            self.replicas, key=lambda replica: (replica.in_flight, replica.requests)
+        )
+        replica.in_flight += 1
+        replica.requests += 1
+        return replica
+
+    def release(self, replica: Replica) -> None:
+        replica.in_flight -= 1
+
+    @contextmanager
+    def use(self) -> Iterator[Replica]:
+        """Serve the current request with a replica."""
+        replica = self.acquire()
+        token = current_replica.set(replica)
+        try:
+            yield replica
+        finally:
+            current_replica.reset(token)
+            self.release(replica)
+
+    def get_status(self) -> list[dict[str, Any]]:
+        return [replica.get_status() for replica in self.replicas]
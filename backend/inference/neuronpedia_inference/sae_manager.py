@@ -1,17 +1,29 @@
 import logging
+import os
 import time
-from collections import OrderedDict
-from typing import Any
-
-from neuronpedia_inference.config import (
-    Config,
-    get_sae_lens_ids_from_neuronpedia_id,
-    get_saelens_neuronpedia_directory_df,
+from collections import OrderedDict, deque
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, TypeVar
+
+import torch
+
+from neuronpedia_inference.config import Config, SaeLensDirectory
+from neuronpedia_inference.replicas import get_current_replica
+from neuronpedia_inference.saes.saelens import (  # type: ignore
+    SaeLensSAE,
+    get_compiled_sae_path,
 )
-from neuronpedia_inference.saes.saelens import SaeLensSAE  # type: ignore
+
+if TYPE_CHECKING:
+    from neuronpedia_inference.inference_utils.device_placement import (
+        DevicePlacement,
+    )
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
 # TODO: this should be in SAELens
 # if we find this in the neuronpedia ID, we enable DFA
 DFA_ENABLED_NP_ID_SEGMENT = "-att-"
@@ -23,6 +35,35 @@ class SAE_TYPE:
     SAELENS = "saelens-1"
 
 
+def is_dfa_enabled_neuronpedia_id(neuronpedia_id: str | None) -> bool:
+    # TODO: this should be in SAELens
+    return neuronpedia_id is not None and (
+        DFA_ENABLED_NP_ID_SEGMENT in neuronpedia_id
+        or DFA_ENABLED_NP_ID_SEGMENT_ALT in neuronpedia_id
+    )
+
+
+def get_sae_bytes(sae: Any) -> int:
+    """Get the memory taken by an SAE's parameters and buffers (0 if it isn't a module)."""
+    if not isinstance(sae, torch.nn.Module):
+        return 0
+    return sum(
+        tensor.numel() * tensor.element_size()
+        for tensor in [*sae.parameters(), *sae.buffers()]
+    )
+
+
+def format_bytes(n_bytes: int) -> str:
+    return f"{n_bytes / 1024**2:.1f} MB"
+
+
+def timed_call(fn: Callable[..., T], *args: Any) -> tuple[T, float]:
+    """Call `fn` and also return how many seconds it took."""
+    start_time = time.time()
+    result = fn(*args)
+    return result, time.time() - start_time
+
+
 class SAEManager:
     NEURONS_SOURCESET = "neurons"
 
@@ -31,6 +72,9 @@ class SAEManager:
     @classmethod
     def get_instance(cls):
         """Get the global SAEManager instance, creating it if it doesn't exist"""
+        replica = get_current_replica()
+        if replica is not None:
+            return replica.sae_manager
         if cls._instance is None:
             cls._instance = SAEManager()
         return cls._instance
@@ -39,16 +83,34 @@ class SAEManager:
         self,
         num_layers: int = 0,
         device: str = "cuda",
+        device_placement: "DevicePlacement | None" = None,
     ):
         self.config = Config.get_instance()
+        self.sae_directory = SaeLensDirectory.get_instance()
         self.num_layers = num_layers
         self.device = device
+        # when the model is split across devices, each SAE goes on its layer's device
+        self.device_placement = device_placement
         self.max_loaded_saes = self.config.max_loaded_saes
+        # 0 means there is no memory budget, only the max_loaded_saes limit
+        self.sae_memory_budget_bytes = self.config.sae_memory_budget_bytes
+        # SAEs evicted from the device are demoted to host memory, then to disk, so that
+        # they don't have to be loaded and folded from scratch again. 0 / None disables
+        # the host / disk tier.
+        self.sae_host_memory_budget_bytes = self.config.sae_host_memory_budget_bytes
+        self.sae_disk_cache_dir = self.config.sae_disk_cache_dir
+        # SAEs compiled ahead of time are loaded from here instead of from SAELens
+        self.sae_compiled_dir = self.config.sae_compiled_dir
 
         self.sae_data = {}  # New consolidated dictionary
         self.sae_set_to_saes = {}
         self.valid_sae_sets = []
         self.loaded_saes = OrderedDict()  # Keep track of loaded SAEs
+        self.host_saes = OrderedDict()  # SAEs demoted to host memory, in LRU order
+        # SAEs being loaded into host memory in the background, ahead of their use
+        self.sae_prefetch_count = self.config.sae_prefetch_count
+        self.prefetching: OrderedDict[str, Future[tuple[Any, str]]] = OrderedDict()
+        self._prefetch_executor: ThreadPoolExecutor | None = None
         # self.load_saes()
 
     def load_saes(self):
@@ -65,81 +127,376 @@ class SAEManager:
 
         starting_saes = self.get_starting_saes(all_sae_ids)
 
-        # Load and immediately unload all SAEs not in starting_saes
-        for sae_id in all_sae_ids:
-            if sae_id not in starting_saes:
-                self.load_sae(
-                    (
-                        self.config.custom_hf_model_id
-                        if self.config.custom_hf_model_id
-                        else self.config.model_id
-                    ),
-                    sae_id,
+        model_id = (
+            self.config.custom_hf_model_id
+            if self.config.custom_hf_model_id
+            else self.config.model_id
+        )
+        registered_saes = [
+            sae_id for sae_id in all_sae_ids if sae_id not in starting_saes
+        ]
+
+        # Reading configs and weights is mostly I/O, so it runs on a pool of workers.
+        # The manager's state is only updated here, in order, once each one is done.
+        start_time = time.time()
+        load_seconds = 0.0
+        workers = max(1, self.config.sae_load_workers)
+
+        # Only `workers` starting SAEs are loaded at a time, so that the ones we haven't
+        # added yet don't pile up, and no more are loaded once the next one (assumed to
+        # be as large as the largest so far) wouldn't fit the memory budget.
+        to_load = deque(starting_saes)
+        weight_futures: OrderedDict[str, Future[tuple[tuple[Any, str], float]]] = (
+            OrderedDict()
+        )
+        largest_bytes = 0
+
+        def submit_weight_loads() -> None:
+            while (
+                to_load
+                and len(weight_futures) < workers
+                and not self._is_over_budget((len(weight_futures) + 1) * largest_bytes)
+            ):
+                sae_id = to_load.popleft()
+                weight_futures[sae_id] = executor.submit(
+                    timed_call, self._load_sae_weights, model_id, sae_id
                 )
-                self.unload_sae(sae_id)
 
-        # Load starting SAEs
-        for sae_id in starting_saes:
-            self.load_sae(
-                (
-                    self.config.custom_hf_model_id
-                    if self.config.custom_hf_model_id
-                    else self.config.model_id
-                ),
-                sae_id,
-            )
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            metadata_futures = {
+                sae_id: executor.submit(self._load_sae_metadata, model_id, sae_id)
+                for sae_id in registered_saes
+            }
+            submit_weight_loads()
+
+            # Only register the metadata of SAEs not in starting_saes, their weights
+            # are loaded on first use.
+            for sae_id, future in metadata_futures.items():
+                self._register_sae(model_id, sae_id, future)
+
+            # Load starting SAEs
+            while weight_futures:
+                sae_id, future = weight_futures.popitem(last=False)
+                (loaded_sae, hook_name), seconds = future.result()
+                load_seconds += seconds
+                sae_bytes = get_sae_bytes(loaded_sae)
+                largest_bytes = max(largest_bytes, sae_bytes)
+                if self.loaded_saes and self._is_over_budget(sae_bytes):
+                    # it was already loading when the budget filled up
+                    self._add_registered_sae(
+                        sae_id,
+                        {
+                            "hook_name": hook_name,
+                            "prepend_bos": loaded_sae.cfg.metadata.prepend_bos,
+                            "neuronpedia_id": loaded_sae.cfg.metadata.neuronpedia_id,
+                        },
+                    )
+                else:
+                    self._add_loaded_sae(sae_id, loaded_sae, hook_name)
+                    logger.info(
+                        f"Successfully loaded SAE: {sae_id} in {seconds:.2f} seconds"
+                    )
+                submit_weight_loads()
+
+            # the starting SAEs that don't fit the memory budget are only registered
+            if to_load:
+                logger.info(
+                    f"Only registering the last {len(to_load)} starting SAEs, they "
+                    f"don't fit in {format_bytes(self.sae_memory_budget_bytes)}"
+                )
+            metadata_futures = {
+                sae_id: executor.submit(self._load_sae_metadata, model_id, sae_id)
+                for sae_id in to_load
+            }
+            for sae_id, future in metadata_futures.items():
+                self._register_sae(model_id, sae_id, future)
 
-        logger.info(f"Loaded {len(self.loaded_saes)} SAEs")
+        logger.info(
+            f"Loaded {len(self.loaded_saes)} SAEs in {time.time() - start_time:.2f} "
+            f"seconds ({load_seconds:.2f} seconds of loading across {workers} workers)"
+        )
 
         self.print_sae_status()
 
     def get_starting_saes(self, all_sae_ids: list[str]) -> list[str]:
         return all_sae_ids[: (self.max_loaded_saes)]
 
+    def _load_sae_metadata(self, model_id: str, sae_id: str) -> dict[str, Any]:
+        """Read an SAE's metadata from its config, without loading its weights."""
+        # doesn't touch the manager's state, so that it can run on a worker thread
+        compiled_path = self._get_compiled_sae_path(model_id, sae_id)
+        if compiled_path is not None:
+            return SaeLensSAE.load_compiled_metadata(compiled_path)
+
+        sae_lens_release, sae_lens_id = self.sae_directory.get_sae_lens_ids(
+            model_id=model_id, neuronpedia_id=sae_id
+        )
+        return SaeLensSAE.load_metadata(sae_lens_release, sae_lens_id)
+
+    def _get_compiled_sae_path(self, model_id: str, sae_id: str) -> str | None:
+        """Get the path of an SAE compiled with compile_saes, if it has been."""
+        if self.sae_compiled_dir is None:
+            return None
+        path = get_compiled_sae_path(self.sae_compiled_dir, model_id, sae_id)
+        return path if SaeLensSAE.is_compiled(path) else None
+
+    def _register_sae(
+        self, model_id: str, sae_id: str, metadata_future: Future[dict[str, Any]]
+    ) -> None:
+        # if we can't read an SAE's config on its own, we fall back to loading and
+        # immediately unloading it
+        try:
+            self._add_registered_sae(sae_id, metadata_future.result())
+        except Exception as e:
+            logger.warning(f"Couldn't read the metadata of SAE {sae_id}: {e}")
+            self.load_sae(model_id, sae_id)
+            self.unload_sae(sae_id)
+
+    def _add_registered_sae(self, sae_id: str, metadata: dict[str, Any]) -> None:
+        # like _add_loaded_sae, only the config's neuronpedia_id enables DFA
+        neuronpedia_id = metadata["neuronpedia_id"]
+        self.sae_data[sae_id] = {
+            "sae": None,
+            "hook": metadata["hook_name"],
+            "prepend_bos": metadata["prepend_bos"],
+            "neuronpedia_id": neuronpedia_id,
+            "type": SAE_TYPE.SAELENS,
+            "dfa_enabled": is_dfa_enabled_neuronpedia_id(neuronpedia_id),
+            "transcoder": False,
+            "residency": None,
+        }
+        logger.info(f"Registered SAE: {sae_id}")
+
+    @property
+    def loaded_bytes(self) -> int:
+        return sum(self.sae_data[sae_id].get("bytes", 0) for sae_id in self.loaded_saes)
+
+    @property
+    def host_bytes(self) -> int:
+        return sum(self.sae_data[sae_id].get("bytes", 0) for sae_id in self.host_saes)
+
+    def _is_over_budget(self, incoming_bytes: int = 0) -> bool:
+        return (
+            self.sae_memory_budget_bytes > 0
+            and self.loaded_bytes + incoming_bytes > self.sae_memory_budget_bytes
+        )
+
+    def evict_saes(self, keep_sae_id: str | None = None, incoming_bytes: int = 0):
+        """Unload least recently used SAEs until we're within the count and memory limits.
+
+        `incoming_bytes` makes room for an SAE that's about to be loaded, and `keep_sae_id`
+        is never evicted, so that an SAE larger than the budget can still be used alone.
+        """
+        while self.loaded_saes:
+            lru_sae = next(iter(self.loaded_saes))
+            if lru_sae == keep_sae_id:
+                break
+            incoming_count = 1 if incoming_bytes else 0
+            if len(self.loaded_saes) + incoming_count <= self.max_loaded_saes and (
+                not self._is_over_budget(incoming_bytes)
+            ):
+                break
+            logger.info(
+                "Evicting SAE %s (%s loaded, %s / %s)",
+                lru_sae,
+                len(self.loaded_saes),
+                format_bytes(self.loaded_bytes),
+                format_bytes(self.sae_memory_budget_bytes),
+            )
+            self.demote_sae(lru_sae)
+
+    def demote_sae(self, sae_id: str) -> None:
+        """Move an SAE off the device, into host memory if we have a host tier."""
+        sae = self.sae_data.get(sae_id, {}).get("sae")
+        if self.sae_host_memory_budget_bytes <= 0 or sae is None:
+            self.unload_sae(sae_id)
+            return
+
+        start_time = time.time()
+        del self.loaded_saes[sae_id]
+        SaeLensSAE.to_host(sae)
+        self.host_saes[sae_id] = None
+        self.sae_data[sae_id]["residency"] = "host"
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        logger.info(
+            f"Demoted SAE to host memory: {sae_id} in {time.time() - start_time:.2f} seconds"
+        )
+
+        # the host tier overflows to disk
+        while self.host_saes and self.host_bytes > self.sae_host_memory_budget_bytes:
+            self._demote_host_sae(next(iter(self.host_saes)))
+
+    def _demote_host_sae(self, sae_id: str) -> None:
+        del self.host_saes[sae_id]
+        sae_data = self.sae_data[sae_id]
+        if self.sae_disk_cache_dir is None:
+            sae_data["sae"] = None
+            sae_data["residency"] = None
+            return
+
+        start_time = time.time()
+        if sae_data.get("disk_path") is None:
+            disk_path = os.path.join(
+                self.sae_disk_cache_dir,
+                self.config.override_model_id,
+                sae_id.replace("/", "__"),
+            )
+            SaeLensSAE.save_to_disk(sae_data["sae"], disk_path)
+            sae_data["disk_path"] = disk_path
+        sae_data["sae"] = None
+        sae_data["residency"] = "disk"
+        logger.info(
+            f"Demoted SAE to disk: {sae_id} in {time.time() - start_time:.2f} seconds"
+        )
+
+    def _promote_sae(self, sae_id: str) -> bool:
+        """Move an SAE from the host or disk tier back to the device, if it's in one."""
+        sae_data = self.sae_data.get(sae_id, {})
+        device = self.get_sae_device(sae_id)
+        if sae_id in self.host_saes:
+            del self.host_saes[sae_id]
+            SaeLensSAE.to_device(sae_data["sae"], device)
+        elif sae_data.get("residency") == "disk":
+            sae_data["sae"] = SaeLensSAE.load_from_disk(
+                sae_data["disk_path"], device=device, dtype=self.config.sae_dtype
+            )
+        else:
+            return False
+
+        sae_data["residency"] = device
+        self.loaded_saes[sae_id] = None
+        return True
+
     def load_sae(self, model_id: str, sae_id: str) -> None:
         start_time = time.time()
         logger.info(f"Loading SAE: {sae_id}")
 
-        sae_lens_release, sae_lens_id = get_sae_lens_ids_from_neuronpedia_id(
-            model_id=model_id,
-            neuronpedia_id=sae_id,
-            df_exploded=get_saelens_neuronpedia_directory_df(),
+        # if we've loaded this SAE before, we know its size and can make room up front
+        self.evict_saes(
+            keep_sae_id=sae_id,
+            incoming_bytes=self.sae_data.get(sae_id, {}).get("bytes", 0),
+        )
+
+        if self._promote_sae(sae_id):
+            logger.info(
+                f"Successfully promoted SAE: {sae_id} in {time.time() - start_time:.2f} seconds"
+            )
+            return
+
+        prefetch = self.prefetching.pop(sae_id, None)
+        if prefetch is not None:
+            try:
+                loaded_sae, hook_name = prefetch.result()
+            except Exception as e:
+                logger.warning(f"Prefetching SAE {sae_id} failed: {e}")
+            else:
+                SaeLensSAE.to_device(loaded_sae, self.get_device_for_hook(hook_name))
+                self._add_loaded_sae(sae_id, loaded_sae, hook_name)
+                logger.info(
+                    f"Successfully loaded prefetched SAE: {sae_id} in {time.time() - start_time:.2f} seconds"
+                )
+                return
+
+        loaded_sae, hook_name = self._load_sae_weights(model_id, sae_id)
+        self._add_loaded_sae(sae_id, loaded_sae, hook_name)
+
+        end_time = time.time()
+
+        logger.info(
+            f"Successfully loaded SAE: {sae_id} in {end_time - start_time:.2f} seconds"
+        )
+
+    def _load_sae_weights(
+        self, model_id: str, sae_id: str, device: str | None = None
+    ) -> tuple[Any, str]:
+        # doesn't touch the manager's state, so that it can run on a worker thread
+        device = device or self.get_sae_device(sae_id)
+        compiled_path = self._get_compiled_sae_path(model_id, sae_id)
+        if compiled_path is not None:
+            return SaeLensSAE.load_compiled(
+                compiled_path, device=device, dtype=self.config.sae_dtype
+            )
+
+        sae_lens_release, sae_lens_id = self.sae_directory.get_sae_lens_ids(
+            model_id=model_id, neuronpedia_id=sae_id
         )
 
-        loaded_sae, hook_name = SaeLensSAE.load(
+        return SaeLensSAE.load(
             release=sae_lens_release,
             sae_id=sae_lens_id,
-            device=self.device,
+            device=device,
             dtype=self.config.sae_dtype,
         )
 
+    def _load_sae_weights_to_host(self, model_id: str, sae_id: str) -> tuple[Any, str]:
+        loaded_sae, hook_name = self._load_sae_weights(model_id, sae_id, device="cpu")
+        SaeLensSAE.to_host(loaded_sae)
+        return loaded_sae, hook_name
+
+    def prefetch_saes(self, sae_ids: list[str]) -> None:
+        """Start loading the next few of these SAEs into host memory in the background.
+
+        Only SAEs that aren't on the device or in the host or disk tier are prefetched,
+        up to `sae_prefetch_count` at a time, counting the ones still prefetching. When
+        one of them is requested, it only has to be copied to the device. Prefetches of
+        SAEs that aren't in `sae_ids` any more are dropped. Must be called from the same
+        thread as get_sae.
+        """
+        if self.sae_prefetch_count <= 0:
+            return
+        if self._prefetch_executor is None:
+            self._prefetch_executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="sae-prefetch"
+            )
+
+        # drop the prefetches that nobody is going to ask for, so they don't pile up
+        for sae_id in list(self.prefetching):
+            if sae_id not in sae_ids:
+                self.prefetching.pop(sae_id).cancel()
+
+        model_id = (
+            self.config.custom_hf_model_id
+            if self.config.custom_hf_model_id
+            else self.config.model_id
+        )
+        for sae_id in sae_ids:
+            if len(self.prefetching) >= self.sae_prefetch_count:
+                break
+            if (
+                self.sae_data.get(sae_id, {}).get("type") != SAE_TYPE.SAELENS
+                or self.sae_data[sae_id].get("residency") is not None
+                or sae_id in self.prefetching
+            ):
+                continue
+            logger.info(f"Prefetching SAE: {sae_id}")
+            self.prefetching[sae_id] = self._prefetch_executor.submit(
+                self._load_sae_weights_to_host, model_id, sae_id
+            )
+
+    def _add_loaded_sae(self, sae_id: str, loaded_sae: Any, hook_name: str) -> None:
+        device = self.get_device_for_hook(hook_name)
+        if self.device_placement is not None:
+            # the hook wasn't known before this SAE was first loaded
+            SaeLensSAE.to_device(loaded_sae, device)
         self.sae_data[sae_id] = {
             "sae": loaded_sae,
             "hook": hook_name,
             "neuronpedia_id": loaded_sae.cfg.metadata.neuronpedia_id,
+            "prepend_bos": loaded_sae.cfg.metadata.prepend_bos,
             "type": SAE_TYPE.SAELENS,
-            # TODO: this should be in SAELens
-            "dfa_enabled": (
-                loaded_sae.cfg.metadata.neuronpedia_id is not None
-                and (
-                    DFA_ENABLED_NP_ID_SEGMENT in loaded_sae.cfg.metadata.neuronpedia_id
-                    or DFA_ENABLED_NP_ID_SEGMENT_ALT
-                    in loaded_sae.cfg.metadata.neuronpedia_id
-                )
+            "dfa_enabled": is_dfa_enabled_neuronpedia_id(
+                loaded_sae.cfg.metadata.neuronpedia_id
             ),
             "transcoder": False,  # You might want to set this based on some condition
+            "bytes": get_sae_bytes(loaded_sae),
+            "residency": device,
+            "disk_path": self.sae_data.get(sae_id, {}).get("disk_path"),
         }
 
         self.loaded_saes[sae_id] = None  # We're using OrderedDict as an OrderedSet
-        if len(self.loaded_saes) > self.max_loaded_saes:
-            lru_sae = next(iter(self.loaded_saes))
-            self.unload_sae(lru_sae)
-
-        end_time = time.time()
-
-        logger.info(
-            f"Successfully loaded SAE: {sae_id} in {end_time - start_time:.2f} seconds"
-        )
+        self.loaded_saes.move_to_end(sae_id)
+        self.evict_saes(keep_sae_id=sae_id)
 
     def unload_sae(self, sae_id: str) -> None:
         start_time = time.time()
@@ -147,10 +504,18 @@ class SAEManager:
 
         if sae_id in self.sae_data:
             self.sae_data[sae_id]["sae"] = None
+            self.sae_data[sae_id]["residency"] = None
 
         if sae_id in self.loaded_saes:
             del self.loaded_saes[sae_id]
 
+        if sae_id in self.host_saes:
+            del self.host_saes[sae_id]
+
+        # dropping our reference frees the weights, give the memory back to the device
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
         end_time = time.time()
         logger.info(
             f"Successfully unloaded SAE: {sae_id} in {end_time - start_time:.2f} seconds"
@@ -200,16 +565,48 @@ class SAEManager:
                 continue
             print(f"  {sae_set}:")
             for sae_id in sae_ids:
-                status = "Loaded" if sae_id in self.loaded_saes else "Not Loaded"
-                print(f"    - {sae_id}: {status}")
+                residency = self.sae_data.get(sae_id, {}).get("residency")
+                if sae_id in self.loaded_saes:
+                    status = f"Loaded on {residency}"
+                elif residency is not None:
+                    status = f"Cached on {residency}"
+                else:
+                    status = "Not Loaded"
+                size = format_bytes(self.sae_data.get(sae_id, {}).get("bytes", 0))
+                print(f"    - {sae_id}: {status} ({size})")
 
         print("\nCurrently Loaded SAEs:")
         for i, sae_id in enumerate(self.loaded_saes, 1):
-            print(f"  {i}. {sae_id}")
+            size = format_bytes(self.sae_data[sae_id].get("bytes", 0))
+            print(f"  {i}. {sae_id} ({size})")
 
         print(f"\nTotal Loaded: {len(self.loaded_saes)} / {self.max_loaded_saes}")
+        budget = (
+            format_bytes(self.sae_memory_budget_bytes)
+            if self.sae_memory_budget_bytes > 0
+            else "no budget"
+        )
+        print(f"Total Memory: {format_bytes(self.loaded_bytes)} / {budget}")
+        if self.sae_host_memory_budget_bytes > 0:
+            print(
+                f"Host Memory: {len(self.host_saes)} SAEs, "
+                f"{format_bytes(self.host_bytes)} / "
+                f"{format_bytes(self.sae_host_memory_budget_bytes)}"
+            )
 
     # Utility methods
+    def get_device_for_hook(self, hook_name: str) -> str:
+        if self.device_placement is None:
+            return self.device
+        return self.device_placement.get_device_for_hook(hook_name)
+
+    def get_sae_device(self, sae_id: str) -> str:
+        """Get the device an SAE is (or will be) loaded on, i.e. the device of its layer."""
+        hook_name = self.sae_data.get(sae_id, {}).get("hook")
+        if hook_name is None:
+            return self.device
+        return self.get_device_for_hook(hook_name)
+
     def get_sae_type(self, sae_id: str) -> str:
         return self.sae_data.get(sae_id, {}).get("type")
 
@@ -1,7 +1,16 @@
+import json
+import os
+from collections.abc import Iterator
 from typing import Any
 
 import torch
+from sae_lens.loading.pretrained_sae_loaders import (
+    SAEConfigLoadOptions,
+    get_sae_config,
+)
+from sae_lens.saes.jumprelu_sae import JumpReLUSAE
 from sae_lens.saes.sae import SAE
+from sae_lens.saes.standard_sae import StandardSAE
 
 from neuronpedia_inference.saes.base import BaseSAE
 
@@ -11,6 +20,21 @@ DTYPE_MAP = {
     "bfloat16": torch.bfloat16,
 }
 
+# number of features encoded at once by the chunked encoders
+ENCODE_CHUNK_SIZE = 16384
+
+# SAEs whose features only depend on their own encoder column, so they can be encoded
+# in chunks over d_sae. Other architectures (e.g. topk) fall back to a dense encode.
+CHUNKED_ENCODE_SAE_TYPES = (StandardSAE, JumpReLUSAE)
+
+# written next to the weights of a compiled SAE, so its metadata can be read without
+# looking it up in the SAELens directory
+COMPILED_METADATA_FILENAME = "neuronpedia_metadata.json"
+
+
+def get_compiled_sae_path(compiled_dir: str, model_id: str, sae_id: str) -> str:
+    return os.path.join(compiled_dir, model_id, sae_id.replace("/", "__"))
+
 
 class SaeLensSAE(BaseSAE):
     @staticmethod
@@ -25,3 +49,200 @@ class SaeLensSAE(BaseSAE):
         loaded_sae.eval()
 
         return loaded_sae, loaded_sae.cfg.metadata.hook_name
+
+    @staticmethod
+    def load_metadata(release: str, sae_id: str) -> dict[str, Any]:
+        """Read an SAE's hook name, prepend_bos and neuronpedia_id without its weights."""
+        cfg_dict = get_sae_config(release, sae_id=sae_id, options=SAEConfigLoadOptions())
+        # depending on the loader, the metadata is either flat or nested
+        metadata = {**cfg_dict, **(cfg_dict.get("metadata") or {})}
+        if metadata.get("hook_name") is None:
+            raise ValueError(f"No hook_name in the config of {release}/{sae_id}")
+        return {
+            "hook_name": metadata["hook_name"],
+            "prepend_bos": metadata.get("prepend_bos", True),
+            "neuronpedia_id": metadata.get("neuronpedia_id"),
+        }
+
+    @staticmethod
+    def to_host(sae: Any) -> None:
+        """Move an SAE to (pinned, if we have a GPU) host memory, in place."""
+        sae.to("cpu")
+        if torch.cuda.is_available():
+            for tensor in [*sae.parameters(), *sae.buffers()]:
+                tensor.data = tensor.data.pin_memory()
+
+    @staticmethod
+    def to_device(sae: Any, device: str) -> None:
+        """Move an SAE back to the device, in place.
+
+        The copy is non-blocking from pinned memory. It is queued on the same stream as the
+        work that uses the SAE afterwards, so nothing reads the weights before they arrive.
+        """
+        sae.to(device, non_blocking=True)
+
+    @staticmethod
+    def save_to_disk(sae: Any, path: str) -> None:
+        # the weights are saved as they are, i.e. already folded and in the SAE's dtype
+        sae.save_model(path)
+
+    @staticmethod
+    def load_from_disk(path: str, device: str, dtype: str) -> Any:
+        """Load an SAE saved with save_to_disk, without folding it again."""
+        loaded_sae = SAE.load_from_disk(path, device=device, dtype=dtype)
+        loaded_sae.eval()
+        return loaded_sae
+
+    @staticmethod
+    def compile(release: str, sae_id: str, path: str, dtype: str) -> None:
+        """Save an SAE folded and in `dtype`, so that it can be loaded with load_compiled.
+
+        The weights are written as safetensors, which are memory mapped when read back.
+        """
+        loaded_sae, hook_name = SaeLensSAE.load(release, sae_id, "cpu", dtype)
+        SaeLensSAE.save_to_disk(loaded_sae, path)
+        metadata = {
+            "release": release,
+            "sae_lens_id": sae_id,
+            "dtype": dtype,
+            "hook_name": hook_name,
+            "prepend_bos": loaded_sae.cfg.metadata.prepend_bos,
+            "neuronpedia_id": loaded_sae.cfg.metadata.neuronpedia_id,
+        }
+        with open(os.path.join(path, COMPILED_METADATA_FILENAME), "w") as f:
+            json.dump(metadata, f, indent=2)
+
+    @staticmethod
+    def is_compiled(path: str) -> bool:
+        return os.path.isfile(os.path.join(path, COMPILED_METADATA_FILENAME))
+
+    @staticmethod
+    def load_compiled_metadata(path: str) -> dict[str, Any]:
+        """Read the metadata of a compiled SAE, in the same format as load_metadata."""
+        with open(os.path.join(path, COMPILED_METADATA_FILENAME)) as f:
+            metadata = json.load(f)
+        return {
+            "hook_name": metadata["hook_name"],
+            "prepend_bos": metadata["prepend_bos"],
+            "neuronpedia_id": metadata["neuronpedia_id"],
+        }
+
+    @staticmethod
+    def load_compiled(path: str, device: str, dtype: str) -> tuple[Any, str]:
+        """Load an SAE written by compile. It's already folded, so it's only moved to the
+        device (and cast, if it was compiled with another dtype)."""
+        metadata = SaeLensSAE.load_compiled_metadata(path)
+        loaded_sae = SaeLensSAE.load_from_disk(path, device=device, dtype=dtype)
+        loaded_sae.cfg.metadata.hook_name = metadata["hook_name"]
+        loaded_sae.cfg.metadata.prepend_bos = metadata["prepend_bos"]
+        loaded_sae.cfg.metadata.neuronpedia_id = metadata["neuronpedia_id"]
+        return loaded_sae, metadata["hook_name"]
+
+    @staticmethod
+    @torch.no_grad()
+    def encode_chunks(
+        sae: Any, x: torch.Tensor, chunk_size: int = ENCODE_CHUNK_SIZE
+    ) -> Iterator[tuple[int, torch.Tensor]]:
+        """Encode `x` one block of features at a time.
+
+        Yields (start, feature_acts[..., start : start + chunk_size]), so that the dense
+        [..., d_sae] output never has to be allocated at once.
+        """
+        if type(sae) not in CHUNKED_ENCODE_SAE_TYPES:
+            feature_acts = sae.encode(x)
+            for start in range(0, feature_acts.shape[-1], chunk_size):
+                yield start, feature_acts[..., start : start + chunk_size]
+            return
+
+        sae_in = sae.process_sae_in(x)
+        d_sae = sae.W_enc.shape[1]
+        for start in range(0, d_sae, chunk_size):
+            features = slice(start, min(start + chunk_size, d_sae))
+            yield start, SaeLensSAE._encode_features(sae, sae_in, features)
+
+    @staticmethod
+    @torch.no_grad()
+    def encode_features(
+        sae: Any, x: torch.Tensor, indices: list[int] | torch.Tensor
+    ) -> torch.Tensor:
+        """Encode only the given features of `x`, returning [..., len(indices)]."""
+        if type(sae) not in CHUNKED_ENCODE_SAE_TYPES:
+            return sae.encode(x)[..., indices]
+        return SaeLensSAE._encode_features(sae, sae.process_sae_in(x), indices)
+
+    @staticmethod
+    def _encode_features(
+        sae: Any, sae_in: torch.Tensor, features: slice | list[int] | torch.Tensor
+    ) -> torch.Tensor:
+        hidden_pre = sae_in @ sae.W_enc[:, features] + sae.b_enc[features]
+        feature_acts = sae.activation_fn(hidden_pre)
+        if isinstance(sae, JumpReLUSAE):
+            feature_acts = feature_acts * (hidden_pre > sae.threshold[features])
+        return feature_acts
+
+    @staticmethod
+    @torch.no_grad()
+    def encode_stats(
+        sae: Any,
+        x: torch.Tensor,
+        sum_positions: list[int],
+        chunk_size: int = ENCODE_CHUNK_SIZE,
+    ) -> dict[str, torch.Tensor]:
+        """Get per-feature and per-position statistics of the feature activations of `x`.
+
+        `x` is [batch, pos, d_in]. Returns the max over positions, its position, and the
+        sum over `sum_positions` of every feature ([batch, d_sae] each), and the number of
+        active features at every position ([batch, pos]). The statistics are accumulated
+        chunk by chunk, so the dense [batch, pos, d_sae] activations are never held.
+        """
+        max_values: list[torch.Tensor] = []
+        max_indices: list[torch.Tensor] = []
+        sum_values: list[torch.Tensor] = []
+        nonzero_counts = torch.zeros(x.shape[:2], dtype=torch.long, device=x.device)
+        for _, feature_acts in SaeLensSAE.encode_chunks(sae, x, chunk_size):
+            chunk_max_values, chunk_max_indices = torch.max(feature_acts, dim=1)
+            max_values.append(chunk_max_values)
+            max_indices.append(chunk_max_indices)
+            if sum_positions:
+                sum_values.append(feature_acts[:, sum_positions].sum(dim=1))
+            else:
+                sum_values.append(torch.zeros_like(chunk_max_values))
+            nonzero_counts += (feature_acts > 0).sum(dim=-1).to(nonzero_counts.device)
+        return {
+            "max_values": torch.cat(max_values, dim=-1),
+            "max_indices": torch.cat(max_indices, dim=-1),
+            "sum_values": torch.cat(sum_values, dim=-1),
+            "nonzero_counts": nonzero_counts,
+        }
+
+    @staticmethod
+    @torch.no_grad()
+    def encode_topk(
+        sae: Any, x: torch.Tensor, k: int, chunk_size: int = ENCODE_CHUNK_SIZE
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """Get the top k feature activations of every position of `x`.
+
+        Returns (values, indices), both [..., k] and sorted by value, keeping a running
+        top k over the feature chunks instead of encoding to a dense [..., d_sae] tensor.
+        """
+        top_values: torch.Tensor | None = None
+        top_indices: torch.Tensor | None = None
+        for start, feature_acts in SaeLensSAE.encode_chunks(sae, x, chunk_size):
+            chunk_values, chunk_indices = torch.topk(
+                feature_acts, k=min(k, feature_acts.shape[-1]), dim=-1
+            )
+            chunk_indices = chunk_indices + start
+            if top_values is not None and top_indices is not None:
+                chunk_values = torch.cat((top_values, chunk_values), dim=-1)
+                chunk_indices = torch.cat((top_indices, chunk_indices), dim=-1)
+            top_values, positions = torch.topk(
+                chunk_values, k=min(k, chunk_values.shape[-1]), dim=-1
+            )
+            top_indices = torch.gather(chunk_indices, -1, positions)
+        if top_values is None or top_indices is None:
+            raise ValueError("Can't encode with an SAE that has no features")
+        if top_values.shape[-1] < k:
+            raise ValueError(
+                f"Requested top {k} features, but the SAE only has {top_values.shape[-1]}"
+            )
+        return top_values, top_indices
@@ -4,46 +4,29 @@ import json
 import logging
 import os
 import sys
+import time
 import traceback
-from collections.abc import Awaitable
-from typing import Callable
+from collections.abc import Awaitable, Iterator
+from contextlib import contextmanager
+from typing import Any, Callable
 
-import sentry_sdk
-import torch
 from dotenv import load_dotenv
 from fastapi import APIRouter, FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
-from transformer_lens import HookedTransformer
-from transformer_lens.hook_points import HookPoint
-from transformers import AutoModelForCausalLM, AutoTokenizer
-
-from neuronpedia_inference.args import list_available_options, parse_env_and_args
-from neuronpedia_inference.config import Config, get_saelens_neuronpedia_directory_df
-from neuronpedia_inference.endpoints.activation.all import (
-    router as activation_all_router,
-)
-from neuronpedia_inference.endpoints.activation.single import (
-    router as activation_single_router,
-)
-from neuronpedia_inference.endpoints.activation.topk_by_token import (
-    router as activation_topk_by_token_router,
-)
-from neuronpedia_inference.endpoints.steer.completion import (
-    router as steer_completion_router,
-)
-from neuronpedia_inference.endpoints.steer.completion_chat import (
-    router as steer_completion_chat_router,
-)
-from neuronpedia_inference.endpoints.tokenize import router as tokenize_router
-from neuronpedia_inference.endpoints.util.sae_topk_by_decoder_cossim import (
-    router as sae_topk_by_decoder_cossim_router,
+from psutil import Process
+
+from neuronpedia_inference.args import (
+    get_available_device,
+    list_available_options,
+    parse_env_and_args,
 )
-from neuronpedia_inference.endpoints.util.sae_vector import router as sae_vector_router
+from neuronpedia_inference.config import Config, SaeLensDirectory
 from neuronpedia_inference.logging import initialize_logging
-from neuronpedia_inference.sae_manager import SAEManager  # noqa: F401
-from neuronpedia_inference.shared import STR_TO_DTYPE, Model  # noqa: F401
-from neuronpedia_inference.utils import checkCudaError
+from neuronpedia_inference.replicas import Replica, ReplicaPool, current_replica
+
+# torch, transformer_lens, transformers, sae_lens and the endpoints are only imported by
+# initialize, in the background, so that the app can answer /health as soon as possible
 
 # Initialize logging at module level
 initialize_logging()
@@ -56,6 +39,9 @@ load_dotenv()
 global initialized
 initialized = False
 
+# how long each phase of the startup took, in seconds, in the order they ran
+startup_timings: dict[str, float] = {}
+
 app = FastAPI()
 
 # Add CORS middleware
@@ -70,10 +56,26 @@ app.add_middleware(
 args = parse_env_and_args()
 
 
+def record_startup_phase(name: str, start_time: float) -> None:
+    startup_timings[name] = round(time.time() - start_time, 3)
+    logger.info(f"Startup phase {name} took {startup_timings[name]:.2f} seconds")
+
+
+@contextmanager
+def startup_phase(name: str) -> Iterator[None]:
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        record_startup_phase(name, start_time)
+
+
 # we have to initialize SAE's AFTER server startup, because some infrastructure providers require
 # our server to respond to health checks within a few minutes of starting up
 @app.on_event("startup")  # pyright: ignore[reportDeprecated]
 async def startup_event():
+    # from the process starting to the app being able to answer requests
+    record_startup_phase("server", Process().create_time())
     logger.info("Starting initialization...")
     # Wait briefly to ensure server is ready
     await asyncio.sleep(3)
@@ -82,23 +84,82 @@ async def startup_event():
     logger.info("Initialization started")
 
 
-v1_router = APIRouter(prefix="/v1")
+def get_v1_router() -> APIRouter:
+    """Import the endpoints, and everything they use, into a router."""
+    from neuronpedia_inference.endpoints.activation.all import (
+        router as activation_all_router,
+    )
+    from neuronpedia_inference.endpoints.activation.single import (
+        router as activation_single_router,
+    )
+    from neuronpedia_inference.endpoints.activation.topk_by_token import (
+        router as activation_topk_by_token_router,
+    )
+    from neuronpedia_inference.endpoints.steer.completion import (
+        router as steer_completion_router,
+    )
+    from neuronpedia_inference.endpoints.steer.completion_chat import (
+        router as steer_completion_chat_router,
+    )
+    from neuronpedia_inference.endpoints.tokenize import router as tokenize_router
+    from neuronpedia_inference.endpoints.util.sae_topk_by_decoder_cossim import (
+        router as sae_topk_by_decoder_cossim_router,
+    )
+    from neuronpedia_inference.endpoints.util.sae_vector import (
+        router as sae_vector_router,
+    )
 
-v1_router.include_router(activation_all_router)
-v1_router.include_router(steer_completion_chat_router)
-v1_router.include_router(steer_completion_router)
-v1_router.include_router(activation_single_router)
-v1_router.include_router(activation_topk_by_token_router)
-v1_router.include_router(sae_topk_by_decoder_cossim_router)
-v1_router.include_router(sae_vector_router)
-v1_router.include_router(tokenize_router)
+    v1_router = APIRouter(prefix="/v1")
 
-app.include_router(v1_router)
+    v1_router.include_router(activation_all_router)
+    v1_router.include_router(steer_completion_chat_router)
+    v1_router.include_router(steer_completion_router)
+    v1_router.include_router(activation_single_router)
+    v1_router.include_router(activation_topk_by_token_router)
+    v1_router.include_router(sae_topk_by_decoder_cossim_router)
+    v1_router.include_router(sae_vector_router)
+    v1_router.include_router(tokenize_router)
+    return v1_router
+
+
+def include_v1_router(v1_router: APIRouter) -> None:
+    """Start serving the endpoints.
+
+    Must be called on the event loop's thread, which is the one that routes requests.
+    """
+    if any(getattr(route, "path", "").startswith("/v1/") for route in app.routes):
+        return
+    app.include_router(v1_router)
+    # the schema may have been generated without the endpoints
+    app.openapi_schema = None
 
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy"}
+    startup = {
+        "phases": startup_timings,
+        "total_seconds": round(sum(startup_timings.values()), 3),
+    }
+    if not initialized:
+        return JSONResponse(
+            status_code=503,
+            content={"status": "initializing", "startup": startup},
+        )
+
+    health: dict[str, Any] = {"status": "healthy", "startup": startup}
+    # only report the caches once they exist, /health must stay cheap
+    from neuronpedia_inference.inference_utils.activation_cache import (
+        PromptActivationCache,
+    )
+    from neuronpedia_inference.inference_utils.prompt_kv_cache import PromptKVCache
+
+    if PromptActivationCache._instance is not None:
+        health["activation_cache"] = PromptActivationCache._instance.get_stats()
+    if PromptKVCache._instance is not None:
+        health["prompt_kv_cache"] = PromptKVCache._instance.get_stats()
+    if ReplicaPool._instance is not None:
+        health["replicas"] = ReplicaPool._instance.get_status()
+    return health
 
 
 @app.post("/initialize")
@@ -109,10 +170,33 @@ async def initialize(
 
     # Move the heavy operations to a separate thread pool to prevent blocking
     def load_model_and_sae():
+        with startup_phase("imports"):
+            import torch
+            from transformer_lens import HookedTransformer
+            from transformer_lens.hook_points import HookPoint
+            from transformers import AutoModelForCausalLM, AutoTokenizer
+
+            from neuronpedia_inference.inference_utils.activation_cache import (
+                PromptActivationCache,
+            )
+            from neuronpedia_inference.inference_utils.device_placement import (
+                DevicePlacement,
+            )
+            from neuronpedia_inference.inference_utils.forward_batcher import (
+                ForwardBatcher,
+            )
+            from neuronpedia_inference.sae_manager import SAEManager
+            from neuronpedia_inference.shared import STR_TO_DTYPE, Model
+            from neuronpedia_inference.utils import checkCudaError
+
+            v1_router = get_v1_router()
+
         # Validate inputs
-        df = get_saelens_neuronpedia_directory_df()
-        models = df["model"].unique()
-        sae_sets = df["neuronpedia_set"].unique()
+        # built once here, then shared by the Config and the SAEManager
+        with startup_phase("sae_directory"):
+            directory = SaeLensDirectory.get_instance()
+        models = directory.get_models()
+        sae_sets = directory.get_sets()
         if args.model_id not in models:
             logger.error(
                 f"Error: Invalid model_id '{args.model_id}'. Use --list_models to see available options."
@@ -137,13 +221,33 @@ async def initialize(
         gc.collect()
         torch.set_grad_enabled(False)
         checkCudaError("cpu")
-        # todo: use multiple devices if available
+        args.device = get_available_device()
+        # the model's layers can only be split across GPUs
         device_count = 1
+        if args.device == "cuda" and args.n_devices > 1:
+            device_count = min(args.n_devices, torch.cuda.device_count())
+            if device_count < args.n_devices:
+                logger.warning(
+                    f"Asked for {args.n_devices} devices, but only {device_count} are available"
+                )
+        # each replica gets a whole GPU, so replicas and n_devices don't mix
+        replica_devices = [args.device]
+        if args.device == "cuda" and args.n_replicas > 1:
+            n_replicas = min(args.n_replicas, torch.cuda.device_count())
+            if n_replicas < args.n_replicas:
+                logger.warning(
+                    f"Asked for {args.n_replicas} replicas, but only {n_replicas} GPUs are available"
+                )
+            replica_devices = [f"cuda:{i}" for i in range(n_replicas)]
+            if device_count > 1:
+                logger.warning("Not splitting the model across devices, using replicas")
+                device_count = 1
 
         SECRET = os.getenv("SECRET")
 
         logger.info(f"device in args: {args.device}")
         logger.info(f"device set in args: {args.device}")
+        config_start_time = time.time()
         config = Config(
             secret=SECRET,
             model_id=args.model_id,
@@ -159,12 +263,25 @@ async def initialize(
             model_from_pretrained_kwargs=args.model_from_pretrained_kwargs,
             max_loaded_saes=args.max_loaded_saes,
             nnsight=args.nnsight,
-            optimize_memory=args.optimize_memory,
             auto_clear_cache=args.auto_clear_cache,
+            batch_window_ms=args.batch_window_ms,
+            max_batch_size=args.max_batch_size,
+            activation_cache_bytes=args.activation_cache_bytes,
+            sae_memory_budget_bytes=args.sae_memory_budget_bytes,
+            sae_host_memory_budget_bytes=args.sae_host_memory_budget_bytes,
+            sae_disk_cache_dir=args.sae_disk_cache_dir,
+            sae_load_workers=args.sae_load_workers,
+            sae_prefetch_count=args.sae_prefetch_count,
+            sae_compiled_dir=args.sae_compiled_dir,
+            n_devices=device_count,
+            n_replicas=len(replica_devices),
+            prompt_kv_cache_bytes=args.prompt_kv_cache_bytes,
         )
         Config._instance = config
+        record_startup_phase("config", config_start_time)
 
         logger.info("Loading model...")
+        model_start_time = time.time()
 
         hf_model = None
         hf_tokenizer = None
@@ -176,26 +293,56 @@ async def initialize(
             )
             hf_tokenizer = AutoTokenizer.from_pretrained(custom_hf_model_id)
 
-        model = HookedTransformer.from_pretrained_no_processing(
-            (config.override_model_id if config.override_model_id else config.model_id),
-            device=args.device,
-            dtype=STR_TO_DTYPE[config.model_dtype],
-            n_devices=device_count,
-            hf_model=hf_model,
-            **({"hf_config": hf_model.config} if hf_model else {}),
-            tokenizer=hf_tokenizer,
-            **config.model_kwargs,
-        )
+        def load_model(device: str) -> HookedTransformer:
+            model = HookedTransformer.from_pretrained_no_processing(
+                (
+                    config.override_model_id
+                    if config.override_model_id
+                    else config.model_id
+                ),
+                device=device,
+                dtype=STR_TO_DTYPE[config.model_dtype],
+                n_devices=device_count,
+                hf_model=hf_model,
+                **({"hf_config": hf_model.config} if hf_model else {}),
+                tokenizer=hf_tokenizer,
+                **config.model_kwargs,
+            )
 
-        # add hook_in to mlp for transcoders
-        def add_hook_in_to_mlp(mlp):  # type: ignore
-            mlp.hook_in = HookPoint()
-            original_forward = mlp.forward
-            mlp.forward = lambda x: original_forward(mlp.hook_in(x))
+            # add hook_in to mlp for transcoders
+            def add_hook_in_to_mlp(mlp):  # type: ignore
+                mlp.hook_in = HookPoint()
+                original_forward = mlp.forward
+                mlp.forward = lambda x: original_forward(mlp.hook_in(x))
+
+            for block in model.blocks:
+                add_hook_in_to_mlp(block.mlp)
+            model.setup()
+            return model
+
+        def load_saes(
+            model: HookedTransformer, device: str
+        ) -> tuple[SAEManager, PromptActivationCache, ForwardBatcher]:
+            sae_manager = SAEManager(
+                model.cfg.n_layers,
+                device,
+                device_placement=(
+                    DevicePlacement.from_model(model) if device_count > 1 else None
+                ),
+            )
+            sae_manager.load_saes()
+            activation_cache = PromptActivationCache(
+                model_id=config.override_model_id,
+                max_bytes=config.activation_cache_bytes,
+            )
+            forward_batcher = ForwardBatcher(
+                window_ms=config.batch_window_ms,
+                max_batch_size=config.max_batch_size,
+                activation_cache=activation_cache,
+            )
+            return sae_manager, activation_cache, forward_batcher
 
-        for block in model.blocks:
-            add_hook_in_to_mlp(block.mlp)
-        model.setup()
+        model = load_model(replica_devices[0])
 
         Model._instance = model
         config.set_num_layers(model.cfg.n_layers)
@@ -217,19 +364,88 @@ async def initialize(
             config.set_steer_special_token_ids(special_token_ids)  # type: ignore
 
         logger.info(
-            f"Loaded {config.custom_hf_model_id if config.custom_hf_model_id else config.override_model_id} on {args.device}"
+            f"Loaded {config.custom_hf_model_id if config.custom_hf_model_id else config.override_model_id} on {replica_devices[0]}"
         )
         checkCudaError()
+        record_startup_phase("model", model_start_time)
 
         logger.info("Loading SAEs...")
-        SAEManager._instance = SAEManager(model.cfg.n_layers, args.device)
-        SAEManager._instance.load_saes()
+        with startup_phase("saes"):
+            (
+                SAEManager._instance,
+                PromptActivationCache._instance,
+                ForwardBatcher._instance,
+            ) = load_saes(model, replica_devices[0])
+
+        if len(replica_devices) > 1:
+            with startup_phase("replicas"):
+                replicas = [
+                    Replica(
+                        0,
+                        replica_devices[0],
+                        model,
+                        SAEManager._instance,
+                        PromptActivationCache._instance,
+                        ForwardBatcher._instance,
+                    )
+                ]
+                for index, device in enumerate(replica_devices[1:], start=1):
+                    logger.info(f"Loading replica {index} on {device}...")
+                    replica_model = load_model(device)
+                    replicas.append(
+                        Replica(
+                            index,
+                            device,
+                            replica_model,
+                            *load_saes(replica_model, device),
+                        )
+                    )
+                ReplicaPool._instance = ReplicaPool(replicas)
+
+        return v1_router
+
+    v1_router = await asyncio.get_event_loop().run_in_executor(
+        None, load_model_and_sae
+    )
+    include_v1_router(v1_router)
 
-        global initialized
-        initialized = True
-        logger.info("Initialized: %s", initialized)
+    global initialized
+    initialized = True
+    logger.info("Initialized: %s", initialized)
 
-    await asyncio.get_event_loop().run_in_executor(None, load_model_and_sae)
+
+# registered first, so that it runs last, after the request has been let through
+@app.middleware("http")
+async def route_to_replica(
+    request: Request, call_next: Callable[[Request], Awaitable[Response]]
+) -> Response:
+    pool = ReplicaPool._instance
+    if pool is None or not request.url.path.startswith("/v1/"):
+        return await call_next(request)
+
+    replica = pool.acquire()
+    token = current_replica.set(replica)
+    try:
+        response = await call_next(request)
+    except BaseException:
+        pool.release(replica)
+        raise
+    finally:
+        current_replica.reset(token)
+
+    # the endpoint is still running while its response streams, so the replica is
+    # only released once the whole body has been sent
+    body_iterator = response.body_iterator  # type: ignore[attr-defined]
+
+    async def release_after_body():
+        try:
+            async for chunk in body_iterator:
+                yield chunk
+        finally:
+            pool.release(replica)
+
+    response.body_iterator = release_after_body()  # type: ignore[attr-defined]
+    return response
 
 
 @app.middleware("http")
@@ -255,6 +471,9 @@ async def check_secret_key(
 async def check_model(
     request: Request, call_next: Callable[[Request], Awaitable[Response]]
 ) -> Response:
+    if request.url.path == "/health":
+        return await call_next(request)
+
     config = Config.get_instance()
 
     if request.method == "POST":
@@ -279,6 +498,9 @@ async def check_model(
 async def log_and_check_cuda_error(
     request: Request, call_next: Callable[[Request], Awaitable[Response]]
 ) -> Response:
+    # /health reports the startup progress itself
+    if request.url.path == "/health":
+        return await call_next(request)
     if not initialized:
         return JSONResponse(
             status_code=500,
@@ -312,6 +534,8 @@ async def generic_exception_handler(request: Request, exc: Exception):  # noqa:
 
 def main():
     if os.getenv("SENTRY_DSN"):
+        import sentry_sdk
+
         logger.info("Initializing Sentry")
         sentry_sdk.init(
             dsn=os.getenv("SENTRY_DSN"),
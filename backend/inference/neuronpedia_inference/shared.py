@@ -4,7 +4,31 @@ from functools import wraps
 import torch
 from transformer_lens import HookedTransformer
 
-request_lock = asyncio.Lock()
+from neuronpedia_inference.replicas import get_current_replica
+
+
+class RequestLock:
+    """Serializes the requests that use the model.
+
+    With a replica pool, each replica has its own lock, so requests on different
+    replicas run at the same time. Otherwise there is a single global lock.
+    """
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+
+    def _get_lock(self) -> asyncio.Lock:
+        replica = get_current_replica()
+        return replica.lock if replica is not None else self._lock
+
+    async def __aenter__(self):
+        await self._get_lock().acquire()
+
+    async def __aexit__(self, *args):  # type: ignore
+        self._get_lock().release()
+
+
+request_lock = RequestLock()
 
 
 def with_request_lock():
@@ -24,6 +48,9 @@ class Model:
 
     @classmethod
     def get_instance(cls) -> HookedTransformer:
+        replica = get_current_replica()
+        if replica is not None:
+            return replica.model
         if cls._instance is None:
             raise ValueError("Model not initialized")
         return cls._instance
@@ -93,6 +93,11 @@ def parse_args():
         action="store_true",
         help="List available models and SAE sets",
     )
+    parser.add_argument(
+        "--compile_saes",
+        action="store_true",
+        help="Compile the selected SAEs (folded and converted to sae_dtype) into --sae_compiled_dir, then exit",
+    )
     parser.add_argument(
         "--max_loaded_saes",
         type=int,
@@ -115,16 +120,83 @@ def parse_args():
         action="store_true",
         help="Use nnsight. Not all models are currently supported.",
     )
-    parser.add_argument(
-        "--optimize_memory",
-        action="store_true",
-        help="Enable memory optimizations (torch.no_grad, stop_at_layer)",
-    )
     parser.add_argument(
         "--auto_clear_cache",
         action="store_true",
         help="Automatically clear GPU cache after each request",
     )
+    parser.add_argument(
+        "--batch_window_ms",
+        type=float,
+        default=0,
+        help="How long (in ms) to collect concurrent activation requests into one batched forward pass. 0 disables batching.",
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=8,
+        help="Maximum number of activation requests to run in one batched forward pass",
+    )
+    parser.add_argument(
+        "--activation_cache_bytes",
+        type=int,
+        default=0,
+        help="Memory budget (in bytes) for caching the hook activations of recently seen prompts. 0 disables the cache.",
+    )
+    parser.add_argument(
+        "--sae_memory_budget_bytes",
+        type=int,
+        default=0,
+        help="Device memory budget (in bytes) for loaded SAEs. Least recently used SAEs are unloaded to stay within it. 0 only limits the number of loaded SAEs.",
+    )
+    parser.add_argument(
+        "--sae_host_memory_budget_bytes",
+        type=int,
+        default=0,
+        help="Host memory budget (in bytes) for SAEs evicted from the device, kept in pinned memory for fast reloads. 0 disables the host tier.",
+    )
+    parser.add_argument(
+        "--sae_disk_cache_dir",
+        type=str,
+        default=None,
+        help="Local directory for SAEs evicted from host memory, saved already folded for fast reloads. Unset disables the disk tier.",
+    )
+    parser.add_argument(
+        "--sae_load_workers",
+        type=int,
+        default=4,
+        help="Number of SAEs to load (or read the configs of) in parallel at startup",
+    )
+    parser.add_argument(
+        "--sae_prefetch_count",
+        type=int,
+        default=0,
+        help="How many of the next SAEs of an /activation/all request to load into host memory in the background. 0 disables prefetching.",
+    )
+    parser.add_argument(
+        "--sae_compiled_dir",
+        type=str,
+        default=None,
+        help="Local directory of SAEs compiled with --compile_saes (already folded and in sae_dtype). SAEs found there are loaded from it instead of from SAELens.",
+    )
+    parser.add_argument(
+        "--n_devices",
+        type=int,
+        default=1,
+        help="Number of GPUs to split the model's layers across. Each SAE is put on the GPU of its layer.",
+    )
+    parser.add_argument(
+        "--n_replicas",
+        type=int,
+        default=1,
+        help="Number of copies of the model to serve requests with, one per GPU. Each request goes to the least busy one.",
+    )
+    parser.add_argument(
+        "--prompt_kv_cache_bytes",
+        type=int,
+        default=0,
+        help="Memory budget (in bytes) for keeping the keys and values of recent steering prompts, so that a prompt that extends one of them only runs its new tokens. 0 disables the cache.",
+    )
     return parser.parse_args()
 
 
@@ -156,10 +228,34 @@ def main():
         os.environ["MAX_LOADED_SAES"] = str(args.max_loaded_saes)
     if "CUSTOM_HF_MODEL_ID" not in os.environ and args.custom_hf_model_id is not None:
         os.environ["CUSTOM_HF_MODEL_ID"] = str(args.custom_hf_model_id)
-    if "OPTIMIZE_MEMORY" not in os.environ:
-        os.environ["OPTIMIZE_MEMORY"] = str(args.optimize_memory)
     if "AUTO_CLEAR_CACHE" not in os.environ:
         os.environ["AUTO_CLEAR_CACHE"] = str(args.auto_clear_cache)
+    if "BATCH_WINDOW_MS" not in os.environ:
+        os.environ["BATCH_WINDOW_MS"] = str(args.batch_window_ms)
+    if "MAX_BATCH_SIZE" not in os.environ:
+        os.environ["MAX_BATCH_SIZE"] = str(args.max_batch_size)
+    if "ACTIVATION_CACHE_BYTES" not in os.environ:
+        os.environ["ACTIVATION_CACHE_BYTES"] = str(args.activation_cache_bytes)
+    if "SAE_MEMORY_BUDGET_BYTES" not in os.environ:
+        os.environ["SAE_MEMORY_BUDGET_BYTES"] = str(args.sae_memory_budget_bytes)
+    if "SAE_HOST_MEMORY_BUDGET_BYTES" not in os.environ:
+        os.environ["SAE_HOST_MEMORY_BUDGET_BYTES"] = str(
+            args.sae_host_memory_budget_bytes
+        )
+    if "SAE_DISK_CACHE_DIR" not in os.environ and args.sae_disk_cache_dir is not None:
+        os.environ["SAE_DISK_CACHE_DIR"] = args.sae_disk_cache_dir
+    if "SAE_LOAD_WORKERS" not in os.environ:
+        os.environ["SAE_LOAD_WORKERS"] = str(args.sae_load_workers)
+    if "SAE_PREFETCH_COUNT" not in os.environ:
+        os.environ["SAE_PREFETCH_COUNT"] = str(args.sae_prefetch_count)
+    if "SAE_COMPILED_DIR" not in os.environ and args.sae_compiled_dir is not None:
+        os.environ["SAE_COMPILED_DIR"] = args.sae_compiled_dir
+    if "N_DEVICES" not in os.environ:
+        os.environ["N_DEVICES"] = str(args.n_devices)
+    if "N_REPLICAS" not in os.environ:
+        os.environ["N_REPLICAS"] = str(args.n_replicas)
+    if "PROMPT_KV_CACHE_BYTES" not in os.environ:
+        os.environ["PROMPT_KV_CACHE_BYTES"] = str(args.prompt_kv_cache_bytes)
 
     if args.list_models:
         from neuronpedia_inference.args import list_available_options
@@ -167,6 +263,12 @@ def main():
         list_available_options()
         return
 
+    if args.compile_saes:
+        from neuronpedia_inference.compile_saes import compile_saes
+
+        compile_saes()
+        return
+
     uvicorn_args = [
         "uvicorn",
         "neuronpedia_inference.server:app",
@@ -0,0 +1,144 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+import torch
+from sae_lens.saes.standard_sae import StandardSAE, StandardSAEConfig
+
+from neuronpedia_inference.endpoints.activation.all import ActivationProcessor
+
+
+@pytest.fixture(autouse=True)
+def mock_config_and_model():
+    config = MagicMock()
+    config.device = "cpu"
+    model = MagicMock()
+    model.cfg.default_prepend_bos = True
+    with (
+        patch(
+            "neuronpedia_inference.endpoints.activation.all.Config.get_instance",
+            return_value=config,
+        ),
+        patch(
+            "neuronpedia_inference.endpoints.activation.all.Model.get_instance",
+            return_value=model,
+        ),
+    ):
+        yield
+
+
+def _dense_sort_and_filter(
+    source_activations: list[dict[str, torch.Tensor]], request: MagicMock
+) -> list[list[float]]:
+    """The original implementation, which sorts every feature of every source."""
+    all_activations = torch.cat(
+        [
+            torch.cat(
+                (
+                    source["layer_num"].unsqueeze(1),
+                    source["indices"].unsqueeze(1),
+                    source["max_values"].unsqueeze(1).to(torch.float32),
+                    source["max_indices"].unsqueeze(1),
+                    source["sum_values"].unsqueeze(1).to(torch.float32),
+                    source["get_activations"](
+                        list(range(len(source["indices"])))
+                    ).to(torch.float32),
+                ),
+                dim=1,
+            )
+            for source in source_activations
+        ],
+        dim=0,
+    )
+    sort_column = 4 if request.sort_by_token_indexes else 2
+    _, sorted_indices = torch.sort(all_activations[:, sort_column], descending=True)
+    sorted_activations = all_activations[sorted_indices]
+    if request.ignore_bos:
+        sorted_activations = sorted_activations[sorted_activations[:, 3] != 0]
+    return sorted_activations[: request.num_results].tolist()
+
+
+@pytest.mark.parametrize("sort_by_token_indexes", [[], [1, 3]])
+@pytest.mark.parametrize("ignore_bos", [True, False])
+@pytest.mark.parametrize("num_results", [5, 1000, None])
+def test_sort_and_filter_results_matches_dense_sort(
+    sort_by_token_indexes: list[int], ignore_bos: bool, num_results: int | None
+):
+    torch.manual_seed(0)
+    processor = ActivationProcessor()
+    source_activations = [
+        processor._process_source_activations(
+            torch.rand(50, 6), layer_num, sort_by_token_indexes
+        )
+        for layer_num in [3, 7]
+    ]
+    request = MagicMock()
+    request.sort_by_token_indexes = sort_by_token_indexes
+    request.ignore_bos = ignore_bos
+    request.num_results = num_results
+
+    results = processor._sort_and_filter_results(source_activations, request)
+
+    assert results == _dense_sort_and_filter(source_activations, request)
+
+
+@pytest.mark.parametrize("sort_by_token_indexes", [[], [0, 2]])
+def test_stream_source_activations_matches_dense(sort_by_token_indexes: list[int]):
+    torch.manual_seed(0)
+    sae = StandardSAE(StandardSAEConfig(d_in=8, d_sae=40))
+    with torch.no_grad():
+        for param in sae.parameters():
+            param.copy_(torch.randn_like(param))
+    activation_data = torch.randn(1, 5, 8)
+    processor = ActivationProcessor()
+    sae_manager = MagicMock()
+    sae_manager.get_sae.return_value = sae
+
+    with torch.no_grad():
+        dense = processor._process_source_activations(
+            sae.encode(activation_data).squeeze(0).T, 3, sort_by_token_indexes
+        )
+    with patch(
+        "neuronpedia_inference.endpoints.activation.all.SAEManager.get_instance",
+        return_value=sae_manager,
+    ):
+        streamed = processor._stream_source_activations(
+            "3-res-jb", activation_data, 3, sort_by_token_indexes
+        )
+
+    for key in ["layer_num", "indices", "max_indices", "nonzero_counts"]:
+        assert torch.equal(streamed[key], dense[key])
+    for key in ["max_values", "sum_values"]:
+        assert torch.allclose(streamed[key].float(), dense[key].float(), atol=1e-5)
+    rows = [4, 0, 39]
+    assert torch.allclose(
+        streamed["get_activations"](rows), dense["get_activations"](rows), atol=1e-5
+    )
+
+
+def test_stream_source_activations_gets_the_sae_again_for_the_results():
+    processor = ActivationProcessor()
+    sae_manager = MagicMock()
+    sae_manager.get_sae.side_effect = lambda source: f"{source} sae"  # noqa: ARG005
+
+    with (
+        patch(
+            "neuronpedia_inference.endpoints.activation.all.SAEManager.get_instance",
+            return_value=sae_manager,
+        ),
+        patch(
+            "neuronpedia_inference.endpoints.activation.all.SaeLensSAE"
+        ) as saelens_sae,
+    ):
+        saelens_sae.encode_stats.return_value = {
+            key: torch.zeros(1, 4)
+            for key in ["max_values", "max_indices", "sum_values", "nonzero_counts"]
+        }
+        streamed = processor._stream_source_activations(
+            "3-res-jb", torch.zeros(1, 2, 8), 3, []
+        )
+        # the SAE may have been moved off its device since it was encoded
+        sae_manager.get_sae.reset_mock()
+        streamed["get_activations"]([0, 1])
+
+    sae_manager.get_sae.assert_called_once_with("3-res-jb")
+    assert saelens_sae.encode_features.call_args.args[0] == "3-res-jb sae"
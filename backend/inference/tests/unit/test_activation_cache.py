@@ -0,0 +1,61 @@
+import torch
+
+from neuronpedia_inference.inference_utils.activation_cache import (
+    PromptActivationCache,
+)
+
+HOOK_A = "blocks.0.hook_resid_post"
+HOOK_B = "blocks.1.hook_resid_post"
+
+
+def _activation(n_floats: int) -> torch.Tensor:
+    return torch.ones(1, n_floats, dtype=torch.float32)
+
+
+def test_disabled_cache_stores_nothing():
+    cache = PromptActivationCache("gpt2-small", max_bytes=0)
+    cache.put(torch.tensor([1, 2]), {HOOK_A: _activation(4)})
+
+    assert cache.get(torch.tensor([1, 2]), {HOOK_A}) is None
+    assert cache.get_stats()["entries"] == 0
+
+
+def test_hit_needs_every_hook():
+    cache = PromptActivationCache("gpt2-small", max_bytes=1000)
+    tokens = torch.tensor([1, 2, 3])
+    cache.put(tokens, {HOOK_A: _activation(4)})
+
+    cached = cache.get(tokens, {HOOK_A})
+    assert cached is not None
+    assert torch.equal(cached[HOOK_A], _activation(4))
+    assert cache.get(tokens, {HOOK_A, HOOK_B}) is None
+    assert cache.get(torch.tensor([1, 2]), {HOOK_A}) is None
+    # requests without a filter need every hook
+    assert cache.get(tokens, None) is None
+
+    stats = cache.get_stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+    assert stats["bytes"] == 16
+
+
+def test_evicts_least_recently_used_by_bytes():
+    # room for two 16 byte activations
+    cache = PromptActivationCache("gpt2-small", max_bytes=32)
+    cache.put(torch.tensor([1]), {HOOK_A: _activation(4)})
+    cache.put(torch.tensor([2]), {HOOK_A: _activation(4)})
+    # touch the first prompt, so that the second one is evicted
+    assert cache.get(torch.tensor([1]), {HOOK_A}) is not None
+    cache.put(torch.tensor([3]), {HOOK_A: _activation(4)})
+
+    assert cache.get(torch.tensor([1]), {HOOK_A}) is not None
+    assert cache.get(torch.tensor([2]), {HOOK_A}) is None
+    assert cache.get(torch.tensor([3]), {HOOK_A}) is not None
+    assert cache.get_stats()["bytes"] == 32
+
+
+def test_skips_activations_larger_than_budget():
+    cache = PromptActivationCache("gpt2-small", max_bytes=8)
+    cache.put(torch.tensor([1]), {HOOK_A: _activation(4)})
+
+    assert cache.get_stats()["entries"] == 0
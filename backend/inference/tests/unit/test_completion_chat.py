@@ -0,0 +1,48 @@
+from unittest.mock import MagicMock
+
+import torch
+
+from neuronpedia_inference.endpoints.steer.completion_chat import (
+    get_position_mask,
+    get_prompt_mask,
+)
+
+BOS = 2
+START_OF_TURN = 106
+END_OF_TURN = 107
+# <bos><start_of_turn>user\n Hi <end_of_turn>\n Hello
+PROMPT = torch.tensor([BOS, START_OF_TURN, 5, 6, 7, END_OF_TURN, 8, 9])
+
+
+def make_model() -> MagicMock:
+    model = MagicMock()
+    model.tokenizer.bos_token_id = BOS
+    model.tokenizer.encode.side_effect = lambda text: {
+        "<start_of_turn>": [START_OF_TURN],
+        "<end_of_turn>": [END_OF_TURN],
+    }[text]
+    return model
+
+
+def test_prompt_mask_skips_special_tokens():
+    prompt_mask = get_prompt_mask(PROMPT, make_model(), steer_special_tokens=False)
+    assert prompt_mask.tolist() == [0, 0, 0, 0, 1, 0, 0, 1]
+
+    prompt_mask = get_prompt_mask(PROMPT, make_model(), steer_special_tokens=True)
+    assert prompt_mask.tolist() == [1] * len(PROMPT)
+
+
+def test_position_mask_across_prefill_and_decode():
+    prompt_mask = get_prompt_mask(PROMPT, make_model(), steer_special_tokens=False)
+
+    # the whole prompt
+    mask = get_position_mask(prompt_mask, position=0, n_positions=8)
+    assert mask is not None
+    assert mask.tolist() == [0, 0, 0, 0, 1, 0, 0, 1]
+    # the rest of the prompt, after a cached prefix
+    mask = get_position_mask(prompt_mask, position=3, n_positions=5)
+    assert mask is not None
+    assert mask.tolist() == [0, 1, 0, 0, 1]
+    # generated tokens are always steered
+    assert get_position_mask(prompt_mask, position=8, n_positions=1) is None
+    assert get_position_mask(prompt_mask, position=12, n_positions=1) is None
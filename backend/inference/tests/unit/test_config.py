@@ -4,8 +4,8 @@ import pytest
 
 from neuronpedia_inference.config import (
     Config,
-    config_to_json,
-    get_saelens_neuronpedia_directory_df,
+    SaeDirectoryEntry,
+    SaeLensDirectory,
 )
 
 
@@ -58,44 +58,34 @@ def test_config_initialization(mock_config: Config):
     }
 
 
-def test_get_saelens_neuronpedia_directory_df():
-    directory_df = get_saelens_neuronpedia_directory_df()
+def test_sae_directory_from_pretrained_saes_directory():
+    sae_directory = SaeLensDirectory.from_pretrained_saes_directory()
 
-    assert directory_df is not None
-    assert directory_df.shape[0] > 0
-    for col_name in [
-        "release",
-        "model",
-        "neuronpedia_id",
-        "sae_lens_id",
-        "neuronpedia_set",
-    ]:
-        assert col_name in directory_df.columns
+    assert "gpt2-small" in sae_directory.get_models()
+    assert "res-jb" in sae_directory.get_sets("gpt2-small")
+    entry = sae_directory.get_saes("gpt2-small", "res-jb")[0]
+    assert entry.neuronpedia_id == f"gpt2-small/{entry.source}"
+    assert sae_directory.get_sae_lens_ids("gpt2-small", entry.source) == (
+        entry.release,
+        entry.sae_lens_id,
+    )
 
 
-def test_config_to_json():
-    directory_df = get_saelens_neuronpedia_directory_df()
+def test_sae_directory_sae_config_of_pretrained_saes():
+    sae_directory = SaeLensDirectory.from_pretrained_saes_directory()
 
     # GPT2 Small SERVER 1
-    selected_model = "gpt2-small"
     selected_sets = [
         "res-jb",
         "res_fs768-jb",
         "res_fs1536-jb",
     ]
-
-    json_output = config_to_json(
-        directory_df,
-        selected_sets_neuronpedia=selected_sets,
-        selected_model=selected_model,
-    )
-
-    # Verify basic structure
-    assert isinstance(json_output, list)
+    sae_config = sae_directory.get_sae_config("gpt2-small", selected_sets)
 
     # Just check that we have entries for each set
-    sets_in_output = {entry["set"] for entry in json_output}
+    sets_in_output = {entry["set"] for entry in sae_config}
     assert all(s in sets_in_output for s in selected_sets)
+    assert all(entry["model"] == "gpt2-small" for entry in sae_config)
 
 
 def test_config_no_filtering(mock_config: Config):
@@ -319,3 +309,54 @@ def test_config_multiple_sae_sets():
             assert sae_config["model"] == "gpt2-small"
             assert sae_config["local"] is False
             assert sae_config["type"] == "saelens-1"
+
+
+@pytest.fixture
+def sae_directory() -> SaeLensDirectory:
+    return SaeLensDirectory(
+        [
+            SaeDirectoryEntry(
+                model="gpt2-small",
+                release="gpt2-small-res-jb",
+                sae_lens_id=f"blocks.{i}.hook_resid_pre",
+                neuronpedia_id=f"gpt2-small/{i}-res-jb",
+                neuronpedia_set="res-jb",
+            )
+            for i in range(3)
+        ]
+        + [
+            SaeDirectoryEntry(
+                model="gemma-2-2b",
+                release="gemma-scope-2b-pt-res",
+                sae_lens_id="layer_0/width_16k/average_l0_105",
+                neuronpedia_id="gemma-2-2b/0-gemmascope-res-16k",
+                neuronpedia_set="gemmascope-res-16k",
+            )
+        ]
+    )
+
+
+def test_sae_directory_lookups(sae_directory: SaeLensDirectory):
+    assert sae_directory.get_models() == ("gpt2-small", "gemma-2-2b")
+    assert sae_directory.get_sets() == ("res-jb", "gemmascope-res-16k")
+    assert sae_directory.get_sets("gpt2-small") == ("res-jb",)
+    assert len(sae_directory.get_saes("gpt2-small", "res-jb")) == 3
+    assert sae_directory.get_sae_lens_ids("gpt2-small", "1-res-jb") == (
+        "gpt2-small-res-jb",
+        "blocks.1.hook_resid_pre",
+    )
+    with pytest.raises(ValueError, match="Found 0 entries"):
+        sae_directory.get_sae_lens_ids("gemma-2-2b", "1-res-jb")
+
+
+def test_sae_directory_sae_config(sae_directory: SaeLensDirectory):
+    assert sae_directory.get_sae_config("gpt2-small", ["res-jb"]) == [
+        {
+            "model": "gpt2-small",
+            "set": "res-jb",
+            "type": "saelens-1",
+            "local": False,
+            "saes": ["0-res-jb", "1-res-jb", "2-res-jb"],
+        }
+    ]
+    assert sae_directory.get_sae_config("gpt2-small", ["gemmascope-res-16k"]) == []
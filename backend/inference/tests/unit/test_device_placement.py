@@ -0,0 +1,28 @@
+from unittest.mock import MagicMock
+
+import torch
+
+from neuronpedia_inference.inference_utils.device_placement import DevicePlacement
+
+
+def test_placement_is_read_from_the_model():
+    model = MagicMock()
+    # the meta device stands in for a second GPU
+    model.blocks = [torch.nn.Linear(2, 2) for _ in range(2)] + [
+        torch.nn.Linear(2, 2, device="meta") for _ in range(3)
+    ]
+
+    placement = DevicePlacement.from_model(model)
+
+    assert placement.layer_devices == ["cpu", "cpu", "meta", "meta", "meta"]
+    assert placement.get_layer_ranges() == {"cpu": (0, 1), "meta": (2, 4)}
+    assert placement.get_device_for_hook("blocks.1.hook_resid_post") == "cpu"
+    assert placement.get_device_for_hook("blocks.3.attn.hook_z") == "meta"
+
+
+def test_hooks_outside_the_blocks_use_the_first_device():
+    placement = DevicePlacement(["cuda:0", "cuda:1"], "cuda:0")
+
+    assert placement.get_device_for_hook("hook_embed") == "cuda:0"
+    assert placement.get_device_for_hook("blocks.7.hook_resid_pre") == "cuda:0"
+    assert placement.get_device_for_hook("blocks.1.hook_resid_pre") == "cuda:1"
@@ -0,0 +1,89 @@
+import einops
+import torch
+
+from neuronpedia_inference.inference_utils.dfa import (
+    calculate_batched_dfa_values,
+    calculate_dfa_values,
+)
+
+
+def _broadcast_dfa(
+    v: torch.Tensor, attn_weights: torch.Tensor, W_enc: torch.Tensor, dest_index: int
+) -> torch.Tensor:
+    """The original DFA, which materializes every destination position."""
+    n_heads = attn_weights.shape[1]
+    v = v.repeat_interleave(n_heads // v.shape[2], dim=2)
+    v_cat = einops.rearrange(
+        v, "batch src_pos n_heads d_head -> batch src_pos (n_heads d_head)"
+    )
+    attn_weights_bcast = einops.repeat(
+        attn_weights,
+        "batch n_heads dest_pos src_pos -> batch dest_pos src_pos (n_heads d_head)",
+        d_head=v.shape[3],
+    )
+    per_src_pos_dfa = einops.einsum(
+        attn_weights_bcast * v_cat.unsqueeze(1),
+        W_enc,
+        "batch dest_pos src_pos d_model, d_model -> batch dest_pos src_pos",
+    )
+    return per_src_pos_dfa[:, dest_index, :]
+
+
+def test_calculate_dfa_values_matches_broadcast():
+    torch.manual_seed(0)
+    v = torch.randn(1, 7, 4, 8)
+    attn_weights = torch.softmax(torch.randn(1, 4, 7, 7), dim=-1)
+    W_enc = torch.randn(32)
+
+    for dest_index in [0, 3, 6]:
+        dfa_values = calculate_dfa_values(v, attn_weights, W_enc, dest_index)
+        assert dfa_values.shape == (1, 7)
+        assert torch.allclose(
+            dfa_values, _broadcast_dfa(v, attn_weights, W_enc, dest_index), atol=1e-5
+        )
+
+
+def test_calculate_dfa_values_gqa():
+    torch.manual_seed(0)
+    v = torch.randn(1, 5, 2, 8)  # 2 key/value heads shared by 4 query heads
+    attn_weights = torch.softmax(torch.randn(1, 4, 5, 5), dim=-1)
+    W_enc = torch.randn(32)
+
+    dfa_values = calculate_dfa_values(v, attn_weights, W_enc, 4)
+    assert torch.allclose(
+        dfa_values, _broadcast_dfa(v, attn_weights, W_enc, 4), atol=1e-5
+    )
+
+
+def test_calculate_batched_dfa_values_matches_single_features():
+    torch.manual_seed(0)
+    v = torch.randn(1, 6, 4, 8)
+    attn_weights = torch.softmax(torch.randn(1, 4, 6, 6), dim=-1)
+    W_enc = torch.randn(32, 10)
+    indices = [7, 2, 7]
+    dest_indices = [5, 1, 3]
+
+    dfa_values = calculate_batched_dfa_values(
+        v, attn_weights, W_enc[:, indices], torch.tensor(dest_indices)
+    )
+
+    assert dfa_values.shape == (1, 3, 6)
+    for i, (index, dest_index) in enumerate(zip(indices, dest_indices)):
+        assert torch.allclose(
+            dfa_values[:, i],
+            _broadcast_dfa(v, attn_weights, W_enc[:, index], dest_index),
+            atol=1e-5,
+        )
+
+
+def test_calculate_dfa_values_float16_computes_in_float32():
+    v = torch.randn(1, 3, 2, 4).half()
+    attn_weights = torch.softmax(torch.randn(1, 2, 3, 3), dim=-1).half()
+    W_enc = torch.randn(8).half()
+
+    dfa_values = calculate_dfa_values(v, attn_weights, W_enc, 2)
+
+    # computed in float32, then cast back to the dtype of v
+    assert dfa_values.dtype == torch.float16
+    expected = _broadcast_dfa(v.float(), attn_weights.float(), W_enc.float(), 2)
+    assert torch.allclose(dfa_values.float(), expected, atol=1e-2)
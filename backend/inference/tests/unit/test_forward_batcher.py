@@ -0,0 +1,147 @@
+import asyncio
+from typing import Any
+
+import pytest
+import torch
+from transformer_lens import ActivationCache
+
+from neuronpedia_inference.inference_utils.activation_cache import (
+    PromptActivationCache,
+)
+from neuronpedia_inference.inference_utils.forward_batcher import ForwardBatcher
+from neuronpedia_inference.shared import Model
+
+HOOK_NAME = "blocks.0.hook_resid_post"
+PATTERN_HOOK_NAME = "blocks.0.attn.hook_pattern"
+
+
+class FakeModel:
+    """Caches the token ids as the "activations", so that we can check the split."""
+
+    def __init__(self):
+        self.calls: list[dict[str, Any]] = []
+
+    def run_with_cache(self, tokens: torch.Tensor, **kwargs: Any):
+        if tokens.dim() == 1:
+            tokens = tokens.unsqueeze(0)
+        self.calls.append({"tokens": tokens, **kwargs})
+        resid = tokens.float().unsqueeze(-1).repeat(1, 1, 4)
+        n_pos = tokens.shape[1]
+        pattern = torch.ones(tokens.shape[0], 2, n_pos, n_pos)
+        cache_dict = {HOOK_NAME: resid, PATTERN_HOOK_NAME: pattern}
+        # stopping early returns the residual, which we make the same as HOOK_NAME's
+        return resid, ActivationCache(cache_dict, self)
+
+
+@pytest.fixture
+def fake_model():
+    model = FakeModel()
+    previous = getattr(Model, "_instance", None)
+    Model._instance = model  # type: ignore
+    yield model
+    Model._instance = previous  # type: ignore
+
+
+def test_forward_batcher_disabled_runs_each_request(fake_model: FakeModel):
+    batcher = ForwardBatcher(window_ms=0)
+
+    async def run():
+        return await asyncio.gather(
+            batcher.run_with_cache(torch.tensor([1, 2, 3])),
+            batcher.run_with_cache(torch.tensor([4, 5])),
+        )
+
+    caches = asyncio.run(run())
+
+    assert len(fake_model.calls) == 2
+    assert caches[0][HOOK_NAME].shape == (1, 3, 4)
+    assert caches[1][HOOK_NAME].shape == (1, 2, 4)
+
+
+def test_forward_batcher_batches_concurrent_requests(fake_model: FakeModel):
+    batcher = ForwardBatcher(window_ms=50, max_batch_size=8)
+
+    async def run():
+        return await asyncio.gather(
+            batcher.run_with_cache(torch.tensor([1, 2, 3]), stop_at_layer=2),
+            batcher.run_with_cache(torch.tensor([4, 5]), stop_at_layer=5),
+            batcher.run_with_cache(torch.tensor([6, 7, 8, 9]), stop_at_layer=3),
+        )
+
+    caches = asyncio.run(run())
+
+    assert len(fake_model.calls) == 1
+    call = fake_model.calls[0]
+    assert call["tokens"].shape == (3, 4)
+    assert call["stop_at_layer"] == 5
+    assert call["attention_mask"].tolist() == [
+        [1, 1, 1, 0],
+        [1, 1, 0, 0],
+        [1, 1, 1, 1],
+    ]
+
+    # each request gets back only its own, unpadded activations
+    assert caches[0][HOOK_NAME][0, :, 0].tolist() == [1, 2, 3]
+    assert caches[1][HOOK_NAME][0, :, 0].tolist() == [4, 5]
+    assert caches[2][HOOK_NAME][0, :, 0].tolist() == [6, 7, 8, 9]
+    assert caches[1][PATTERN_HOOK_NAME].shape == (1, 2, 2, 2)
+
+
+def test_forward_batcher_caches_resid_pre_of_the_stop_layer(fake_model: FakeModel):
+    batcher = ForwardBatcher(window_ms=50, max_batch_size=8)
+
+    async def run():
+        return await asyncio.gather(
+            batcher.run_with_cache(
+                torch.tensor([1, 2, 3]),
+                stop_at_layer=1,
+                names_filter={"blocks.1.hook_resid_pre"},
+            ),
+            batcher.run_with_cache(
+                torch.tensor([4, 5]), stop_at_layer=1, names_filter={HOOK_NAME}
+            ),
+        )
+
+    caches = asyncio.run(run())
+
+    assert fake_model.calls[0]["stop_at_layer"] == 1
+    assert caches[0]["blocks.1.hook_resid_pre"][0, :, 0].tolist() == [1, 2, 3]
+    assert caches[1]["blocks.1.hook_resid_pre"][0, :, 0].tolist() == [4, 5]
+
+
+def test_forward_batcher_respects_max_batch_size(fake_model: FakeModel):
+    batcher = ForwardBatcher(window_ms=50, max_batch_size=2)
+
+    async def run():
+        return await asyncio.gather(
+            *[batcher.run_with_cache(torch.tensor([i, i + 1])) for i in range(5)]
+        )
+
+    caches = asyncio.run(run())
+
+    assert [call["tokens"].shape[0] for call in fake_model.calls] == [2, 2, 1]
+    for i, cache in enumerate(caches):
+        assert cache[HOOK_NAME][0, :, 0].tolist() == [i, i + 1]
+
+
+def test_forward_batcher_serves_repeated_prompts_from_activation_cache(
+    fake_model: FakeModel,
+):
+    batcher = ForwardBatcher(
+        activation_cache=PromptActivationCache("fake-model", max_bytes=10_000)
+    )
+
+    async def run():
+        first = await batcher.run_with_cache(
+            torch.tensor([1, 2, 3]), names_filter={HOOK_NAME}
+        )
+        second = await batcher.run_with_cache(
+            torch.tensor([1, 2, 3]), names_filter={HOOK_NAME}
+        )
+        return first, second
+
+    first, second = asyncio.run(run())
+
+    assert len(fake_model.calls) == 1
+    assert torch.equal(first[HOOK_NAME], second[HOOK_NAME])
+    assert batcher.activation_cache.get_stats()["hits"] == 1  # type: ignore
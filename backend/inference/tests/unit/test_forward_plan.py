@@ -0,0 +1,100 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from neuronpedia_inference.inference_utils.forward_plan import (
+    get_cache_hook_names,
+    get_forward_plan,
+    get_hook_layer,
+    get_stop_at_layer,
+)
+
+SAE_HOOKS = {
+    "5-res-jb": "blocks.5.hook_resid_pre",
+    "7-att-kk": "blocks.7.attn.hook_z",
+    "3-transcoder": "blocks.3.mlp.hook_in",
+}
+
+
+@pytest.fixture
+def mock_sae_manager():
+    sae_manager = MagicMock()
+    sae_manager.get_sae_hook.side_effect = lambda source: SAE_HOOKS.get(source)  # type: ignore
+    sae_manager.is_dfa_enabled.side_effect = lambda source: "-att-" in source  # type: ignore
+    with patch(
+        "neuronpedia_inference.inference_utils.forward_plan.SAEManager.get_instance",
+        return_value=sae_manager,
+    ):
+        yield sae_manager
+
+
+@pytest.fixture
+def mock_model():
+    model = MagicMock()
+    model.cfg.n_layers = 12
+    with patch(
+        "neuronpedia_inference.inference_utils.forward_plan.Model.get_instance",
+        return_value=model,
+    ):
+        yield model
+
+
+def test_get_hook_layer():
+    assert get_hook_layer("blocks.7.attn.hook_z") == 7
+    assert get_hook_layer("blocks.12.hook_resid_post") == 12
+    assert get_hook_layer("hook_embed") is None
+
+
+def test_get_cache_hook_names(mock_sae_manager: MagicMock):  # noqa: ARG001
+    assert get_cache_hook_names(["5-res-jb", "3-transcoder"]) == {
+        "blocks.5.hook_resid_pre",
+        "blocks.3.mlp.hook_in",
+    }
+
+
+def test_get_cache_hook_names_dfa(mock_sae_manager: MagicMock):  # noqa: ARG001
+    assert get_cache_hook_names(["7-att-kk"]) == {
+        "blocks.7.attn.hook_z",
+        "blocks.7.attn.hook_v",
+        "blocks.7.attn.hook_pattern",
+    }
+    assert get_cache_hook_names(["7-att-kk"], include_dfa=False) == {
+        "blocks.7.attn.hook_z"
+    }
+
+
+def test_get_cache_hook_names_unknown_source(mock_sae_manager: MagicMock):  # noqa: ARG001
+    assert get_cache_hook_names(["5-res-jb", "fake-source"]) is None
+
+
+def test_get_stop_at_layer(mock_model: MagicMock):  # noqa: ARG001
+    assert get_stop_at_layer({"blocks.3.mlp.hook_in", "blocks.7.attn.hook_z"}) == 8
+    # the last block runs the whole model anyway
+    assert get_stop_at_layer({"blocks.11.hook_resid_post"}) is None
+    # the input of a block is returned by the blocks below it
+    assert get_stop_at_layer({"blocks.5.hook_resid_pre"}) == 5
+    assert get_stop_at_layer({"blocks.0.hook_resid_pre"}) == 0
+    assert get_stop_at_layer({"blocks.5.hook_resid_pre", "blocks.4.mlp.hook_in"}) == 5
+    assert get_stop_at_layer({"blocks.11.hook_resid_pre"}) == 11
+    # hooks outside of a block need the whole model
+    hook_names = {"blocks.3.hook_resid_pre", "ln_final.hook_normalized"}
+    assert get_stop_at_layer(hook_names) is None
+    assert get_stop_at_layer(None) is None
+
+
+def test_get_forward_plan(
+    mock_sae_manager: MagicMock,  # noqa: ARG001
+    mock_model: MagicMock,  # noqa: ARG001
+):
+    plan = get_forward_plan(["5-res-jb", "7-att-kk"])
+    assert plan.stop_at_layer == 8
+    assert plan.hook_names == {
+        "blocks.5.hook_resid_pre",
+        "blocks.7.attn.hook_z",
+        "blocks.7.attn.hook_v",
+        "blocks.7.attn.hook_pattern",
+    }
+
+    plan = get_forward_plan(["fake-source"])
+    assert plan.hook_names is None
+    assert plan.stop_at_layer is None
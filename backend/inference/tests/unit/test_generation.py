@@ -0,0 +1,107 @@
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import torch
+
+from neuronpedia_inference.inference_utils.generation import BatchedGeneration
+
+D_VOCAB = 16
+D_MODEL = 4
+N_LAYERS = 2
+EOS_TOKEN_ID = 0
+
+
+def make_model(logits_fn):
+    model = MagicMock()
+    model.cfg.device = "cpu"
+    model.cfg.n_layers = N_LAYERS
+    model.cfg.positional_embedding_type = "standard"
+    model.tokenizer.eos_token_id = EOS_TOKEN_ID
+    model.side_effect = lambda tokens, **kwargs: logits_fn(tokens)  # noqa: ARG005
+    return model
+
+
+def generate(generation: BatchedGeneration):
+    with patch.object(BatchedGeneration, "init_cache", return_value=None):
+        return list(generation.stream())
+
+
+def test_rows_sample_like_a_seeded_batch_of_one():
+    torch.manual_seed(0)
+    fixed_logits = torch.randn(D_VOCAB)
+    fixed_logits[EOS_TOKEN_ID] = -100
+    model = make_model(
+        lambda tokens: fixed_logits.expand(tokens.shape[0], tokens.shape[1], -1)
+    )
+
+    generation = BatchedGeneration(
+        model, torch.tensor([1, 2, 3]), n_rows=2, max_new_tokens=5, seed=42
+    )
+    steps = generate(generation)
+
+    torch.manual_seed(42)
+    expected = [
+        torch.distributions.Categorical(logits=fixed_logits.unsqueeze(0)).sample()
+        for _ in range(5)
+    ]
+    assert [step[0].tolist() for step in steps] == [[t.item()] * 2 for t in expected]
+    assert generation.tokens.shape == (2, 8)
+    assert generation.position == 3 + 4
+
+
+def test_rows_stop_at_eos_independently():
+    def logits_fn(tokens):
+        # row 0 always picks EOS, row 1 always picks token 5
+        logits = torch.full((tokens.shape[0], tokens.shape[1], D_VOCAB), -100.0)
+        logits[0, :, EOS_TOKEN_ID] = 100
+        logits[1, :, 5] = 100
+        return logits
+
+    generation = BatchedGeneration(
+        make_model(logits_fn),
+        torch.tensor([1, 2]),
+        n_rows=2,
+        max_new_tokens=3,
+        temperature=0.0,
+    )
+    steps = generate(generation)
+
+    assert [step[0].tolist() for step in steps] == [[0, 5], [0, 5], [0, 5]]
+    assert [step[2] for step in steps] == [[True, True], [False, True], [False, True]]
+
+
+def test_prompt_runs_once_through_the_shared_layers():
+    prompt = torch.tensor([1, 2, 3])
+    calls = []
+
+    def model_fn(inputs, past_kv_cache, stop_at_layer=None, **kwargs):
+        calls.append((inputs.shape, stop_at_layer, kwargs.get("start_at_layer")))
+        if stop_at_layer is not None:
+            for entry in past_kv_cache.entries[:stop_at_layer]:
+                entry.past_keys = torch.ones(1, len(prompt), 1, 1)
+                entry.past_values = torch.ones(1, len(prompt), 1, 1)
+            past_kv_cache.previous_attention_mask = torch.ones(1, len(prompt))
+            return torch.zeros(1, len(prompt), D_MODEL)
+        return torch.zeros(inputs.shape[0], inputs.shape[1], D_VOCAB)
+
+    def init_cache(n_rows=None):  # noqa: ARG001
+        entries = [
+            SimpleNamespace(past_keys=None, past_values=None) for _ in range(N_LAYERS)
+        ]
+        return SimpleNamespace(entries=entries, previous_attention_mask=None)
+
+    model = make_model(lambda tokens: None)
+    model.side_effect = model_fn
+    generation = BatchedGeneration(
+        model, prompt, n_rows=2, max_new_tokens=1, temperature=0.0, shared_layers=1
+    )
+    cache = init_cache()
+    with patch.object(generation, "init_cache", side_effect=init_cache):
+        generation.prefill(cache)
+
+    # the prompt goes through layer 0 for one row, then layer 1 on for both rows
+    assert calls == [((1, 3), 1, None), ((2, 3, D_MODEL), None, 1)]
+    assert cache.entries[0].past_keys.shape == (2, 3, 1, 1)
+    assert cache.entries[1].past_keys is None
+    assert cache.previous_attention_mask.shape == (2, 3)
+    assert generation.position == 3
@@ -0,0 +1,127 @@
+from types import SimpleNamespace
+
+import torch
+
+from neuronpedia_inference.inference_utils.prompt_kv_cache import (
+    PromptKVCache,
+    PromptKVCacheEntry,
+)
+
+N_LAYERS = 2
+STEERING_KEY = "steered"
+
+
+def _kv_cache(n_tokens: int):
+    # 2 layers of keys and values of 4 bytes per token, and 4 bytes of mask per token
+    entries = [
+        SimpleNamespace(
+            past_keys=torch.ones(1, n_tokens, 1, 1),
+            past_values=torch.ones(1, n_tokens, 1, 1),
+        )
+        for _ in range(N_LAYERS)
+    ]
+    return SimpleNamespace(
+        entries=entries,
+        previous_attention_mask=torch.ones(1, n_tokens, dtype=torch.int32),
+    )
+
+
+def _empty_kv_cache():
+    entries = [
+        SimpleNamespace(past_keys=None, past_values=None) for _ in range(N_LAYERS)
+    ]
+    return SimpleNamespace(entries=entries, previous_attention_mask=None)
+
+
+def _put(cache: PromptKVCache, tokens: list[int], steering_key: str = STEERING_KEY):
+    # 4 bytes of logits
+    cache.put(
+        steering_key, torch.tensor(tokens), _kv_cache(len(tokens)), torch.zeros(1, 1)
+    )
+
+
+def _bytes(n_tokens: int) -> int:
+    return 5 * 4 * n_tokens + 4
+
+
+def test_entry_counts_shared_storage_once():
+    # 2 rows of 3 tokens of 4 bytes, with the first layer shared by both rows
+    entry = PromptKVCacheEntry(
+        keys=[torch.ones(1, 3, 1, 1).expand(2, -1, -1, -1), torch.ones(2, 3, 1, 1)],
+        values=[torch.ones(1, 3, 1, 1).expand(2, -1, -1, -1), torch.ones(2, 3, 1, 1)],
+        attention_mask=torch.ones(1, 3, dtype=torch.int32).expand(2, -1),
+        logits=torch.zeros(2, 1),
+    )
+
+    # the shared layer and the mask are only counted for one row
+    assert entry.n_bytes == 2 * 12 + 2 * 24 + 12 + 8
+
+
+def test_disabled_cache_stores_nothing():
+    cache = PromptKVCache("gpt2-small", max_bytes=0)
+    _put(cache, [1, 2])
+
+    assert cache.get_longest_prefix(STEERING_KEY, torch.tensor([1, 2])) is None
+    assert cache.get_stats()["entries"] == 0
+
+
+def test_resumes_from_the_longest_cached_prefix():
+    cache = PromptKVCache("gpt2-small", max_bytes=1000)
+    _put(cache, [1, 2])
+    _put(cache, [1, 2, 3, 4])
+    _put(cache, [5, 6, 7])
+
+    cached = cache.get_longest_prefix(STEERING_KEY, torch.tensor([1, 2, 3, 4, 5, 6]))
+    assert cached is not None
+    length, entry = cached
+    assert length == 4
+
+    kv_cache = _empty_kv_cache()
+    entry.restore(kv_cache)
+    assert kv_cache.entries[1].past_keys.shape == (1, 4, 1, 1)
+    assert kv_cache.previous_attention_mask.shape == (1, 4)
+
+    cached = cache.get_longest_prefix(STEERING_KEY, torch.tensor([1, 2, 3]))
+    assert cached is not None
+    assert cached[0] == 2
+    # the whole prompt can be cached
+    cached = cache.get_longest_prefix(STEERING_KEY, torch.tensor([5, 6, 7]))
+    assert cached is not None
+    assert cached[0] == 3
+    assert cache.get_longest_prefix(STEERING_KEY, torch.tensor([9, 1, 2])) is None
+
+    stats = cache.get_stats()
+    assert stats["hits"] == 3
+    assert stats["misses"] == 1
+    assert stats["bytes"] == _bytes(2) + _bytes(4) + _bytes(3)
+
+
+def test_only_reuses_prompts_with_the_same_steering():
+    cache = PromptKVCache("gpt2-small", max_bytes=1000)
+    _put(cache, [1, 2], steering_key="a")
+
+    assert cache.get_longest_prefix("a", torch.tensor([1, 2, 3])) is not None
+    assert cache.get_longest_prefix("b", torch.tensor([1, 2, 3])) is None
+
+
+def test_evicts_least_recently_used_by_bytes():
+    # room for two prompts of 2 tokens
+    cache = PromptKVCache("gpt2-small", max_bytes=2 * _bytes(2))
+    _put(cache, [1, 2])
+    _put(cache, [3, 4])
+    # touch the first prompt, so that the second one is evicted
+    assert cache.get_longest_prefix(STEERING_KEY, torch.tensor([1, 2])) is not None
+    _put(cache, [5, 6])
+
+    assert cache.get_longest_prefix(STEERING_KEY, torch.tensor([1, 2])) is not None
+    assert cache.get_longest_prefix(STEERING_KEY, torch.tensor([3, 4])) is None
+    assert cache.get_longest_prefix(STEERING_KEY, torch.tensor([5, 6])) is not None
+    assert cache.get_stats()["bytes"] == 2 * _bytes(2)
+
+
+def test_skips_prompts_larger_than_budget():
+    cache = PromptKVCache("gpt2-small", max_bytes=_bytes(2))
+    _put(cache, [1, 2, 3])
+
+    assert cache.get_stats()["entries"] == 0
+    assert cache.lengths == {}
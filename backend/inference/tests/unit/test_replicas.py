@@ -0,0 +1,61 @@
+import asyncio
+from unittest.mock import MagicMock
+
+from neuronpedia_inference.inference_utils.forward_batcher import ForwardBatcher
+from neuronpedia_inference.replicas import Replica, ReplicaPool, get_current_replica
+from neuronpedia_inference.sae_manager import SAEManager
+from neuronpedia_inference.shared import Model, request_lock
+
+
+def make_replica(index: int) -> Replica:
+    return Replica(
+        index, f"cuda:{index}", MagicMock(), MagicMock(), MagicMock(), MagicMock()
+    )
+
+
+def test_requests_go_to_the_least_busy_replica():
+    pool = ReplicaPool([make_replica(0), make_replica(1)])
+
+    with pool.use() as first:
+        with pool.use() as second:
+            assert {first.index, second.index} == {0, 1}
+            assert get_current_replica() is second
+        assert get_current_replica() is first
+
+    assert get_current_replica() is None
+    assert [replica.in_flight for replica in pool.replicas] == [0, 0]
+    # both replicas are idle again, the next request goes to the one used the least
+    pool.replicas[0].requests = 5
+    assert pool.acquire() is pool.replicas[1]
+
+
+def test_singletons_resolve_to_the_current_replica():
+    pool = ReplicaPool([make_replica(0)])
+
+    with pool.use() as replica:
+        assert Model.get_instance() is replica.model
+        assert SAEManager.get_instance() is replica.sae_manager
+        assert ForwardBatcher.get_instance() is replica.forward_batcher
+
+
+def test_replicas_run_requests_concurrently():
+    pool = ReplicaPool([make_replica(0), make_replica(1)])
+    running = 0
+    max_running = 0
+
+    async def handle_request():
+        nonlocal running, max_running
+        with pool.use():
+            async with request_lock:
+                running += 1
+                max_running = max(max_running, running)
+                await asyncio.sleep(0.01)
+                running -= 1
+
+    async def main():
+        await asyncio.gather(*(handle_request() for _ in range(4)))
+
+    asyncio.run(main())
+
+    # each replica only runs one request at a time, but both run at once
+    assert max_running == 2
@@ -1,9 +1,14 @@
+import threading
+import time
 from unittest.mock import MagicMock, patch
 
 import pytest
+import torch
 from sae_lens.saes.sae import SAE
 
-from neuronpedia_inference.config import Config
+from neuronpedia_inference.config import Config, SaeLensDirectory
+from neuronpedia_inference.endpoints.activation.all import ActivationProcessor
+from neuronpedia_inference.inference_utils.device_placement import DevicePlacement
 from neuronpedia_inference.sae_manager import SAEManager
 
 
@@ -208,3 +213,333 @@ def test_lru_stress_test(mock_sae_manager: SAEManager) -> None:
         "1-res-jb",
         "3-res-jb",
     ]
+
+
+class TinySAE(torch.nn.Module):
+    def __init__(self, d_sae: int):
+        super().__init__()
+        self.W_enc = torch.nn.Parameter(torch.zeros(4, d_sae))  # 16 bytes per feature
+        self.cfg = MagicMock()
+
+
+@pytest.fixture
+def budgeted_sae_manager(mock_config: Config):
+    mock_config.max_loaded_saes = 10
+    mock_config.sae_memory_budget_bytes = 1000
+    # 2-res-jb is twice as wide as the others
+    d_sae_by_id = {"2-res-jb": 32}
+
+    def load(release: str, sae_id: str, device: str, dtype: str):  # noqa: ARG001
+        return TinySAE(d_sae_by_id.get(sae_id, 16)), "mock_hook"
+
+    with (
+        patch("neuronpedia_inference.sae_manager.SaeLensSAE") as mock_sae_lens,
+        patch(
+            "neuronpedia_inference.sae_manager.Config.get_instance",
+            return_value=mock_config,
+        ),
+        patch.object(
+            SaeLensDirectory,
+            "get_sae_lens_ids",
+            side_effect=lambda model_id, neuronpedia_id: (  # noqa: ARG005
+                "release",
+                neuronpedia_id,
+            ),
+        ) as mock_get_sae_lens_ids,
+    ):
+        mock_sae_lens.load.side_effect = load
+        sae_manager = SAEManager(num_layers=12, device="cpu")
+        sae_manager.load_saes()
+        for sae_id in list(sae_manager.loaded_saes):
+            sae_manager.unload_sae(sae_id)
+        mock_sae_lens.load.reset_mock()
+        mock_get_sae_lens_ids.reset_mock()
+        sae_manager.mock_sae_lens = mock_sae_lens  # type: ignore
+        sae_manager.mock_get_sae_lens_ids = mock_get_sae_lens_ids  # type: ignore
+        yield sae_manager
+
+
+def test_memory_budget_tracks_bytes(budgeted_sae_manager: SAEManager) -> None:
+    budgeted_sae_manager.get_sae("0-res-jb")
+    budgeted_sae_manager.get_sae("1-res-jb")
+
+    assert budgeted_sae_manager.sae_data["0-res-jb"]["bytes"] == 256
+    assert budgeted_sae_manager.loaded_bytes == 512
+
+
+def test_memory_budget_evicts_least_recently_used(
+    budgeted_sae_manager: SAEManager,
+) -> None:
+    budgeted_sae_manager.get_sae("0-res-jb")
+    budgeted_sae_manager.get_sae("1-res-jb")
+    budgeted_sae_manager.get_sae("3-res-jb")
+    budgeted_sae_manager.get_sae("0-res-jb")
+    # 512 bytes, which only fits after evicting the two least recently used SAEs
+    budgeted_sae_manager.get_sae("2-res-jb")
+
+    assert list(budgeted_sae_manager.loaded_saes.keys()) == ["0-res-jb", "2-res-jb"]
+    assert budgeted_sae_manager.loaded_bytes == 768
+    assert budgeted_sae_manager.sae_data["1-res-jb"]["sae"] is None
+    assert budgeted_sae_manager.sae_data["1-res-jb"]["residency"] is None
+
+
+def test_evicted_saes_are_demoted_to_host(budgeted_sae_manager: SAEManager) -> None:
+    budgeted_sae_manager.sae_host_memory_budget_bytes = 1000
+    mock_sae_lens: MagicMock = budgeted_sae_manager.mock_sae_lens  # type: ignore
+    for i in [0, 1, 3, 4]:
+        budgeted_sae_manager.get_sae(f"{i}-res-jb")
+
+    assert list(budgeted_sae_manager.host_saes.keys()) == ["0-res-jb"]
+    assert budgeted_sae_manager.sae_data["0-res-jb"]["residency"] == "host"
+    sae = budgeted_sae_manager.sae_data["0-res-jb"]["sae"]
+    mock_sae_lens.to_host.assert_called_once_with(sae)
+
+    # promoting back from the host doesn't load the SAE again
+    assert budgeted_sae_manager.get_sae("0-res-jb") is sae
+    mock_sae_lens.to_device.assert_called_once_with(sae, "cpu")
+    assert mock_sae_lens.load.call_count == 4
+    assert budgeted_sae_manager.sae_data["0-res-jb"]["residency"] == "cpu"
+    assert list(budgeted_sae_manager.host_saes.keys()) == ["1-res-jb"]
+
+
+def test_host_overflow_is_demoted_to_disk(budgeted_sae_manager: SAEManager) -> None:
+    budgeted_sae_manager.sae_host_memory_budget_bytes = 300
+    budgeted_sae_manager.sae_disk_cache_dir = "/tmp/sae-cache"
+    mock_sae_lens: MagicMock = budgeted_sae_manager.mock_sae_lens  # type: ignore
+    for i in [0, 1, 3, 4, 6]:
+        budgeted_sae_manager.get_sae(f"{i}-res-jb")
+
+    # 0-res-jb went to the host, then to disk to make room for 1-res-jb
+    assert list(budgeted_sae_manager.host_saes.keys()) == ["1-res-jb"]
+    assert budgeted_sae_manager.sae_data["0-res-jb"]["residency"] == "disk"
+    assert budgeted_sae_manager.sae_data["0-res-jb"]["sae"] is None
+    disk_path = budgeted_sae_manager.sae_data["0-res-jb"]["disk_path"]
+    mock_sae_lens.save_to_disk.assert_called_once()
+
+    budgeted_sae_manager.get_sae("0-res-jb")
+    mock_sae_lens.load_from_disk.assert_called_once_with(
+        disk_path, device="cpu", dtype="float32"
+    )
+    assert mock_sae_lens.load.call_count == 5
+
+
+@pytest.fixture
+def registering_sae_manager(mock_config_multiple_sae_sets: Config):
+    # only 5-res-jb is loaded at startup, 7-att-kk is only registered
+    mock_config_multiple_sae_sets.max_loaded_saes = 1
+    with (
+        patch("neuronpedia_inference.sae_manager.SaeLensSAE") as mock_sae_lens,
+        patch(
+            "neuronpedia_inference.sae_manager.Config.get_instance",
+            return_value=mock_config_multiple_sae_sets,
+        ),
+    ):
+        mock_sae_lens.load.return_value = (MagicMock(), "mock_hook")
+        mock_sae_lens.load_metadata.return_value = {
+            "hook_name": "blocks.7.attn.hook_z",
+            "prepend_bos": True,
+            "neuronpedia_id": "gpt2-small/7-att-kk",
+        }
+        yield SAEManager(num_layers=12, device="cpu"), mock_sae_lens
+
+
+def test_load_saes_registers_metadata_without_weights(
+    registering_sae_manager: tuple[SAEManager, MagicMock],
+) -> None:
+    sae_manager, mock_sae_lens = registering_sae_manager
+    sae_manager.load_saes()
+
+    assert mock_sae_lens.load.call_count == 1
+    assert list(sae_manager.loaded_saes.keys()) == ["5-res-jb"]
+    assert sae_manager.sae_data["7-att-kk"]["sae"] is None
+    assert sae_manager.get_sae_hook("7-att-kk") == "blocks.7.attn.hook_z"
+    assert sae_manager.is_dfa_enabled("7-att-kk")
+
+    # the weights are loaded on first use
+    sae_manager.get_sae("7-att-kk")
+    assert mock_sae_lens.load.call_count == 2
+
+
+def test_load_saes_registers_sae_without_neuronpedia_id(
+    registering_sae_manager: tuple[SAEManager, MagicMock],
+) -> None:
+    sae_manager, mock_sae_lens = registering_sae_manager
+    mock_sae_lens.load_metadata.return_value["neuronpedia_id"] = None
+    sae_manager.load_saes()
+
+    assert sae_manager.sae_data["7-att-kk"]["neuronpedia_id"] is None
+    assert not sae_manager.is_dfa_enabled("7-att-kk")
+
+
+def test_load_saes_falls_back_to_loading_without_metadata(
+    registering_sae_manager: tuple[SAEManager, MagicMock],
+) -> None:
+    sae_manager, mock_sae_lens = registering_sae_manager
+    mock_sae_lens.load_metadata.side_effect = ValueError("no config")
+    sae_manager.load_saes()
+
+    assert mock_sae_lens.load.call_count == 2
+    assert list(sae_manager.loaded_saes.keys()) == ["5-res-jb"]
+    assert sae_manager.get_sae_hook("7-att-kk") == "mock_hook"
+
+
+def test_load_saes_loads_in_parallel_and_keeps_order(
+    mock_config_multiple_sae_sets: Config,
+) -> None:
+    mock_config_multiple_sae_sets.sae_load_workers = 2
+    load_threads: list[int] = []
+
+    def load(release: str, sae_id: str, device: str, dtype: str):  # noqa: ARG001
+        # the first SAE to start loading finishes last
+        is_first = not load_threads
+        load_threads.append(threading.get_ident())
+        if is_first:
+            time.sleep(0.2)
+        return MagicMock(), sae_id
+
+    with (
+        patch("neuronpedia_inference.sae_manager.SaeLensSAE") as mock_sae_lens,
+        patch(
+            "neuronpedia_inference.sae_manager.Config.get_instance",
+            return_value=mock_config_multiple_sae_sets,
+        ),
+    ):
+        mock_sae_lens.load.side_effect = load
+        sae_manager = SAEManager(num_layers=12, device="cpu")
+        sae_manager.load_saes()
+
+    assert list(sae_manager.loaded_saes.keys()) == ["5-res-jb", "7-att-kk"]
+    assert len(set(load_threads)) == 2
+
+
+def test_load_saes_stops_loading_at_the_memory_budget(
+    mock_config_multiple_sae_sets: Config,
+) -> None:
+    # room for one SAE of 256 bytes, the second one isn't loaded at all
+    mock_config_multiple_sae_sets.sae_memory_budget_bytes = 300
+    mock_config_multiple_sae_sets.sae_load_workers = 1
+    with (
+        patch("neuronpedia_inference.sae_manager.SaeLensSAE") as mock_sae_lens,
+        patch(
+            "neuronpedia_inference.sae_manager.Config.get_instance",
+            return_value=mock_config_multiple_sae_sets,
+        ),
+    ):
+        mock_sae_lens.load.side_effect = lambda **kwargs: (  # noqa: ARG005
+            TinySAE(16),
+            "mock_hook",
+        )
+        mock_sae_lens.load_metadata.return_value = {
+            "hook_name": "blocks.7.attn.hook_z",
+            "prepend_bos": True,
+            "neuronpedia_id": "gpt2-small/7-att-kk",
+        }
+        sae_manager = SAEManager(num_layers=12, device="cpu")
+        sae_manager.load_saes()
+
+    assert mock_sae_lens.load.call_count == 1
+    assert list(sae_manager.loaded_saes.keys()) == ["5-res-jb"]
+    assert sae_manager.sae_data["7-att-kk"]["sae"] is None
+    assert sae_manager.get_sae_hook("7-att-kk") == "blocks.7.attn.hook_z"
+
+
+def test_prefetched_sae_is_used_on_first_get(budgeted_sae_manager: SAEManager) -> None:
+    budgeted_sae_manager.sae_prefetch_count = 1
+    mock_sae_lens: MagicMock = budgeted_sae_manager.mock_sae_lens  # type: ignore
+    budgeted_sae_manager.prefetch_saes(["5-res-jb", "neurons-not-an-sae"])
+
+    assert list(budgeted_sae_manager.prefetching.keys()) == ["5-res-jb"]
+    prefetched_sae, _ = budgeted_sae_manager.prefetching["5-res-jb"].result()
+    assert mock_sae_lens.load.call_args.kwargs["device"] == "cpu"
+    mock_sae_lens.to_host.assert_called_once_with(prefetched_sae)
+
+    assert budgeted_sae_manager.get_sae("5-res-jb") is prefetched_sae
+    assert mock_sae_lens.load.call_count == 1
+    mock_sae_lens.to_device.assert_called_once_with(prefetched_sae, "cpu")
+    assert not budgeted_sae_manager.prefetching
+
+
+def test_prefetched_saes_are_used_while_processing_sources(
+    budgeted_sae_manager: SAEManager,
+) -> None:
+    sources = ["0-res-jb", "1-res-jb", "3-res-jb", "4-res-jb"]
+    for source in sources:
+        budgeted_sae_manager.get_sae(source)
+        budgeted_sae_manager.unload_sae(source)
+    budgeted_sae_manager.sae_prefetch_count = 2
+    mock_sae_lens: MagicMock = budgeted_sae_manager.mock_sae_lens  # type: ignore
+    mock_sae_lens.load.reset_mock()
+    request = MagicMock()
+    request.selected_sources = sources
+    request.feature_filter = []
+    request.sort_by_token_indexes = []
+    cache = {"mock_hook": torch.zeros(1, 3, 4)}
+
+    # the same calls as ActivationProcessor.process_activations
+    budgeted_sae_manager.get_sae(sources[0])
+    budgeted_sae_manager.prefetch_saes(sources[1:])
+    prefetches = dict(budgeted_sae_manager.prefetching)
+    with (
+        patch(
+            "neuronpedia_inference.endpoints.activation.all.SAEManager.get_instance",
+            return_value=budgeted_sae_manager,
+        ),
+        patch(
+            "neuronpedia_inference.endpoints.activation.all.SaeLensSAE"
+        ) as saelens_sae,
+    ):
+        saelens_sae.encode_stats.return_value = {
+            key: torch.zeros(1, 16)
+            for key in ["max_values", "max_indices", "sum_values", "nonzero_counts"]
+        }
+        ActivationProcessor()._process_sources(request, cache)  # type: ignore
+
+    assert list(prefetches) == ["1-res-jb", "3-res-jb"]
+    for sae_id, prefetch in prefetches.items():
+        assert budgeted_sae_manager.sae_data[sae_id]["sae"] is prefetch.result()[0]
+    # every SAE is only loaded once, all but the first in the background
+    assert mock_sae_lens.load.call_count == 4
+    assert mock_sae_lens.to_host.call_count == 3
+    assert not budgeted_sae_manager.prefetching
+
+
+def test_prefetch_is_disabled_by_default(budgeted_sae_manager: SAEManager) -> None:
+    budgeted_sae_manager.prefetch_saes(["5-res-jb"])
+
+    assert not budgeted_sae_manager.prefetching
+
+
+def test_compiled_saes_are_preferred(budgeted_sae_manager: SAEManager) -> None:
+    budgeted_sae_manager.sae_compiled_dir = "/tmp/compiled-saes"
+    mock_sae_lens: MagicMock = budgeted_sae_manager.mock_sae_lens  # type: ignore
+    mock_sae_lens.is_compiled.return_value = True
+    mock_sae_lens.load_compiled.return_value = (TinySAE(16), "mock_hook")
+
+    budgeted_sae_manager.get_sae("0-res-jb")
+
+    mock_sae_lens.load_compiled.assert_called_once_with(
+        "/tmp/compiled-saes/gpt2-small/0-res-jb", device="cpu", dtype="float32"
+    )
+    mock_sae_lens.load.assert_not_called()
+    budgeted_sae_manager.mock_get_sae_lens_ids.assert_not_called()  # type: ignore
+
+
+def test_saes_are_placed_on_their_layers_device(
+    budgeted_sae_manager: SAEManager,
+) -> None:
+    budgeted_sae_manager.device_placement = DevicePlacement(
+        ["cpu"] * 6 + ["cuda:1"] * 6, "cpu"
+    )
+
+    def load(release: str, sae_id: str, device: str, dtype: str):  # noqa: ARG001
+        return TinySAE(16), f"blocks.{sae_id.split('-')[0]}.hook_resid_pre"
+
+    mock_sae_lens: MagicMock = budgeted_sae_manager.mock_sae_lens  # type: ignore
+    mock_sae_lens.load.side_effect = load
+
+    sae = budgeted_sae_manager.get_sae("8-res-jb")
+
+    mock_sae_lens.to_device.assert_called_once_with(sae, "cuda:1")
+    assert budgeted_sae_manager.sae_data["8-res-jb"]["residency"] == "cuda:1"
+    assert budgeted_sae_manager.get_sae_device("8-res-jb") == "cuda:1"
+    assert budgeted_sae_manager.get_device_for_hook("blocks.2.hook_resid_pre") == "cpu"
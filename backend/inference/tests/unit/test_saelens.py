@@ -0,0 +1,87 @@
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+import torch
+from sae_lens.saes.jumprelu_sae import JumpReLUSAE, JumpReLUSAEConfig
+from sae_lens.saes.standard_sae import StandardSAE, StandardSAEConfig
+
+from neuronpedia_inference.saes.saelens import SaeLensSAE
+
+D_IN = 16
+D_SAE = 50
+
+
+def _randomize(sae: torch.nn.Module) -> torch.nn.Module:
+    torch.manual_seed(0)
+    with torch.no_grad():
+        for param in sae.parameters():
+            param.copy_(torch.randn_like(param) * 0.5)
+    return sae
+
+
+@pytest.fixture(params=["standard", "jumprelu"])
+def sae(request: pytest.FixtureRequest) -> torch.nn.Module:
+    if request.param == "standard":
+        return _randomize(StandardSAE(StandardSAEConfig(d_in=D_IN, d_sae=D_SAE)))
+    sae = _randomize(JumpReLUSAE(JumpReLUSAEConfig(d_in=D_IN, d_sae=D_SAE)))
+    with torch.no_grad():
+        sae.threshold.copy_(torch.rand(D_SAE))
+    return sae
+
+
+@pytest.mark.parametrize("chunk_size", [7, 50, 1000])
+def test_encode_chunks_matches_encode(sae: torch.nn.Module, chunk_size: int):
+    x = torch.randn(1, 5, D_IN)
+    with torch.no_grad():
+        expected = sae.encode(x)  # type: ignore
+
+    chunks = list(SaeLensSAE.encode_chunks(sae, x, chunk_size=chunk_size))
+
+    assert [start for start, _ in chunks] == list(range(0, D_SAE, chunk_size))
+    assert torch.allclose(torch.cat([acts for _, acts in chunks], dim=-1), expected)
+
+
+@pytest.mark.parametrize("chunk_size", [3, 7, 1000])
+def test_encode_topk_matches_dense_topk(sae: torch.nn.Module, chunk_size: int):
+    x = torch.randn(1, 5, D_IN)
+    with torch.no_grad():
+        expected_values, expected_indices = torch.topk(sae.encode(x), k=4)  # type: ignore
+
+    values, indices = SaeLensSAE.encode_topk(sae, x, k=4, chunk_size=chunk_size)
+
+    assert values.shape == (1, 5, 4)
+    assert torch.allclose(values, expected_values)
+    # only compare indices where the activation is nonzero, zeros can tie in any order
+    nonzero = expected_values > 0
+    assert torch.equal(indices[nonzero], expected_indices[nonzero])
+
+
+def test_encode_topk_too_many_features(sae: torch.nn.Module):
+    with pytest.raises(ValueError):
+        SaeLensSAE.encode_topk(sae, torch.randn(1, 2, D_IN), k=D_SAE + 1)
+
+
+def test_compiled_sae_round_trips(sae: torch.nn.Module, tmp_path: Path) -> None:
+    sae.cfg.metadata.hook_name = "blocks.0.hook_resid_pre"  # type: ignore
+    sae.cfg.metadata.prepend_bos = False  # type: ignore
+    sae.cfg.metadata.neuronpedia_id = "gpt2-small/0-res-test"  # type: ignore
+    path = str(tmp_path / "0-res-test")
+
+    with patch.object(
+        SaeLensSAE, "load", return_value=(sae, "blocks.0.hook_resid_pre")
+    ) as mock_load:
+        SaeLensSAE.compile("release", "sae_id", path, "float32")
+    mock_load.assert_called_once_with("release", "sae_id", "cpu", "float32")
+
+    assert SaeLensSAE.is_compiled(path)
+    assert SaeLensSAE.load_compiled_metadata(path) == {
+        "hook_name": "blocks.0.hook_resid_pre",
+        "prepend_bos": False,
+        "neuronpedia_id": "gpt2-small/0-res-test",
+    }
+    compiled_sae, hook_name = SaeLensSAE.load_compiled(path, "cpu", "float32")
+    assert hook_name == "blocks.0.hook_resid_pre"
+    assert compiled_sae.cfg.metadata.neuronpedia_id == "gpt2-small/0-res-test"
+    for name, tensor in sae.state_dict().items():
+        assert torch.equal(compiled_sae.state_dict()[name], tensor)
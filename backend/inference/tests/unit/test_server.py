@@ -1,5 +1,13 @@
+import subprocess
+import sys
 from unittest.mock import patch
 
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+
+import neuronpedia_inference.server as server
+from neuronpedia_inference.replicas import Replica, ReplicaPool
 from neuronpedia_inference.server import parse_env_and_args
 
 
@@ -7,3 +15,52 @@ from neuronpedia_inference.server import parse_env_and_args
 def test_multiple_sae_sets():
     parsed_args = parse_env_and_args()
     assert parsed_args.sae_sets == ["res-jb", "att-kk"]
+
+
+def test_server_imports_without_heavy_modules():
+    # the app has to answer /health before torch and friends are imported
+    code = (
+        "import sys\n"
+        "import neuronpedia_inference.server\n"
+        "heavy = {'torch', 'transformer_lens', 'transformers', 'sae_lens', 'pandas'}\n"
+        "print(sorted(heavy & set(sys.modules)))\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert result.stdout.strip() == "[]"
+
+
+def test_health_reports_startup_while_initializing():
+    with patch.object(server, "initialized", False):
+        response = TestClient(server.app).get("/health")
+
+    assert response.status_code == 503
+    assert response.json()["status"] == "initializing"
+    assert "phases" in response.json()["startup"]
+
+
+def test_streaming_requests_hold_their_replica_until_the_body_is_sent():
+    replica = Replica(0, "cuda:0", None, None, None, None)
+    pool = ReplicaPool([replica])
+    in_flight_while_streaming = []
+
+    app = FastAPI()
+    app.middleware("http")(server.route_to_replica)
+
+    @app.get("/v1/stream")
+    async def stream():
+        async def body():
+            for chunk in ["a", "b"]:
+                in_flight_while_streaming.append(replica.in_flight)
+                yield chunk
+
+        return StreamingResponse(body())
+
+    with patch.object(ReplicaPool, "_instance", pool):
+        response = TestClient(app).get("/v1/stream")
+
+    assert response.text == "ab"
+    assert in_flight_while_streaming == [1, 1]
+    assert replica.in_flight == 0
+    assert replica.requests == 1
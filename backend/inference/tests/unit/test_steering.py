@@ -1,4 +1,15 @@
-from neuronpedia_inference.inference_utils.steering import apply_generic_chat_template
+from unittest.mock import MagicMock, patch
+
+import torch
+from neuronpedia_inference_client.models.np_steer_method import NPSteerMethod
+from neuronpedia_inference_client.models.np_steer_type import NPSteerType
+from neuronpedia_inference_client.models.np_steer_vector import NPSteerVector
+
+from neuronpedia_inference.inference_utils.steering import (
+    RankOneProjector,
+    SteeringPlan,
+    apply_generic_chat_template,
+)
 
 
 def test_single_message_with_generation_prompt():
@@ -33,3 +44,95 @@ def test_empty_messages():
     result = apply_generic_chat_template([])
     expected = "<|im_start|>assistant\n"
     assert result == expected
+
+
+def compile_steering_plan(vectors, steer_method, position_mask=None):
+    sae_manager = MagicMock()
+    sae_manager.get_device_for_hook.return_value = "cpu"
+    model_cfg = MagicMock()
+    model_cfg.dtype = torch.float32
+    with patch(
+        "neuronpedia_inference.inference_utils.steering.SAEManager.get_instance",
+        return_value=sae_manager,
+    ):
+        return SteeringPlan.compile(
+            vectors,
+            [NPSteerType.STEERED, NPSteerType.DEFAULT],
+            2.0,
+            steer_method,
+            False,
+            model_cfg,
+            position_mask=position_mask,
+        )
+
+
+def run_hook(plan, hook_name, activations):
+    hook = MagicMock()
+    hook.name = hook_name
+    return plan.steer(activations.clone(), hook)
+
+
+def test_steering_plan_folds_the_features_of_a_hook_into_one_delta():
+    plan = compile_steering_plan(
+        [
+            NPSteerVector(steering_vector=[1.0, 0.0], strength=1, hook="a"),
+            NPSteerVector(steering_vector=[0.0, 1.0], strength=2, hook="a"),
+            NPSteerVector(steering_vector=[1.0, 1.0], strength=3, hook="b"),
+        ],
+        NPSteerMethod.SIMPLE_ADDITIVE,
+    )
+    assert sorted(name for name, _ in plan.get_fwd_hooks()) == ["a", "b"]
+
+    activations = torch.zeros(2, 3, 2)
+    steered = run_hook(plan, "a", activations)
+    # each feature is applied once, and only at its own hook
+    assert torch.equal(steered[0], torch.tensor([[2.0, 4.0]] * 3))
+    # the DEFAULT row isn't steered
+    assert torch.equal(steered[1], activations[1])
+    assert torch.equal(run_hook(plan, "b", activations)[0], torch.full((3, 2), 6.0))
+
+
+def test_steering_plan_position_mask():
+    plan = compile_steering_plan(
+        [NPSteerVector(steering_vector=[1.0, 0.0], strength=1, hook="a")],
+        NPSteerMethod.SIMPLE_ADDITIVE,
+        # don't steer the first position
+        position_mask=lambda n: torch.tensor([0.0] + [1.0] * (n - 1)),
+    )
+    steered = run_hook(plan, "a", torch.zeros(2, 3, 2))
+    assert torch.equal(steered[0, :, 0], torch.tensor([0.0, 2.0, 2.0]))
+    assert torch.equal(steered[1], torch.zeros(3, 2))
+
+
+def test_steering_plan_orthogonal_decomp_only_steers_steered_rows():
+    plan = compile_steering_plan(
+        [NPSteerVector(steering_vector=[1.0, 0.0], strength=1, hook="a")],
+        NPSteerMethod.ORTHOGONAL_DECOMP,
+    )
+    activations = torch.tensor([[[3.0, 4.0]], [[3.0, 4.0]]])
+    steered = run_hook(plan, "a", activations)
+    # the component along the steering vector is scaled by the strength (2)
+    assert torch.allclose(steered[0], torch.tensor([[6.0, 4.0]]))
+    assert torch.equal(steered[1], activations[1])
+
+
+def _orthogonal_projection(
+    activations: torch.Tensor, steering_vector: torch.Tensor, strength: float
+) -> torch.Tensor:
+    """The original projection, (I - P)h + strength * Ph with the d x d P = vv^T."""
+    P = torch.outer(steering_vector, steering_vector)
+    orthogonal_complement = torch.eye(P.shape[0]) - P
+    return torch.matmul(activations, orthogonal_complement.T) + strength * torch.matmul(
+        activations, P.T
+    )
+
+
+def test_rank_one_projector_matches_orthogonal_projection():
+    torch.manual_seed(0)
+    activations = torch.randn(2, 5, 64)
+    unit_vector = torch.nn.functional.normalize(torch.randn(64), dim=0)
+    for steering_vector in [torch.randn(64), unit_vector]:
+        for strength in [-3.0, 0.0, 1.0, 8.5]:
+            expected = _orthogonal_projection(activations, steering_vector, strength)
+            projected = RankOneProjector(steering_vector).project(activations, strength)
+            assert torch.allclose(projected, expected, rtol=1e-4, atol=1e-4)
@@ -191,7 +191,6 @@ case "$MODEL_PRESET" in
             --sae_dtype bfloat16 \
             --max_loaded_saes 100 \
             --include_sae 20-gemmascope-res-131k \
-            --optimize_memory \
             --auto_clear_cache"
         ;;
 